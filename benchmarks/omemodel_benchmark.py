@@ -0,0 +1,121 @@
+# This file is part of the pyometiff library.
+
+# pyometiff is distributed under the GNU General Public License v3.0 (GNU GPLv3),
+# specific files are distributed under different licenses, please refer to the
+# file header.
+
+# Modification and redistribution is possible under the terms of the applied
+# license agreement.
+
+# This software is distributed WITHOUT ANY WARRANTY.
+# See the GNU General Public License v3.0 for further details.
+
+# A copy of the GNU General Public License v3.0 should be included in pyometiff,
+# if you didn't receive a copy, visit <http://www.gnu.org/licenses/>.
+
+# Copyright (c) 2021, Filippo Maria Castelli
+
+"""Compare the memory of OMEModel with the parse_metadata dictionary and the lxml tree.
+
+The model and the dictionary are measured with tracemalloc. lxml allocates
+its tree in C, out of sight of tracemalloc, so the tree is measured by the
+growth of the resident set size while a few copies are held (Linux only).
+
+The size and decoding time of OMEModel.to_bytes are compared with the
+OME-XML text and with a pickle of the model (lxml trees cannot be pickled).
+
+    python benchmarks/omemodel_benchmark.py --planes 1000 10000 100000
+"""
+import argparse
+import gc
+import logging
+import os
+import pickle
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from omexml_benchmark import _make_document, time_call
+from pyometiff.omemodel import OMEModel
+from pyometiff.omereader import OMETIFFReader
+from pyometiff.omexml import OMEXML, ElementTree
+
+COPIES = 5
+
+
+def traced_size(build) -> float:
+    """Return the memory held by the objects build returns, per copy, as seen by tracemalloc"""
+    gc.collect()
+    tracemalloc.start()
+    objects = [build() for _ in range(COPIES)]
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] / len(objects)
+    tracemalloc.stop()
+    return size
+
+
+def resident_size(build) -> float | None:
+    """Return the growth of the resident set size per copy of the objects build returns, None off Linux"""
+    if not os.path.exists("/proc/self/statm"):
+        return None
+
+    def resident():
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    gc.collect()
+    before = resident()
+    objects = [build() for _ in range(COPIES)]
+    size = (resident() - before) / len(objects)
+    del objects
+    return size
+
+
+def parse_metadata(xml: str) -> dict:
+    reader = OMETIFFReader("benchmark.ome.tiff")
+    return reader.parse_metadata(xml)
+
+
+def benchmark_memory(n_planes: int) -> None:
+    xml = _make_document(n_planes)
+    xml_bytes = xml.encode()
+    model_size = traced_size(lambda: OMEModel.from_xml(xml))
+    metadata_size = traced_size(lambda: parse_metadata(xml))
+    tree_size = resident_size(lambda: ElementTree.fromstring(xml_bytes))
+    print("{} planes, {:.0f} kB of OME-XML".format(n_planes, len(xml_bytes) / 1e3))
+    print("  OMEModel {:10.0f} kB   parse_metadata dict {:10.0f} kB   lxml tree {} kB".format(
+        model_size / 1e3, metadata_size / 1e3, "n/a" if tree_size is None else "%.0f" % (tree_size / 1e3)))
+
+
+def benchmark_transport(n_planes: int) -> None:
+    xml = _make_document(n_planes)
+    xml_bytes = xml.encode()
+    model = OMEModel.from_xml(xml)
+    data = model.to_bytes()
+    pickled = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+    repeat = 5
+    print("  OME-XML  {:10.0f} kB   parsed in   {:8.4f}s".format(
+        len(xml_bytes) / 1e3, time_call(lambda: OMEXML(xml), repeat)))
+    print("  to_bytes {:10.0f} kB   decoded in  {:8.4f}s   encoded in {:8.4f}s".format(
+        len(data) / 1e3, time_call(lambda: OMEModel.from_bytes(data), repeat),
+        time_call(model.to_bytes, repeat)))
+    print("  pickle   {:10.0f} kB   loaded in   {:8.4f}s   dumped in  {:8.4f}s".format(
+        len(pickled) / 1e3, time_call(lambda: pickle.loads(pickled), repeat),
+        time_call(lambda: pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL), repeat)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--planes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="numbers of planes of the OME-XML documents")
+    args = parser.parse_args()
+    # parse_metadata warns about the instrument metadata the documents do not have
+    logging.disable(logging.WARNING)
+    for n_planes in args.planes:
+        benchmark_memory(n_planes)
+        benchmark_transport(n_planes)
+
+
+if __name__ == "__main__":
+    main()
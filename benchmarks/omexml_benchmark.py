@@ -0,0 +1,214 @@
+# This file is part of the pyometiff library.
+
+# pyometiff is distributed under the GNU General Public License v3.0 (GNU GPLv3),
+# specific files are distributed under different licenses, please refer to the
+# file header.
+
+# Modification and redistribution is possible under the terms of the applied
+# license agreement.
+
+# This software is distributed WITHOUT ANY WARRANTY.
+# See the GNU General Public License v3.0 for further details.
+
+# A copy of the GNU General Public License v3.0 should be included in pyometiff,
+# if you didn't receive a copy, visit <http://www.gnu.org/licenses/>.
+
+# Copyright (c) 2021, Filippo Maria Castelli
+
+"""Compare parse and lookup times of OMEXML against a plain xml.etree document.
+
+The xml.etree timings reproduce the previous engine: parsing with
+xml.etree.ElementTree and a findall on every accessor. The bulk TiffData
+generation is compared with the element-by-element loop it replaced, as it
+ran on xml.etree with the previous TiffData wrapper.
+
+    python benchmarks/omexml_benchmark.py --sizes 1 50 500
+"""
+import argparse
+import os
+import re
+import sys
+import time
+import xml.etree.ElementTree as StdElementTree
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyometiff.omexml import NS_RE, OMEXML, ElementTree, get_qualified_name
+
+LOOKUPS = 100
+
+
+def make_document(size_mb: float) -> str:
+    """Return an OME-XML document of about size_mb megabytes, made of Plane and TiffData entries"""
+    sample = _make_document(1000)
+    n_planes = max(1, int(size_mb * 1e6 / len(sample.encode()) * 1000))
+    return _make_document(n_planes)
+
+
+def _make_document(n_planes: int) -> str:
+    ox = OMEXML()
+    pixels = ox.image().Pixels
+    pixels.SizeZ = n_planes
+    pixels.channel_count = 4
+    pixels.populate_Planes({
+        "DeltaT": np.arange(n_planes) * 0.1, "DeltaTUnit": "s",
+        "ExposureTime": 0.01, "ExposureTimeUnit": "s",
+        "PositionX": 1.5, "PositionY": 2.5, "PositionZ": np.arange(n_planes) * 0.25,
+    })
+    pixels.populate_TiffData(explicit=True)
+    return ox.to_xml()
+
+
+class BaselineTiffData(object):
+    """The TiffData wrapper of the previous engine, which resolved the namespaces of every new element"""
+
+    def __init__(self, node: StdElementTree.Element) -> None:
+        self.node = node
+        self.ns = {'ome': None, 'sa': None, 'spw': None}
+        for child in node.iter():
+            match = re.match(NS_RE, re.match('{(.*)}(.*)', child.tag).group(1))
+            if match:
+                self.ns[match.group('ns_key').lower()] = match.group(0)
+
+    def set_FirstZ(self, value: int) -> None:
+        self.node.set("FirstZ", str(value))
+
+    def set_FirstC(self, value: int) -> None:
+        self.node.set("FirstC", str(value))
+
+    def set_FirstT(self, value: int) -> None:
+        self.node.set("FirstT", str(value))
+
+    def set_IFD(self, value: int) -> None:
+        self.node.set("IFD", str(value))
+
+    def set_PlaneCount(self, value: int) -> None:
+        self.node.set("PlaneCount", str(value))
+
+
+def baseline_pixels(size_z: int, size_c: int, size_t: int) -> StdElementTree.Element:
+    """Return the Pixels element of the default document as an xml.etree element"""
+    ox = OMEXML()
+    pixels = ox.image().Pixels
+    pixels.SizeZ, pixels.SizeC, pixels.SizeT = size_z, size_c, size_t
+    return StdElementTree.fromstring(ElementTree.tostring(pixels.node))
+
+
+def populate_TiffData_baseline(pixels: StdElementTree.Element) -> None:
+    """The element-by-element TiffData generation of the previous engine, populate_TiffData(explicit=True)"""
+    namespace = re.match('{(.*)}', pixels.tag).group(1)
+    for td in pixels.findall(get_qualified_name(namespace, "TiffData")):
+        pixels.remove(td)
+    sizes = {"Z": int(pixels.get("SizeZ")), "C": int(pixels.get("SizeC")), "T": int(pixels.get("SizeT"))}
+    setters = {"Z": BaselineTiffData.set_FirstZ, "C": BaselineTiffData.set_FirstC, "T": BaselineTiffData.set_FirstT}
+    dims = pixels.get("DimensionOrder")[-3:]
+    ifd = 0
+    for i in range(sizes[dims[2]]):
+        for j in range(sizes[dims[1]]):
+            for k in range(sizes[dims[0]]):
+                new_tiffdata = BaselineTiffData(
+                    StdElementTree.SubElement(pixels, get_qualified_name(namespace, "TiffData")))
+                setters[dims[2]](new_tiffdata, i)
+                setters[dims[1]](new_tiffdata, j)
+                setters[dims[0]](new_tiffdata, k)
+                new_tiffdata.set_IFD(ifd)
+                new_tiffdata.set_PlaneCount(1)
+                ifd = ifd + 1
+
+
+def time_call(func, repeat: int = 1) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark(size_mb: float) -> None:
+    xml = make_document(size_mb)
+    xml_bytes = xml.encode()
+    repeat = 3 if size_mb < 100 else 1
+
+    ox = OMEXML(xml)
+    ns = ox.namespaces["ome"]
+    n_planes = ox.image().Pixels.plane_count
+    indices = np.linspace(0, n_planes - 1, min(LOOKUPS, n_planes)).astype(int).tolist()
+
+    std_root = StdElementTree.fromstring(xml_bytes)
+    std_pixels = std_root.find(get_qualified_name(ns, "Image")).find(get_qualified_name(ns, "Pixels"))
+
+    def std_lookups():
+        for idx in indices:
+            len(std_pixels.findall(get_qualified_name(ns, "Plane")))
+            float(std_pixels.findall(get_qualified_name(ns, "Plane"))[idx].get("DeltaT"))
+            std_pixels.findall(get_qualified_name(ns, "TiffData"))[idx].get("IFD")
+            std_pixels.findall(get_qualified_name(ns, "Channel"))[idx % 4].get("Name")
+
+    def omexml_lookups():
+        pixels = ox.image().Pixels
+        for idx in indices:
+            pixels.plane_count
+            pixels.Plane(idx).DeltaT
+            pixels.Tiffdata(idx).IFD
+            pixels.Channel(idx % 4).Name
+
+    print("{:.0f} MB OME-XML, {} planes".format(len(xml_bytes) / 1e6, n_planes))
+    print("  parse      xml.etree {:8.3f}s   OMEXML {:8.3f}s".format(
+        time_call(lambda: StdElementTree.fromstring(xml_bytes), repeat), time_call(lambda: OMEXML(xml), repeat)))
+    # the first OMEXML pass also builds the child indexes
+    print("  {} lookups xml.etree {:8.3f}s   OMEXML {:8.3f}s (first pass {:.3f}s)".format(
+        len(indices), time_call(std_lookups, repeat), time_call(omexml_lookups, repeat),
+        time_call(lambda: (ox.namespaces.child_indexes.clear(), omexml_lookups()))))
+
+
+def compare_tiffdata(size_z: int = 50, size_c: int = 4, size_t: int = 250,
+                     repeat: int = 3) -> tuple[int, float, float]:
+    """Return the number of TiffData and the best times of the previous and of the bulk generation"""
+    def pixels():
+        ox = OMEXML()
+        pixels = ox.image().Pixels
+        pixels.SizeZ, pixels.SizeC, pixels.SizeT = size_z, size_c, size_t
+        return pixels
+
+    baseline_time = bulk_time = float("inf")
+    for _ in range(repeat):
+        baseline = baseline_pixels(size_z, size_c, size_t)
+        baseline_time = min(baseline_time, time_call(lambda: populate_TiffData_baseline(baseline)))
+        bulk = pixels()
+        bulk_time = min(bulk_time, time_call(lambda: bulk.populate_TiffData(explicit=True)))
+    return bulk.tiffdata_count, baseline_time, bulk_time
+
+
+def benchmark_tiffdata() -> None:
+    count, baseline_time, bulk_time = compare_tiffdata()
+    print("{} TiffData  previous engine {:8.3f}s   bulk {:8.3f}s   {:.1f}x".format(
+        count, baseline_time, bulk_time, baseline_time / bulk_time))
+
+
+def benchmark_indexed_access() -> None:
+    """Read every Plane and TiffData by index, the time should grow linearly with the number of planes"""
+    timings = {}
+    for n_planes in (10 ** 4, 10 ** 5):
+        pixels = OMEXML(_make_document(n_planes)).image().Pixels
+        timings[n_planes] = time_call(lambda: ([pixels.Plane(i).PositionZ for i in range(pixels.plane_count)],
+                                               [pixels.Tiffdata(i).IFD for i in range(pixels.tiffdata_count)]))
+    print("indexed access  1e4 planes {:8.3f}s   1e5 planes {:8.3f}s   {:.1f}x".format(
+        timings[10 ** 4], timings[10 ** 5], timings[10 ** 5] / timings[10 ** 4]))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 50, 500],
+                        help="sizes of the OME-XML documents in MB")
+    args = parser.parse_args()
+    benchmark_tiffdata()
+    benchmark_indexed_access()
+    for size_mb in args.sizes:
+        benchmark(size_mb)
+
+
+if __name__ == "__main__":
+    main()
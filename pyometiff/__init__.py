@@ -1,5 +1,7 @@
 from pyometiff.omereader import OMETIFFReader
-from pyometiff.omewriter import OMETIFFWriter
+from pyometiff.omewriter import OMETIFFWriter, AsyncOMETIFFWriter
 from pyometiff.omexml import OMEXML
+from pyometiff.omemodel import OMEModel
+from pyometiff.ometools import update_metadata, transcode, concat, extract
 
 __version__ = "1.1.4"
\ No newline at end of file
@@ -0,0 +1,578 @@
+# This file is part of the pyometiff library.
+
+# pyometiff is distributed under the GNU General Public License v3.0 (GNU GPLv3),
+# specific files are distributed under different licenses, please refer to the
+# file header.
+
+# Modification and redistribution is possible under the terms of the applied
+# license agreement.
+
+# This software is distributed WITHOUT ANY WARRANTY.
+# See the GNU General Public License v3.0 for further details.
+
+# A copy of the GNU General Public License v3.0 should be included in pyometiff,
+# if you didn't receive a copy, visit <http://www.gnu.org/licenses/>.
+
+# Copyright (c) 2021, Filippo Maria Castelli
+
+"""omemodel.py a compact typed model of OME metadata
+
+The model holds the images of an OME-XML document in slotted dataclasses,
+with the Plane and TiffData elements as NumPy structured arrays. It takes a
+fraction of the memory of the lxml tree while keeping the whole document,
+unlike the summary returned by OMETIFFReader.parse_metadata, for services
+keeping the metadata of many files at once. See
+benchmarks/omemodel_benchmark.py for measurements.
+
+Attributes the dataclasses do not name are kept as strings in their
+attributes dictionary, and elements they do not model (structured
+annotations, plates, ROIs, light sources...) are kept serialized, so that
+OMEModel.from_omexml(ox).to_omexml() gives back the same document. Numeric
+attributes are stored as numbers and written back in Python's shortest
+representation, "1.50" comes back as "1.5". Comments and the whitespace
+between elements are not kept.
+
+In the Plane and TiffData arrays -1, NaN and '' mark the attributes an
+element does not set. Elements setting an attribute to one of these values,
+such as PositionX="NaN", are kept serialized rather than in the arrays.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass, field, fields
+import json
+import struct
+import sys
+
+import numpy as np
+
+from xml.sax.saxutils import escape, quoteattr
+
+from pyometiff.omexml import (OMEXML, ElementTree, PLANE_COLUMNS, PLANE_INDEX_COLUMNS, get_attr_strings,
+                              match_namespaces)
+
+TIFFDATA_COLUMNS = ("IFD", "FirstZ", "FirstC", "FirstT", "PlaneCount")
+
+# the order of the children the model rebuilds, as in the OME 2016-06 schema
+OME_CHILD_ORDER = ("Rights", "Project", "Dataset", "Folder", "Experiment", "Plate", "Screen", "Experimenter",
+                   "ExperimenterGroup", "Instrument", "Image", "StructuredAnnotations", "ROI", "BinaryOnly")
+IMAGE_CHILD_ORDER = ("AcquisitionDate", "ExperimenterRef", "Description", "ExperimentRef", "ExperimenterGroupRef",
+                     "InstrumentRef", "ObjectiveSettings", "ImagingEnvironment", "StageLabel", "Pixels", "ROIRef",
+                     "MicrobeamManipulationRef", "AnnotationRef")
+INSTRUMENT_CHILD_ORDER = ("Microscope", "LightSource", "Laser", "Arc", "Filament", "LightEmittingDiode",
+                          "GenericExcitationSource", "Detector", "Objective", "FilterSet", "Filter", "Dichroic",
+                          "AnnotationRef")
+
+FRAGMENT_MARKER = "omemodel fragment "
+
+# binary encoding: magic and version, header length, JSON header, then the raw buffers
+BINARY_MAGIC = b"OMEM\x01"
+BINARY_HEADER = struct.Struct("<I")
+
+
+def _local_name(node: ElementTree.Element) -> str:
+    return ElementTree.QName(node).localname
+
+
+def _read_attributes(obj, node: ElementTree.Element) -> None:
+    """Set the typed fields of a model object from the attributes of a node, the others go to obj.attributes"""
+    types = obj.TYPES
+    extra = None
+    for key, value in node.attrib.items():
+        kind = types.get(key)
+        if kind is None:
+            if extra is None:
+                extra = {}
+            extra[sys.intern(key)] = value
+        elif kind is int:
+            setattr(obj, key, int(value))
+        elif kind is float:
+            setattr(obj, key, float(value))
+        else:
+            setattr(obj, key, sys.intern(value) if kind == "intern" else value)
+    obj.attributes = extra
+
+
+def _attribute_string(obj) -> str:
+    """Format the typed fields and the other attributes of a model object as XML attributes"""
+    items = [(key, getattr(obj, key)) for key in obj.TYPES]
+    if obj.attributes:
+        items += obj.attributes.items()
+    return "".join(" %s=%s" % (key, quoteattr(str(value))) for key, value in items if value is not None)
+
+
+def _serialize(nodes: list[ElementTree.Element]) -> tuple[tuple[str, bytes], ...] | None:
+    """Keep unmodelled elements as (<local name>, <XML>) pairs"""
+    if not nodes:
+        return None
+    return tuple((sys.intern(_local_name(node)), ElementTree.tostring(node, with_tail=False)) for node in nodes)
+
+
+class _Renderer(object):
+    """Collects the XML of a model, serialized elements are inserted once the document is parsed"""
+
+    def __init__(self, prefix: str = "") -> None:
+        self.prefix = prefix
+        self.parts = []
+        self.fragments = []
+
+    def start(self, tag_name: str, attributes: str = "") -> str:
+        return "<%s%s%s>" % (self.prefix, tag_name, attributes)
+
+    def end(self, tag_name: str) -> str:
+        return "</%s%s>" % (self.prefix, tag_name)
+
+    def empty(self, tag_name: str, attributes: str = "") -> str:
+        return "<%s%s%s/>" % (self.prefix, tag_name, attributes)
+
+    def ordered(self, elements: list[tuple[str, str | None]], serialized, order: tuple[str, ...]) -> None:
+        """Write model elements and serialized ones, sorted in schema order"""
+        entries = [(name, xml, None) for name, xml in elements if xml is not None]
+        entries += [(name, None, fragment) for name, fragment in serialized or ()]
+        entries.sort(key=lambda entry: order.index(entry[0]) if entry[0] in order else len(order))
+        for _, xml, fragment in entries:
+            if xml is not None:
+                self.parts.append(xml)
+            else:
+                self.fragment(fragment)
+
+    def fragment(self, xml: bytes) -> None:
+        self.parts.append("<!--%s%d-->" % (FRAGMENT_MARKER, len(self.fragments)))
+        self.fragments.append(xml)
+
+    def to_omexml(self) -> OMEXML:
+        ox = OMEXML("".join(self.parts))
+        if self.fragments:
+            comments = [comment for comment in ox.root_node.iter(ElementTree.Comment)
+                        if comment.text.startswith(FRAGMENT_MARKER)]
+            for comment in comments:
+                xml = self.fragments[int(comment.text[len(FRAGMENT_MARKER):])]
+                # moved into the document, the elements drop their redundant namespace declarations
+                wrapper = ElementTree.fromstring(b"<wrapper>" + xml + b"</wrapper>",
+                                                 ElementTree.XMLParser(huge_tree=True))
+                parent = comment.getparent()
+                index = parent.index(comment)
+                parent[index:index + 1] = list(wrapper)
+        return ox
+
+
+@dataclass(slots=True)
+class Channel:
+    """The OME/Image/Pixels/Channel element"""
+    ID: str | None = None
+    Name: str | None = None
+    SamplesPerPixel: int | None = None
+    Color: int | None = None
+    ExcitationWavelength: float | None = None
+    ExcitationWavelengthUnit: str | None = None
+    EmissionWavelength: float | None = None
+    EmissionWavelengthUnit: str | None = None
+    Fluor: str | None = None
+    attributes: dict[str, str] | None = None
+    children: tuple[tuple[str, bytes], ...] | None = None
+
+    TYPES = {"ID": str, "Name": str, "SamplesPerPixel": int, "Color": int, "ExcitationWavelength": float,
+             "ExcitationWavelengthUnit": "intern", "EmissionWavelength": float, "EmissionWavelengthUnit": "intern",
+             "Fluor": str}
+
+    @classmethod
+    def from_node(cls, node: ElementTree.Element) -> "Channel":
+        channel = cls()
+        _read_attributes(channel, node)
+        channel.children = _serialize([child for child in node if isinstance(child.tag, str)])
+        return channel
+
+    def render(self, renderer: _Renderer) -> None:
+        if not self.children:
+            renderer.parts.append(renderer.empty("Channel", _attribute_string(self)))
+            return
+        renderer.parts.append(renderer.start("Channel", _attribute_string(self)))
+        for _, xml in self.children:
+            renderer.fragment(xml)
+        renderer.parts.append(renderer.end("Channel"))
+
+
+def _table_from_nodes(nodes: list[ElementTree.Element], names: tuple[str, ...],
+                      kinds: dict[str, str]) -> np.ndarray | None:
+    """Gather attributes of nodes into a structured array, -1, NaN and '' standing for missing values
+
+    Columns missing from every node are left out of the array. None is
+    returned when a value set on a node reads as one of the missing markers
+    (a negative integer, a NaN or an empty string), the nodes are then kept
+    serialized so that the value is not lost.
+    """
+    rows = [tuple(node.get(name) for name in names) for node in nodes]
+    arrays = []
+    for name, column in zip(names, zip(*rows)):
+        if all(value is None for value in column):
+            continue
+        present = np.array([value is not None for value in column])
+        if kinds[name] == "i":
+            values = np.array(["-1" if value is None else value for value in column]).astype(np.int32)
+            missing = values < 0
+        elif kinds[name] == "f":
+            values = np.array(["nan" if value is None else value for value in column]).astype(np.float64)
+            missing = np.isnan(values)
+        else:
+            values = np.array(["" if value is None else value for value in column], dtype=str)
+            missing = values == ""
+        if (missing & present).any():
+            return None
+        arrays.append((name, values))
+    table = np.empty(len(nodes), dtype=[(name, values.dtype) for name, values in arrays])
+    for name, values in arrays:
+        table[name] = values
+    return table
+
+
+def _table_elements(renderer: _Renderer, tag_name: str, table: np.ndarray) -> str:
+    """Format the rows of a structured array as elements, leaving missing values out"""
+    columns = []
+    for name in table.dtype.names:
+        values = table[name]
+        if values.dtype.kind == "i":
+            strings = [None if value < 0 else str(value) for value in values.tolist()]
+        else:
+            strings = get_attr_strings(values)
+        columns.append([None if value is None else ' %s=%s' % (name, quoteattr(value)) for value in strings])
+    return "".join(renderer.empty(tag_name, "".join(cell for cell in row if cell is not None))
+                   for row in zip(*columns))
+
+
+def _is_tabular(nodes: list[ElementTree.Element], names: tuple[str, ...]) -> bool:
+    return all(len(node) == 0 and all(key in names for key in node.attrib) for node in nodes)
+
+
+@dataclass(slots=True)
+class Pixels:
+    """The OME/Image/Pixels element, with the Plane and TiffData elements as structured arrays
+
+    planes has the fields of OMEXML.Pixels.plane_table and tiffdata the
+    IFD, FirstZ, FirstC, FirstT and PlaneCount fields (as int32, -1 where
+    missing), limited to the attributes set on at least one element.
+    Planes or TiffData elements with other content, or with values reading
+    as missing, are kept serialized in data (TiffData, BinData,
+    MetadataOnly) and plane_data instead.
+    """
+    ID: str | None = None
+    DimensionOrder: str | None = None
+    Type: str | None = None
+    SizeX: int | None = None
+    SizeY: int | None = None
+    SizeZ: int | None = None
+    SizeC: int | None = None
+    SizeT: int | None = None
+    PhysicalSizeX: float | None = None
+    PhysicalSizeXUnit: str | None = None
+    PhysicalSizeY: float | None = None
+    PhysicalSizeYUnit: str | None = None
+    PhysicalSizeZ: float | None = None
+    PhysicalSizeZUnit: str | None = None
+    TimeIncrement: float | None = None
+    TimeIncrementUnit: str | None = None
+    attributes: dict[str, str] | None = None
+    channels: list[Channel] = field(default_factory=list)
+    tiffdata: np.ndarray | None = None
+    planes: np.ndarray | None = None
+    data: tuple[tuple[str, bytes], ...] | None = None
+    plane_data: tuple[tuple[str, bytes], ...] | None = None
+
+    TYPES = {"ID": str, "DimensionOrder": "intern", "Type": "intern", "SizeX": int, "SizeY": int, "SizeZ": int,
+             "SizeC": int, "SizeT": int, "PhysicalSizeX": float, "PhysicalSizeXUnit": "intern",
+             "PhysicalSizeY": float, "PhysicalSizeYUnit": "intern", "PhysicalSizeZ": float,
+             "PhysicalSizeZUnit": "intern", "TimeIncrement": float, "TimeIncrementUnit": "intern"}
+
+    @classmethod
+    def from_node(cls, node: ElementTree.Element) -> "Pixels":
+        pixels = cls()
+        _read_attributes(pixels, node)
+        children = {"Channel": [], "TiffData": [], "Plane": [], "other": []}
+        for child in node:
+            if isinstance(child.tag, str):
+                name = _local_name(child)
+                children[name if name in children else "other"].append(child)
+        pixels.channels = [Channel.from_node(child) for child in children["Channel"]]
+
+        if children["TiffData"] and _is_tabular(children["TiffData"], TIFFDATA_COLUMNS):
+            pixels.tiffdata = _table_from_nodes(
+                children["TiffData"], TIFFDATA_COLUMNS, dict.fromkeys(TIFFDATA_COLUMNS, "i"))
+        if pixels.tiffdata is None:
+            children["other"] = children["TiffData"] + children["other"]
+        pixels.data = _serialize(children["other"])
+
+        plane_names = PLANE_INDEX_COLUMNS + PLANE_COLUMNS
+        if children["Plane"] and _is_tabular(children["Plane"], plane_names):
+            kinds = {name: "i" if name in PLANE_INDEX_COLUMNS else "U" if name.endswith("Unit") else "f"
+                     for name in plane_names}
+            pixels.planes = _table_from_nodes(children["Plane"], plane_names, kinds)
+        if pixels.planes is None:
+            pixels.plane_data = _serialize(children["Plane"])
+        return pixels
+
+    def render(self, renderer: _Renderer) -> None:
+        renderer.parts.append(renderer.start("Pixels", _attribute_string(self)))
+        for channel in self.channels:
+            channel.render(renderer)
+        for _, xml in self.data or ():
+            renderer.fragment(xml)
+        if self.tiffdata is not None:
+            renderer.parts.append(_table_elements(renderer, "TiffData", self.tiffdata))
+        if self.planes is not None:
+            renderer.parts.append(_table_elements(renderer, "Plane", self.planes))
+        for _, xml in self.plane_data or ():
+            renderer.fragment(xml)
+        renderer.parts.append(renderer.end("Pixels"))
+
+
+@dataclass(slots=True)
+class Image:
+    """The OME/Image element
+
+    children holds the elements other than AcquisitionDate, Description,
+    InstrumentRef and Pixels, serialized.
+    """
+    ID: str | None = None
+    Name: str | None = None
+    AcquisitionDate: str | None = None
+    Description: str | None = None
+    InstrumentRef: str | None = None
+    pixels: Pixels | None = None
+    attributes: dict[str, str] | None = None
+    children: tuple[tuple[str, bytes], ...] | None = None
+
+    TYPES = {"ID": str, "Name": str}
+
+    @classmethod
+    def from_node(cls, node: ElementTree.Element) -> "Image":
+        image = cls()
+        _read_attributes(image, node)
+        others = []
+        for child in node:
+            if not isinstance(child.tag, str):
+                continue
+            name = _local_name(child)
+            if name == "Pixels":
+                image.pixels = Pixels.from_node(child)
+            elif name in ("AcquisitionDate", "Description") and len(child) == 0 and not child.attrib:
+                setattr(image, name, child.text)
+            elif name == "InstrumentRef" and len(child) == 0 and list(child.attrib) == ["ID"]:
+                image.InstrumentRef = child.get("ID")
+            else:
+                others.append(child)
+        image.children = _serialize(others)
+        return image
+
+    def render(self, renderer: _Renderer) -> None:
+        renderer.parts.append(renderer.start("Image", _attribute_string(self)))
+        elements = [
+            ("AcquisitionDate", None if self.AcquisitionDate is None
+             else renderer.start("AcquisitionDate") + escape(self.AcquisitionDate) + renderer.end("AcquisitionDate")),
+            ("Description", None if self.Description is None
+             else renderer.start("Description") + escape(self.Description) + renderer.end("Description")),
+            ("InstrumentRef", None if self.InstrumentRef is None
+             else renderer.empty("InstrumentRef", " ID=%s" % quoteattr(self.InstrumentRef))),
+        ]
+        before = [entry for entry in self.children or () if entry[0] in IMAGE_CHILD_ORDER[:9]]
+        after = [entry for entry in self.children or () if entry not in before]
+        renderer.ordered(elements, before, IMAGE_CHILD_ORDER)
+        if self.pixels is not None:
+            self.pixels.render(renderer)
+        renderer.ordered([], after, IMAGE_CHILD_ORDER)
+        renderer.parts.append(renderer.end("Image"))
+
+
+@dataclass(slots=True)
+class Instrument:
+    """The OME/Instrument element
+
+    Microscope, Detectors and Objectives hold the attributes of those
+    elements, the other elements of the instrument (light sources, filters,
+    annotation references) are kept serialized in children.
+    """
+    ID: str | None = None
+    Microscope: dict[str, str] | None = None
+    Detectors: list[dict[str, str]] = field(default_factory=list)
+    Objectives: list[dict[str, str]] = field(default_factory=list)
+    attributes: dict[str, str] | None = None
+    children: tuple[tuple[str, bytes], ...] | None = None
+
+    TYPES = {"ID": str}
+
+    @classmethod
+    def from_node(cls, node: ElementTree.Element) -> "Instrument":
+        instrument = cls()
+        _read_attributes(instrument, node)
+        others = []
+        for child in node:
+            if not isinstance(child.tag, str):
+                continue
+            name = _local_name(child)
+            if len(child) or name not in ("Microscope", "Detector", "Objective"):
+                others.append(child)
+            elif name == "Microscope":
+                instrument.Microscope = dict(child.attrib)
+            else:
+                getattr(instrument, name + "s").append(dict(child.attrib))
+        instrument.children = _serialize(others)
+        return instrument
+
+    def render(self, renderer: _Renderer) -> None:
+        def element(tag_name, attributes):
+            return renderer.empty(tag_name, "".join(" %s=%s" % (key, quoteattr(value))
+                                                    for key, value in attributes.items()))
+
+        elements = [("Microscope", None if self.Microscope is None else element("Microscope", self.Microscope))]
+        elements += [("Detector", element("Detector", detector)) for detector in self.Detectors]
+        elements += [("Objective", element("Objective", objective)) for objective in self.Objectives]
+        renderer.parts.append(renderer.start("Instrument", _attribute_string(self)))
+        renderer.ordered(elements, self.children, INSTRUMENT_CHILD_ORDER)
+        renderer.parts.append(renderer.end("Instrument"))
+
+
+def _encode(value, buffers: list) -> object:
+    """Turn a model value into JSON-compatible data, arrays and serialized elements go to buffers"""
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, list):
+        return [_encode(item, buffers) for item in value]
+    if isinstance(value, tuple):
+        return {"T": [_encode(item, buffers) for item in value]}
+    if isinstance(value, dict):
+        return {"M": [[key, _encode(item, buffers)] for key, item in value.items()]}
+    if isinstance(value, bytes):
+        buffers.append(value)
+        return {"B": len(buffers) - 1}
+    if isinstance(value, np.ndarray):
+        buffers.append(np.ascontiguousarray(value).tobytes())
+        return {"A": len(buffers) - 1, "dtype": np.lib.format.dtype_to_descr(value.dtype)}
+    return {"C": type(value).__name__,
+            "V": [_encode(getattr(value, item.name), buffers) for item in fields(value)]}
+
+
+def _decode(value, buffers: list[memoryview]) -> object:
+    if isinstance(value, list):
+        return [_decode(item, buffers) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if "C" in value:
+        cls = MODEL_CLASSES[value["C"]]
+        obj = cls(*[_decode(item, buffers) for item in value["V"]])
+        for key, kind in getattr(cls, "TYPES", {}).items():
+            if kind == "intern" and getattr(obj, key) is not None:
+                setattr(obj, key, sys.intern(getattr(obj, key)))
+        return obj
+    if "A" in value:
+        dtype = np.lib.format.descr_to_dtype(value["dtype"])
+        return np.frombuffer(buffers[value["A"]], dtype=dtype).copy()
+    if "B" in value:
+        return bytes(buffers[value["B"]])
+    if "T" in value:
+        return tuple(_decode(item, buffers) for item in value["T"])
+    return {key: _decode(item, buffers) for key, item in value["M"]}
+
+
+@dataclass(slots=True)
+class OMEModel:
+    """An OME-XML document as images and instruments
+
+    namespaces maps the prefixes of the root element to their URIs and
+    attributes holds its attributes by qualified name. The other top-level
+    elements (plates, structured annotations, ROIs...) are kept serialized
+    in children.
+    """
+    namespaces: dict[str | None, str]
+    images: list[Image] = field(default_factory=list)
+    instruments: list[Instrument] = field(default_factory=list)
+    attributes: dict[str, str] | None = None
+    children: tuple[tuple[str, bytes], ...] | None = None
+
+    @classmethod
+    def from_omexml(cls, ox: OMEXML) -> "OMEModel":
+        root = ox.root_node
+        model = cls(dict(root.nsmap), attributes=dict(root.attrib) or None)
+        others = []
+        for child in root:
+            if not isinstance(child.tag, str):
+                continue
+            name = _local_name(child)
+            if name == "Image":
+                model.images.append(Image.from_node(child))
+            elif name == "Instrument":
+                model.instruments.append(Instrument.from_node(child))
+            else:
+                others.append(child)
+        model.children = _serialize(others)
+        return model
+
+    @classmethod
+    def from_xml(cls, xml: str | bytes) -> "OMEModel":
+        return cls.from_omexml(OMEXML(xml))
+
+    def to_omexml(self) -> OMEXML:
+        ome_namespace = match_namespaces(list(self.namespaces.values()))['ome']
+        prefixes = {uri: prefix for prefix, uri in self.namespaces.items()}
+        prefix = prefixes[ome_namespace]
+        renderer = _Renderer("%s:" % prefix if prefix else "")
+        declarations = "".join(' xmlns%s=%s' % (":" + prefix if prefix else "", quoteattr(uri))
+                               for prefix, uri in self.namespaces.items())
+        attributes = ""
+        for key, value in (self.attributes or {}).items():
+            qname = ElementTree.QName(key)
+            if qname.namespace is not None:
+                key = "%s:%s" % (prefixes[qname.namespace], qname.localname)
+            attributes += " %s=%s" % (key, quoteattr(value))
+        renderer.parts.append(renderer.start("OME", declarations + attributes))
+        before = [entry for entry in self.children or () if entry[0] in OME_CHILD_ORDER[:9]]
+        after = [entry for entry in self.children or () if entry not in before]
+        renderer.ordered([], before, OME_CHILD_ORDER)
+        for instrument in self.instruments:
+            instrument.render(renderer)
+        for image in self.images:
+            image.render(renderer)
+        renderer.ordered([], after, OME_CHILD_ORDER)
+        renderer.parts.append(renderer.end("OME"))
+        return renderer.to_omexml()
+
+    def to_xml(self) -> str:
+        return self.to_omexml().to_xml()
+
+    def to_bytes(self) -> bytes:
+        """Encode the model in a compact binary form, to hand it to another process
+
+        The form is a small JSON header describing the dataclasses followed
+        by the raw buffers of the plane and TiffData tables and of the
+        serialized elements. It is meant for transport between processes
+        running the same pyometiff version, not for storage.
+        """
+        buffers = []
+        header = json.dumps({"model": _encode(self, buffers), "buffers": [len(buffer) for buffer in buffers]},
+                            separators=(",", ":")).encode()
+        return b"".join([BINARY_MAGIC, BINARY_HEADER.pack(len(header)), header] + buffers)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "OMEModel":
+        """Decode a model encoded by to_bytes, raises ValueError on truncated or malformed data"""
+        if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+            raise ValueError("not an encoded OMEModel")
+        offset = len(BINARY_MAGIC) + BINARY_HEADER.size
+        if offset > len(data):
+            raise ValueError("truncated OMEModel encoding: %d bytes" % len(data))
+        header_length, = BINARY_HEADER.unpack_from(data, len(BINARY_MAGIC))
+        if offset + header_length > len(data):
+            raise ValueError("truncated OMEModel encoding: header of %d bytes past the end of %d bytes"
+                             % (header_length, len(data)))
+        header = json.loads(bytes(data[offset:offset + header_length]))
+        offset += header_length
+        view = memoryview(data)
+        buffers = []
+        for length in header["buffers"]:
+            if offset + length > len(data):
+                raise ValueError("truncated OMEModel encoding: buffer of %d bytes past the end of %d bytes"
+                                 % (length, len(data)))
+            buffers.append(view[offset:offset + length])
+            offset += length
+        if offset != len(data):
+            raise ValueError("malformed OMEModel encoding: %d bytes after the last buffer" % (len(data) - offset))
+        return _decode(header["model"], buffers)
+
+
+MODEL_CLASSES = {cls.__name__: cls for cls in (Channel, Pixels, Image, Instrument, OMEModel)}
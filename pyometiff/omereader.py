@@ -18,7 +18,6 @@
 
 from pathlib import Path
 import pathlib
-from lxml import etree as et
 
 from pyometiff.omexml import OMEXML
 
@@ -44,14 +43,13 @@ class OMETIFFReader:
         if not hasattr(self, "omexml_string"):
             _, _, _ = self.read()
         xml_fpath = self.fpath.parent.joinpath(self.fpath.stem + ".xml")
-        tree = et.ElementTree(et.fromstring(self.omexml_string.encode("utf-8")))
-        tree.write(str(xml_fpath), encoding="utf-8", method="xml", pretty_print=True)
+        self.ox.write_to(str(xml_fpath), pretty=True)
 
     def parse_metadata(self, omexml_string):
         if omexml_string is None:
             logging.warning("File {} has no OME-XML tags!".format(str(self.fpath)))
             return None
-        self.ox = OMEXML(omexml_string)
+        self.ox = OMEXML(omexml_string, lazy=True)
         metadata = self._get_metadata_template()
         metadata["Directory"] = str(self.fpath.parent)
         metadata["Filename"] = str(self.fpath.name)
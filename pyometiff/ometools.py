@@ -0,0 +1,514 @@
+# This file is part of the pyometiff library.
+
+# pyometiff is distributed under the GNU General Public License v3.0 (GNU GPLv3),
+# specific files are distributed under different licenses, please refer to the
+# file header.
+
+# Modification and redistribution is possible under the terms of the applied
+# license agreement.
+
+# This software is distributed WITHOUT ANY WARRANTY.
+# See the GNU General Public License v3.0 for further details.
+
+# A copy of the GNU General Public License v3.0 should be included in pyometiff,
+# if you didn't receive a copy, visit <http://www.gnu.org/licenses/>.
+
+# Copyright (c) 2021, Filippo Maria Castelli
+import contextlib
+import copy
+import uuid
+from pathlib import Path
+from typing import Callable, Iterable, Union
+
+import numpy as np
+import tifffile
+
+from pyometiff.omewriter import BYTE_BOUNDARY, _iter_prefetched
+from pyometiff.omexml import OMEXML, ElementTree, get_plane_indices, get_qualified_name
+
+
+def update_metadata(fpath: Path, changes: Union[dict, Callable[[OMEXML], None]], imageseries: int = 0) -> OMEXML:
+    """
+    Rewrite the OME-XML of an OME-TIFF file in place, without touching its pixel data.
+
+    Only the ImageDescription tag of the first IFD is patched: the new OME-XML overwrites the old one if it fits,
+    otherwise it is appended at the end of the file and the tag is repointed to it.
+    For multi-file datasets each file holds its own copy of the OME-XML and has to be updated separately.
+
+    :param fpath: path to the OME-TIFF file
+    :param changes: either a callable editing the OMEXML object in place, or a dictionary in the OMETIFFWriter
+        metadata format: "Name" and "AcquisitionDate" of the image, Pixels attributes such as "PhysicalSizeX" and a
+        "Channels" dictionary mapping current channel names (or indices) to the channel attributes to set
+    :param imageseries: index of the image the dictionary changes apply to
+    :return: the updated OMEXML
+    """
+    with tifffile.TiffFile(str(fpath), mode="r+b") as tif:
+        description = tif.pages[0].tags.get("ImageDescription")
+        if description is None or not tif.is_ome:
+            raise ValueError("File {} has no OME-XML tags!".format(str(fpath)))
+
+        ox = OMEXML(tif.ome_metadata)
+        if callable(changes):
+            changes(ox)
+        else:
+            _apply_metadata_changes(ox, changes, imageseries)
+
+        description.overwrite(ox.to_bytes())
+    return ox
+
+
+def _apply_metadata_changes(ox: OMEXML, changes: dict, imageseries: int = 0) -> None:
+    image = ox.image(imageseries)
+    pixels = image.Pixels
+    changes = changes.copy()
+
+    if "Name" in changes:
+        image.set_Name(changes.pop("Name"))
+    if "AcquisitionDate" in changes:
+        image.set_AcquisitionDate(changes.pop("AcquisitionDate"))
+
+    channels_dict = changes.pop("Channels", {})
+    for key, item in changes.items():
+        if not isinstance(getattr(type(pixels), key, None), property):
+            raise KeyError("Pixels has no attribute {}".format(key))
+        setattr(pixels, key, item)
+
+    channel_names = pixels.get_channel_names()
+    for channel_key, channel_dict in channels_dict.items():
+        if isinstance(channel_key, int):
+            idx = channel_key
+        elif channel_key in channel_names:
+            idx = channel_names.index(channel_key)
+        else:
+            raise KeyError("No channel named {}".format(channel_key))
+        channel = pixels.Channel(idx)
+        for key, item in channel_dict.items():
+            if not isinstance(getattr(type(channel), key, None), property):
+                raise KeyError("Channel has no attribute {}".format(key))
+            setattr(channel, key, item)
+
+
+def _compression_tag(compression) -> int:
+    """Normalize a tifffile compression argument to its TIFF Compression tag value"""
+    if compression is None or compression is False:
+        return tifffile.COMPRESSION.NONE.value
+    if compression is True:
+        return tifffile.COMPRESSION.ADOBE_DEFLATE.value
+    if isinstance(compression, str):
+        compression = compression.upper()
+        if compression == "ZLIB":
+            return tifffile.COMPRESSION.ADOBE_DEFLATE.value
+        return tifffile.COMPRESSION[compression].value
+    return tifffile.COMPRESSION(compression).value
+
+
+def _page_tile(page: tifffile.TiffPage) -> Union[tuple, None]:
+    return (page.tilelength, page.tilewidth) if page.is_tiled else None
+
+
+def _page_encoding(page: tifffile.TiffPage) -> dict:
+    """TiffWriter.write arguments reproducing the layout and encoding of a page"""
+    return {
+        "shape": page.shape,
+        "dtype": page.dtype,
+        "photometric": page.photometric,
+        "planarconfig": page.planarconfig,
+        "compression": page.compression,
+        "predictor": page.predictor if page.predictor > 1 else None,
+        "tile": _page_tile(page),
+        "rowsperstrip": None if page.is_tiled else page.rowsperstrip,
+        "jpegtables": page.jpegtables,
+        "subsampling": page.subsampling,
+        "extrasamples": page.extrasamples,
+    }
+
+
+def _read_raw_segments(page: tifffile.TiffPage) -> list:
+    return [data for data, _ in page.parent.filehandle.read_segments(
+        page.dataoffsets, page.databytecounts, lock=page.parent.filehandle.lock)]
+
+
+def _write_pages(out: tifffile.TiffWriter, pages: list, read_page: Callable, description: bytes,
+                 encoding: Callable[[tifffile.TiffPage], dict], max_inflight: int, maxworkers: int = None) -> None:
+    """Write pages in order, reading (and decoding) the next ones in background threads meanwhile
+
+    read_page returns either a decoded array or, for pages copied verbatim, a list of compressed segments
+    """
+    for idx, (page, data) in enumerate(zip(pages, _iter_prefetched(read_page, pages, max_inflight))):
+        if isinstance(data, list):
+            # pre-compressed strips or tiles are written as they are
+            data = iter(data)
+            kwargs = _page_encoding(page)
+        else:
+            kwargs = encoding(page)
+        out.write(data, description=description if idx == 0 else None, metadata=None, software=False,
+                  maxworkers=maxworkers, **kwargs)
+
+
+def transcode(src: Path, dst: Path, compression: Union[str, int, None] = None, tile: tuple = None,
+              predictor: Union[str, int, bool, None] = None, maxworkers: int = None,
+              bigtiff: bool = None) -> None:
+    """
+    Rewrite an OME-TIFF file with a different compression or tiling, preserving its OME-XML.
+
+    Pages are decoded by a pool of background threads while the previous ones are encoded and written, encoding of
+    tiled pages is itself spread over maxworkers threads. Pages whose compression, predictor and tiling already
+    match the requested ones are not decoded at all: their compressed strips or tiles are copied verbatim.
+    Pyramid levels stored in SubIFDs are not copied.
+
+    :param src: path to the OME-TIFF file to read
+    :param dst: path to the OME-TIFF file to write
+    :param compression: compression of the output (e.g. "zstd", "zlib", "lzw"), if None, no compression is used
+    :param tile: (length, width) of the output tiles, if None, pages are written in strips
+    :param predictor: predictor used with compression, e.g. "horizontal"
+    :param maxworkers: number of threads used to decode and encode, by default as many as tifffile uses
+    :param bigtiff: if None, the output is BigTIFF if the input is BigTIFF or larger than 4GB
+    """
+    target_compression = _compression_tag(compression)
+    target_tile = None if tile is None else tuple(tile)
+    if predictor in (None, False, 1):
+        target_predictor = None
+    elif isinstance(predictor, str):
+        target_predictor = tifffile.PREDICTOR[predictor.upper()].value
+    else:
+        target_predictor = predictor
+
+    def _is_passthrough(page: tifffile.TiffPage) -> bool:
+        page_predictor = page.predictor if page.predictor > 1 else None
+        return (page.compression == target_compression
+                and _page_tile(page) == target_tile
+                and (predictor is True or page_predictor == target_predictor))
+
+    def _read_page(page: tifffile.TiffPage):
+        if _is_passthrough(page):
+            return _read_raw_segments(page)
+        return page.asarray(lock=page.parent.filehandle.lock, maxworkers=1)
+
+    def _encoding(page: tifffile.TiffPage) -> dict:
+        return {
+            "shape": page.shape,
+            "dtype": page.dtype,
+            "photometric": page.photometric,
+            "planarconfig": page.planarconfig,
+            "extrasamples": page.extrasamples,
+            "compression": compression,
+            "predictor": predictor,
+            "tile": target_tile,
+        }
+
+    with tifffile.TiffFile(str(src)) as tif:
+        tif.filehandle.set_lock(True)
+        tag = tif.pages[0].tags.get("ImageDescription")
+        if tag is None or not tif.is_ome:
+            raise ValueError("File {} has no OME-XML tags!".format(str(src)))
+        pages = list(tif.pages)
+        description = tag.value.encode()
+        if bigtiff is None:
+            bigtiff = tif.is_bigtiff or tif.filehandle.size > BYTE_BOUNDARY
+        with tifffile.TiffWriter(str(dst), bigtiff=bigtiff) as out:
+            _write_pages(out, pages, _read_page, description, _encoding,
+                         max_inflight=maxworkers or 4, maxworkers=maxworkers)
+
+
+def _plane_ifds(pixels: OMEXML.Pixels) -> np.ndarray:
+    """Return the IFD of every plane as a (SizeZ, SizeC, SizeT) array"""
+    the_z, the_c, the_t = get_plane_indices(pixels.DimensionOrder, pixels.SizeZ, pixels.SizeC, pixels.SizeT)
+    ifds = np.empty((pixels.SizeZ, pixels.SizeC, pixels.SizeT), dtype=np.int64)
+    ifds[the_z, the_c, the_t] = np.arange(len(the_z))
+    return ifds
+
+
+def _plane_nodes(pixels: OMEXML.Pixels) -> dict:
+    """Map the (TheZ, TheC, TheT) of every Plane element to the element"""
+    return {(plane.get("TheZ"), plane.get("TheC"), plane.get("TheT")): plane
+            for plane in pixels.node.findall(get_qualified_name(pixels.namespaces["ome"], "Plane"))}
+
+
+def concat(paths: Iterable[Path], out: Path, axis: str = "T", bigtiff: bool = None) -> OMEXML:
+    """
+    Concatenate single-image OME-TIFF files along the Z, C or T axis, without decoding their pixel data.
+
+    Compressed strips or tiles are copied verbatim and interleaved in the IFD order of the merged image. The OME-XML
+    of the first file is kept, with the size along axis summed, TiffData entries regenerated and the Plane entries
+    of every file merged with their plane index shifted. When concatenating channels the Channel entries of every
+    file are merged as well. All files must share DimensionOrder, PixelType and the size of every other axis.
+
+    :param paths: paths to the OME-TIFF files to concatenate, in order
+    :param out: path to the OME-TIFF file to write
+    :param axis: one of "Z", "C" or "T"
+    :param bigtiff: if None, the output is BigTIFF if the inputs add up to more than 4GB
+    :return: the merged OMEXML
+    """
+    axis = axis.upper()
+    if axis not in ("Z", "C", "T"):
+        raise ValueError("Cannot concatenate along axis {}, only Z, C or T are supported".format(axis))
+    paths = list(paths)
+    if not paths:
+        raise ValueError("No files to concatenate")
+
+    with contextlib.ExitStack() as stack:
+        tifs = [stack.enter_context(tifffile.TiffFile(str(fpath))) for fpath in paths]
+        oxs = []
+        pixels_list = []
+        for fpath, tif in zip(paths, tifs):
+            if not tif.is_ome:
+                raise ValueError("File {} has no OME-XML tags!".format(str(fpath)))
+            oxs.append(OMEXML(tif.ome_metadata))
+            pixels = oxs[-1].image().Pixels
+            if len(tif.pages) != pixels.SizeZ * pixels.SizeC * pixels.SizeT:
+                raise ValueError("File {} does not hold all the planes of its image".format(str(fpath)))
+            pixels_list.append(pixels)
+            tif.filehandle.set_lock(True)
+
+        ref = pixels_list[0]
+        same = ["DimensionOrder", "PixelType", "SizeX", "SizeY"] + ["Size" + dim for dim in "ZCT" if dim != axis]
+        for fpath, pixels in zip(paths[1:], pixels_list[1:]):
+            for attr in same:
+                if getattr(pixels, attr) != getattr(ref, attr):
+                    raise ValueError("File {} has {} {}, expected {}".format(
+                        str(fpath), attr, getattr(pixels, attr), getattr(ref, attr)))
+
+        # locate every output plane in the input files
+        sizes = [getattr(pixels, "Size" + axis) for pixels in pixels_list]
+        offsets = np.cumsum([0] + sizes[:-1])
+        ifds = [_plane_ifds(pixels) for pixels in pixels_list]
+        planes = [_plane_nodes(pixels) for pixels in pixels_list]
+        explicit = ref.tiffdata_count > 1
+
+        pixels_node = ref.node
+        qn = get_qualified_name(ref.namespaces["ome"], "Plane")
+        for plane in pixels_node.findall(qn):
+            pixels_node.remove(plane)
+        if axis == "C":
+            channels = pixels_node.findall(get_qualified_name(ref.namespaces["ome"], "Channel"))
+            index = list(pixels_node).index(channels[-1]) + 1
+            pixels_node[index:index] = [copy.deepcopy(channel) for pixels in pixels_list[1:] for channel in
+                                    pixels.node.findall(get_qualified_name(pixels.namespaces["ome"], "Channel"))]
+            ref.namespaces.invalidate(pixels_node)
+            for idx in range(ref.channel_count):
+                ref.Channel(idx).set_ID("Channel:0:" + str(idx))
+        setattr(ref, "Size" + axis, int(sum(sizes)))
+
+        the_z, the_c, the_t = get_plane_indices(ref.DimensionOrder, ref.SizeZ, ref.SizeC, ref.SizeT)
+        the_axis = {"Z": the_z, "C": the_c, "T": the_t}[axis]
+        file_idxs = np.searchsorted(offsets, the_axis, side="right") - 1
+        local_axis = the_axis - offsets[file_idxs]
+
+        pages = []
+        plane_nodes = []
+        for z, c, t, file_idx, local in zip(the_z.tolist(), the_c.tolist(), the_t.tolist(),
+                                            file_idxs.tolist(), local_axis.tolist()):
+            zct = {"Z": z, "C": c, "T": t}
+            zct[axis] = local
+            pages.append(tifs[file_idx].pages[int(ifds[file_idx][zct["Z"], zct["C"], zct["T"]])])
+            plane = planes[file_idx].get((str(zct["Z"]), str(zct["C"]), str(zct["T"])))
+            if plane is not None:
+                plane = copy.deepcopy(plane)
+                plane.set("The" + axis, str(zct[axis] + offsets[file_idx]))
+                plane_nodes.append(plane)
+            elif any(planes):
+                plane_nodes.append(ElementTree.Element(qn, {"TheZ": str(z), "TheC": str(c), "TheT": str(t)}))
+        pixels_node.extend(plane_nodes)
+        ref.populate_TiffData(explicit=explicit)
+
+        ox = oxs[0]
+        if ox.UUID is not None:
+            ox.set_UUID("urn:uuid:" + str(uuid.uuid4()))
+
+        if bigtiff is None:
+            bigtiff = any(tif.is_bigtiff for tif in tifs) or sum(tif.filehandle.size for tif in tifs) > BYTE_BOUNDARY
+        with tifffile.TiffWriter(str(out), bigtiff=bigtiff) as writer:
+            _write_pages(writer, pages, _read_raw_segments, ox.to_bytes(), _page_encoding,
+                         max_inflight=4)
+    return ox
+
+
+def _select(selection: Union[int, slice, Iterable[int], None], size: int, axis: str) -> np.ndarray:
+    """Normalize a plane selection to an array of indices along an axis of the given size"""
+    indices = np.arange(size)
+    if selection is None:
+        return indices
+    if isinstance(selection, slice):
+        selected = indices[selection]
+    else:
+        selected = np.atleast_1d(np.asarray(selection, dtype=np.int64))
+        if np.any(selected >= size) or np.any(selected < -size):
+            raise IndexError("{} index out of range for Size{} {}".format(axis, axis, size))
+        selected = indices[selected]
+    if selected.size == 0:
+        raise ValueError("Empty {} selection".format(axis))
+    return selected
+
+
+# the reference elements of the OME schemas (ImageRef, ROIRef, AnnotationRef...), by the ID they point to
+REFERENCE_XPATH = ElementTree.XPath("//*[@ID and substring(local-name(), string-length(local-name()) - 2) = 'Ref']")
+
+
+def _update_references(ox: OMEXML, removed_ids: set, renamed_ids: dict) -> None:
+    """Remove the references to removed IDs and point those to renamed IDs to the new ones"""
+    for node in REFERENCE_XPATH(ox.root_node):
+        target = node.get("ID")
+        if target in removed_ids:
+            parent = node.getparent()
+            parent.remove(node)
+            ox.namespaces.invalidate(parent)
+        elif target in renamed_ids:
+            node.set("ID", renamed_ids[target])
+
+
+def _read_region(page: tifffile.TiffPage, region: tuple) -> np.ndarray:
+    """Decode the (x, y, width, height) region of a page, reading only the strips or tiles it intersects"""
+    x, y, width, height = region
+    fh = page.parent.filehandle
+    if page.imagedepth > 1 or (page.samplesperpixel > 1 and page.planarconfig == tifffile.PLANARCONFIG.SEPARATE):
+        return page.asarray(lock=fh.lock, maxworkers=1)[y:y + height, x:x + width]
+
+    chunk_length, chunk_width = page.chunks[:2]
+    rows = range(y // chunk_length, (y + height - 1) // chunk_length + 1)
+    cols = range(x // chunk_width, (x + width - 1) // chunk_width + 1)
+    indices = [row * page.chunked[1] + col for row in rows for col in cols]
+
+    out = np.zeros((height, width) + page.shape[2:], dtype=page.dtype)
+    segments = fh.read_segments([page.dataoffsets[i] for i in indices], [page.databytecounts[i] for i in indices],
+                                indices=indices, lock=fh.lock)
+    for data, index in segments:
+        segment, (_, _, seg_y, seg_x, _), _ = page.decode(data, index, jpegtables=page.jpegtables)
+        if segment is None:
+            continue
+        segment = segment[0] if page.samplesperpixel > 1 else segment[0, ..., 0]
+        y0, y1 = max(y, seg_y), min(y + height, seg_y + segment.shape[0])
+        x0, x1 = max(x, seg_x), min(x + width, seg_x + segment.shape[1])
+        out[y0 - y:y1 - y, x0 - x:x1 - x] = segment[y0 - seg_y:y1 - seg_y, x0 - seg_x:x1 - seg_x]
+    return out
+
+
+def extract(src: Path, dst: Path, z: Union[int, slice, Iterable[int], None] = None,
+            c: Union[int, slice, Iterable[int], None] = None, t: Union[int, slice, Iterable[int], None] = None,
+            region: tuple = None, imageseries: int = 0, bigtiff: bool = None) -> OMEXML:
+    """
+    Write a subset of the planes of an OME-TIFF image, optionally cropped, to a new OME-TIFF file.
+
+    Only the strips or tiles intersecting region are read and decoded, the output keeps the compression and
+    tiling of the input. Without region, the selected planes are copied without decoding them. The OME-XML is
+    adjusted accordingly: sizes, Channel and Plane entries are restricted to the selection, and Plane positions
+    are moved to the origin of the crop when their unit matches the physical pixel size unit.
+
+    :param src: path to the OME-TIFF file to read
+    :param dst: path to the OME-TIFF file to write
+    :param z: Z planes to keep, either an index, a slice or a sequence of indices, all planes if None
+    :param c: channels to keep, either an index, a slice or a sequence of indices, all channels if None
+    :param t: timepoints to keep, either an index, a slice or a sequence of indices, all timepoints if None
+    :param region: (x, y, width, height) of the crop in pixels, the whole plane if None
+    :param imageseries: index of the image to extract from
+    :param bigtiff: if None, the output is BigTIFF if the input is BigTIFF
+    :return: the OMEXML of the extracted image
+    """
+    with tifffile.TiffFile(str(src)) as tif:
+        if not tif.is_ome:
+            raise ValueError("File {} has no OME-XML tags!".format(str(src)))
+        tif.filehandle.set_lock(True)
+        ox = OMEXML(tif.ome_metadata)
+        pixels = ox.image(imageseries).Pixels
+        first_ifd = (pixels.Tiffdata(0).IFD or 0) if pixels.tiffdata_count else 0
+        ifds = _plane_ifds(pixels) + first_ifd
+
+        selected = {"Z": _select(z, pixels.SizeZ, "Z"), "C": _select(c, pixels.SizeC, "C"),
+                    "T": _select(t, pixels.SizeT, "T")}
+        if region is not None:
+            x, y, width, height = (int(value) for value in region)
+            if width <= 0 or height <= 0 or x < 0 or y < 0 or x + width > pixels.SizeX or y + height > pixels.SizeY:
+                raise ValueError("Region {} exceeds the {}x{} image".format(region, pixels.SizeX, pixels.SizeY))
+            region = (x, y, width, height)
+
+        # source planes in the IFD order of the extracted image
+        the_z, the_c, the_t = get_plane_indices(pixels.DimensionOrder, len(selected["Z"]), len(selected["C"]),
+                                                len(selected["T"]))
+        pages = [tif.pages[int(ifd)] for ifd in
+                 ifds[selected["Z"][the_z], selected["C"][the_c], selected["T"][the_t]]]
+
+        # adjust the OME-XML
+        pixels_node = pixels.node
+        channels = pixels_node.findall(get_qualified_name(pixels.namespaces["ome"], "Channel"))
+        removed_ids = {channel.get("ID") for channel in channels} - \
+            {channels[idx].get("ID") for idx in selected["C"]} if channels else set()
+        for channel in channels:
+            pixels_node.remove(channel)
+        # the channels come before the pixel data and the planes, the schema allows no Channel at all
+        index = next((idx for idx, child in enumerate(pixels_node) if isinstance(child.tag, str) and
+                      ElementTree.QName(child).localname in ("BinData", "TiffData", "MetadataOnly", "Plane")),
+                     len(pixels_node))
+        if channels:
+            pixels_node[index:index] = [channels[idx] for idx in selected["C"]]
+
+        planes = _plane_nodes(pixels)
+        for plane in planes.values():
+            pixels_node.remove(plane)
+        plane_nodes = []
+        for new_z, new_c, new_t in zip(the_z.tolist(), the_c.tolist(), the_t.tolist()):
+            zct = (str(selected["Z"][new_z]), str(selected["C"][new_c]), str(selected["T"][new_t]))
+            plane = planes.get(zct)
+            if plane is not None:
+                plane.set("TheZ", str(new_z))
+                plane.set("TheC", str(new_c))
+                plane.set("TheT", str(new_t))
+                plane_nodes.append(plane)
+        pixels_node.extend(plane_nodes)
+        pixels.namespaces.invalidate(pixels_node)
+
+        if region is not None:
+            for dim, offset in (("X", region[0]), ("Y", region[1])):
+                physical_size = getattr(pixels, "PhysicalSize" + dim)
+                unit = getattr(pixels, "PhysicalSize" + dim + "Unit") or "µm"
+                if physical_size is None or offset == 0:
+                    continue
+                for plane_node in plane_nodes:
+                    plane = OMEXML.Plane(plane_node, pixels.namespaces)
+                    position = getattr(plane, "Position" + dim)
+                    if position is not None and getattr(plane, "Position" + dim + "Unit") == unit:
+                        setattr(plane, "Position" + dim, position + offset * physical_size)
+            pixels.SizeX = region[2]
+            pixels.SizeY = region[3]
+
+        explicit = pixels.tiffdata_count > 1
+        pixels.SizeZ = len(selected["Z"])
+        pixels.SizeC = len(selected["C"])
+        pixels.SizeT = len(selected["T"])
+        # the extracted image is the first and only one of the new file
+        renamed_ids = {}
+        for idx in range(pixels.channel_count):
+            channel = pixels.Channel(idx)
+            renamed_ids[channel.ID] = "Channel:0:{}".format(idx)
+            channel.set_ID(renamed_ids[channel.ID])
+        pixels.populate_TiffData(explicit=explicit)
+        if ox.UUID is not None:
+            ox.set_UUID("urn:uuid:" + str(uuid.uuid4()))
+        # the other images have no pixel data in the new file, the references to them are dropped
+        image_node = ox.image(imageseries).node
+        for other_node in ox.root_node.findall(get_qualified_name(ox.namespaces["ome"], "Image")):
+            if other_node is not image_node:
+                removed_ids.update(node.get("ID") for node in other_node.iter(ElementTree.Element)
+                                   if node.get("ID") is not None)
+                ox.root_node.remove(other_node)
+        ox.namespaces.invalidate(ox.root_node)
+        _update_references(ox, removed_ids - {None}, renamed_ids)
+
+        if region is None:
+            read_page, encoding = _read_raw_segments, _page_encoding
+        else:
+            def read_page(page: tifffile.TiffPage) -> np.ndarray:
+                return _read_region(page, region)
+
+            def encoding(page: tifffile.TiffPage) -> dict:
+                kwargs = _page_encoding(page)
+                kwargs["shape"] = (region[3], region[2]) + page.shape[2:]
+                kwargs["rowsperstrip"] = None
+                if kwargs["compression"] == tifffile.COMPRESSION.JPEG:
+                    # the JPEG tables of the input are not reused when encoding
+                    kwargs["jpegtables"] = None
+                return kwargs
+
+        if bigtiff is None:
+            bigtiff = tif.is_bigtiff
+        with tifffile.TiffWriter(str(dst), bigtiff=bigtiff) as writer:
+            _write_pages(writer, pages, read_page, ox.to_bytes(), encoding, max_inflight=4)
+    return ox
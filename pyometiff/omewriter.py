@@ -14,13 +14,19 @@
 # if you didn't receive a copy, visit <http://www.gnu.org/licenses/>.
 
 # Copyright (c) 2021, Filippo Maria Castelli
+import collections
+import itertools
 import logging
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Union
-from lxml import etree as ET
+from typing import Iterable, Union
 import numpy as np
 import tifffile
-from pyometiff.omexml import OMEXML, get_pixel_type, xsd_now
+from pyometiff.omexml import OMEXML, get_pixel_type, get_plane_indices, xsd_now
 
 BYTE_BOUNDARY = 2 ** 32
 
@@ -36,6 +42,69 @@ class InvalidDimensionOrderingError(Exception):
         return self.message
 
 
+def _is_chunked(array) -> bool:
+    """True for chunked lazy arrays (dask, zarr, ...) that should not be materialized as a whole"""
+    return not isinstance(array, np.ndarray) and hasattr(array, "chunks") and hasattr(array, "__getitem__")
+
+
+def _iter_prefetched(func, items, max_inflight: int):
+    """Yield func(item) for each item in order, computing up to max_inflight results concurrently"""
+    with ThreadPoolExecutor(max_workers=max_inflight) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_inflight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class _ChunkedArrayView:
+    """Axis bookkeeping over a chunked lazy array
+
+    Stands in for np.expand_dims and np.moveaxis in OMETIFFWriter._adjust_dims, which would materialize the
+    whole array. Indexing the view with the leading indices of a plane computes only that plane.
+    """
+
+    def __init__(self, array, axes: tuple = None):
+        self.array = array
+        # source axis of every view axis, None for inserted length-1 axes
+        self.axes = tuple(range(len(array.shape))) if axes is None else tuple(axes)
+
+    @property
+    def shape(self) -> tuple:
+        return tuple(1 if axis is None else self.array.shape[axis] for axis in self.axes)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(self.array.dtype)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.axes)
+
+    def expand_dims(self) -> "_ChunkedArrayView":
+        return _ChunkedArrayView(self.array, (None,) + self.axes)
+
+    def moveaxis(self, source: list, destination: list) -> "_ChunkedArrayView":
+        source = [s % self.ndim for s in source]
+        destination = [d % self.ndim for d in destination]
+        order = [idx for idx in range(self.ndim) if idx not in source]
+        for dest, src in sorted(zip(destination, source)):
+            order.insert(dest, src)
+        return _ChunkedArrayView(self.array, [self.axes[idx] for idx in order])
+
+    def __getitem__(self, idx: tuple) -> np.ndarray:
+        """compute the YX plane at the given leading indices"""
+        key = [slice(None)] * len(self.array.shape)
+        for axis, i in zip(self.axes[:-2], idx):
+            if axis is not None:
+                key[axis] = i
+        plane = np.asarray(self.array[tuple(key)])
+        y_axis, x_axis = self.axes[-2:]
+        return plane.T if y_axis > x_axis else plane
+
+
 class OMETIFFWriter:
     def __init__(
             self,
@@ -49,6 +118,10 @@ class OMETIFFWriter:
             compression: str = None,
             arr_shape: Union[list, tuple] = None,
             bigtiff: bool = False,
+            max_file_size: int = None,
+            arr_dtype: Union[np.dtype, str] = None,
+            plane_metadata: Union[dict, np.ndarray] = None,
+            blocks_in_flight: int = 2,
     ):
         """
         OMETIFFWriter class for writing OME-TIFF files.
@@ -63,6 +136,14 @@ class OMETIFFWriter:
         :param compression: compression type, if None, no compression is used
         :param arr_shape: shape of the array, if None, it is inferred from the array
         :param bigtiff: if True, use bigtiff format. File sizes exceeding 4GB will automatically be written in bigtiff format
+        :param max_file_size: if set, planes are split across several files holding at most this many bytes of pixel
+            data each, linked into a single dataset through UUID TiffData entries. Files after the first one are named
+            after fpath with an increasing _<index> suffix.
+        :param arr_dtype: dtype of the array, if None, it is inferred from the array (uint16 when no array is given)
+        :param plane_metadata: per-plane acquisition metadata (DeltaT, ExposureTime, PositionX/Y/Z and their units),
+            as a dictionary of arrays or a structured array, see OMEXML.Pixels.populate_Planes
+        :param blocks_in_flight: for chunked lazy arrays (e.g. dask or zarr), number of planes computed concurrently
+            while writing. Such arrays are written plane by plane and never materialized as a whole.
         """
 
         self.fpath = Path(fpath)
@@ -75,19 +156,188 @@ class OMETIFFWriter:
         self.compression = compression
         self.arr_shape = arr_shape
         self.use_bigtiff = bigtiff
+        self.max_file_size = max_file_size
+        self.arr_dtype = arr_dtype
+        self.plane_metadata = plane_metadata
+        self.blocks_in_flight = blocks_in_flight
         self.init_file()
 
     def init_file(self):
-        self._array, self._dimension_order = self._adjust_dims(
+        self._array, self._dimension_order, self._arr_shape = self._adjust_dims(
             array=self.array,
             dimension_order=self.dimension_order,
             shape=self.arr_shape
         )
+        self._file_parts = self._split_file_parts()
         self._ox = self.gen_meta()
-        self._xml = self._ox.to_xml().encode()
+        self._xml = self._ox.to_bytes()
+
+    @property
+    def _dtype(self) -> np.dtype:
+        if self._array is not None:
+            return self._array.dtype
+        return np.dtype(self.arr_dtype if self.arr_dtype is not None else "uint16")
+
+    @classmethod
+    def create_empty(
+            cls,
+            fpath: Path,
+            shape: Union[list, tuple],
+            dtype: Union[np.dtype, str],
+            metadata: dict,
+            dimension_order: str = "STZCYX",
+            photometric: str = "minisblack",
+            bigtiff: bool = False,
+    ) -> np.memmap:
+        """
+        Create an uncompressed, contiguous OME-TIFF and memory-map its pixel data for writing.
+
+        The OME-XML and IFD structure are written right away, the returned array can then be filled in place.
+        Other processes can map the same pixel region with tifffile.memmap(fpath) and fill disjoint slabs
+        concurrently.
+
+        :param fpath: path to the file to be created
+        :param shape: shape of the array
+        :param dtype: dtype of the array
+        :param metadata: dictionary containing the metadata to be written
+        :param dimension_order: dimension ordering of shape
+        :param photometric: photometric interpretation of the array, "minisblack" or "miniswhite"
+        :param bigtiff: if True, use bigtiff format. File sizes exceeding 4GB will automatically be written in bigtiff format
+        :return: writable memory map over the pixel data, with shape expanded to 5 dimensions
+        """
+        writer = cls(
+            fpath=fpath,
+            array=None,
+            metadata=metadata,
+            dimension_order=dimension_order,
+            photometric=photometric,
+            arr_shape=list(shape),
+            arr_dtype=dtype,
+            bigtiff=bigtiff,
+        )
+        return tifffile.memmap(
+            str(writer.fpath),
+            shape=tuple(writer._arr_shape),
+            dtype=writer._dtype,
+            bigtiff=writer.use_bigtiff or writer._should_use_bigtiff(writer._arr_shape, writer._dtype),
+            description=writer._xml,
+            photometric=writer.photometric,
+            metadata=None,
+        )
 
     def write(self):
-        self.write_stack(self._array, self._xml)
+        if self._array is None:
+            raise ValueError("no array to write: writers created with array=None write through write_planes")
+        if isinstance(self._array, _ChunkedArrayView) or not self._array.flags.c_contiguous:
+            # lazy arrays and strided views (e.g. from non-YX-last orders) are written plane by plane,
+            # never as a full copy
+            self.write_planes(self._iter_array_planes())
+        elif self._file_parts is None:
+            self.write_stack(self._array, self._xml)
+        else:
+            self.write_multifile()
+
+    def _iter_array_planes(self):
+        indices = np.ndindex(*self._array.shape[:-2])
+        if isinstance(self._array, _ChunkedArrayView):
+            yield from _iter_prefetched(self._array.__getitem__, indices, self.blocks_in_flight)
+        else:
+            for idx in indices:
+                yield self._array[idx]
+
+    @property
+    def written_files(self) -> list:
+        """paths of the files making up the dataset"""
+        if self._file_parts is None:
+            return [self.fpath]
+        return [part["fpath"] for part in self._file_parts]
+
+    def _part_fpath(self, index: int) -> Path:
+        if index == 0:
+            return self.fpath
+        name = self.fpath.name
+        for suffix in (".ome.tiff", ".ome.tif"):
+            if name.lower().endswith(suffix):
+                stem, suffix = name[:-len(suffix)], name[-len(suffix):]
+                break
+        else:
+            stem, suffix = self.fpath.stem, self.fpath.suffix
+        return self.fpath.with_name("{}_{}{}".format(stem, index, suffix))
+
+    def _split_file_parts(self):
+        if self.max_file_size is None:
+            return None
+
+        shape = self._array.shape if self._array is not None else self._arr_shape
+        plane_bytes = shape[-1] * shape[-2] * self._dtype.itemsize
+        plane_count = int(np.prod(shape[:-2]))
+        planes_per_file = max(1, self.max_file_size // plane_bytes)
+        if plane_bytes > self.max_file_size:
+            logging.warning("a single plane is larger than max_file_size, writing one plane per file")
+
+        parts = []
+        for index, first_plane in enumerate(range(0, plane_count, planes_per_file)):
+            parts.append({
+                "fpath": self._part_fpath(index),
+                "uuid": "urn:uuid:" + str(uuid.uuid4()),
+                "first_plane": first_plane,
+                "plane_count": min(planes_per_file, plane_count - first_plane),
+            })
+        return parts
+
+    def _populate_multifile_TiffData(self, pixels):
+        first_z, first_c, first_t = get_plane_indices(
+            pixels.DimensionOrder, pixels.SizeZ, pixels.SizeC, pixels.SizeT)
+        pixels.set_tiffdata_count(len(self._file_parts))
+        for idx, part in enumerate(self._file_parts):
+            tiffdata = pixels.Tiffdata(idx)
+            first_plane = part["first_plane"]
+            tiffdata.set_FirstZ(first_z[first_plane])
+            tiffdata.set_FirstC(first_c[first_plane])
+            tiffdata.set_FirstT(first_t[first_plane])
+            tiffdata.set_IFD(0)
+            tiffdata.set_PlaneCount(part["plane_count"])
+            tiffdata.set_UUID(part["uuid"])
+            tiffdata.set_FileName(part["fpath"].name)
+
+    def _part_xml(self, part: dict) -> bytes:
+        # every file carries the full OME-XML, tagged with its own UUID
+        self._ox.set_UUID(part["uuid"])
+        return self._ox.to_bytes()
+
+    def write_multifile(self):
+        planes = self._array.reshape(-1, *self._array.shape[-2:])
+        for part in self._file_parts:
+            first_plane = part["first_plane"]
+            part_planes = planes[first_plane:first_plane + part["plane_count"]]
+            self.write_stack(part_planes, self._part_xml(part), fpath=part["fpath"])
+
+    def _iter_checked_planes(self, planes: Iterable[np.ndarray], plane_shape: tuple):
+        for plane in planes:
+            plane = np.ascontiguousarray(plane, dtype=self._dtype)
+            if plane.shape != plane_shape:
+                raise ValueError("expected a plane of shape {}, got {}".format(plane_shape, plane.shape))
+            yield plane
+
+    def write_planes(self, planes: Iterable[np.ndarray]):
+        """
+        Write the image from an iterable of 2D planes instead of an in-memory array.
+
+        The writer must have been created with array=None, arr_shape and arr_dtype. Planes are consumed one at a
+        time, in the order of the leading dimensions of the (5D expanded) shape, so the whole image never needs to
+        be in memory.
+
+        :param planes: iterable yielding YX planes
+        """
+        shape = tuple(self._array.shape if self._array is not None else self._arr_shape)
+        planes = self._iter_checked_planes(planes, shape[-2:])
+        if self._file_parts is None:
+            self.write_stack(planes, self._xml, shape=shape)
+        else:
+            for part in self._file_parts:
+                part_planes = itertools.islice(planes, part["plane_count"])
+                part_shape = (part["plane_count"], *shape[-2:])
+                self.write_stack(part_planes, self._part_xml(part), fpath=part["fpath"], shape=part_shape)
 
     def write_xml(self, xml_fpath: Path = None):
         if xml_fpath is None:
@@ -97,32 +347,31 @@ class OMETIFFWriter:
         if xml_fpath.exists():
                 xml_fpath.unlink()
 
-        tree = ET.ElementTree(ET.fromstring(self._xml))
-        tree.write(str(xml_fpath),
-                   encoding="utf-8",
-                   method="xml",
-                   pretty_print=True,
-                   xml_declaration=True)
+        self._ox.write_to(str(xml_fpath), pretty=True)
 
     @staticmethod
-    def _should_use_bigtiff(array):
-        if array is None:
+    def _should_use_bigtiff(shape, dtype):
+        if shape is None:
             return False
         else:
-            file_size = array.size * array.itemsize
+            file_size = int(np.prod(shape)) * np.dtype(dtype).itemsize
             return file_size > BYTE_BOUNDARY
 
-    def write_stack(self, array, xml_meta):
-        should_use_bigtiff = self._should_use_bigtiff(array)
+    def write_stack(self, array, xml_meta, fpath: Path = None, shape=None):
+        fpath = self.fpath if fpath is None else fpath
+        if shape is None and array is not None:
+            shape = array.shape
+        should_use_bigtiff = self._should_use_bigtiff(shape, self._dtype)
 
         use_bigtiff = self.use_bigtiff or should_use_bigtiff
 
         if should_use_bigtiff and (self.use_bigtiff is False):
             logging.warning("array size is larger than 4GB, using BigTIFF")
 
-        with tifffile.TiffWriter(str(self.fpath), bigtiff=use_bigtiff) as tif:
+        with tifffile.TiffWriter(str(fpath), bigtiff=use_bigtiff) as tif:
             tif.write(
-                array, description=xml_meta, photometric=self.photometric, metadata=None, compression=self.compression
+                array, shape=shape, dtype=self._dtype, description=xml_meta, photometric=self.photometric,
+                metadata=None, compression=self.compression
             )
 
     def gen_meta(self):
@@ -161,7 +410,7 @@ class OMETIFFWriter:
         if self._array is not None:
             shape = self._array.shape
         else:
-            shape = self.arr_shape
+            shape = self._arr_shape
 
         def _dim_or_1(dim):
             idx = self._dimension_order.find(dim)
@@ -187,11 +436,7 @@ class OMETIFFWriter:
         pixels.set_DimensionOrder(self._dimension_order[::-1])
 
         # convert numpy dtype to a compatibile pixeltype
-        if self._array is not None:
-            dtype = self._array.dtype
-        else:
-            dtype = np.dtype("uint16")
-        pixels.set_PixelType(get_pixel_type(dtype))
+        pixels.set_PixelType(get_pixel_type(self._dtype))
 
         if pop_expected_keys["Channels"] is not None:
             channels_dict = pop_expected_keys["Channels"]
@@ -204,7 +449,13 @@ class OMETIFFWriter:
                 pixels.Channel(i).set_ID("Channel:0:" + str(i))
                 pixels.Channel(i).set_Name("C:" + str(i))
 
-        pixels.populate_TiffData(explicit=self.explicit_tiffdata)
+        if self._file_parts is None:
+            pixels.populate_TiffData(explicit=self.explicit_tiffdata)
+        else:
+            self._populate_multifile_TiffData(pixels)
+
+        if self.plane_metadata is not None:
+            pixels.populate_Planes(self.plane_metadata)
 
         return ox
 
@@ -231,10 +482,14 @@ class OMETIFFWriter:
 
     @staticmethod
     def _adjust_dims(array=None, dimension_order="ZYX", shape=None):
+        if _is_chunked(array):
+            array = _ChunkedArrayView(array)
         if array is not None:
             array_shape = array.shape
+            shape = None
         else:
-            array_shape = shape
+            # the caller's shape is left untouched, the adjusted shape is returned
+            array_shape = shape = list(shape)
         ndims = len(array_shape)
 
         assert ndims in (3, 4, 5), "Expected a 3, 4, or 5-dimensional array"
@@ -245,14 +500,6 @@ class OMETIFFWriter:
                 "Invalid dimension_order {}".format(dimension_order)
             )
 
-        # ends in YX
-        if dimension_order[-2:] != "YX":
-            raise InvalidDimensionOrderingError(
-                "the last two dimensions are expected to be YX, they are {} instead. Please transpose your data".format(
-                    dimension_order[-2:]
-                )
-            )
-
         # starts in S
         if dimension_order.find("S") > 0:
             raise InvalidDimensionOrderingError(
@@ -282,10 +529,30 @@ class OMETIFFWriter:
         if len(dimension_order) > ndims:
             dimension_order = dimension_order[-ndims:]
 
+        # has both spatial dims
+        if "Y" not in dimension_order or "X" not in dimension_order:
+            raise InvalidDimensionOrderingError(
+                "dimension_order {} must contain both Y and X".format(dimension_order)
+            )
+
+        # move YX last, e.g. ZYXC becomes ZCYX: the array becomes a strided view, no data is copied
+        if dimension_order[-2:] != "YX":
+            src_axes = [dimension_order.find("Y"), dimension_order.find("X")]
+            if isinstance(array, _ChunkedArrayView):
+                array = array.moveaxis(src_axes, [-2, -1])
+            elif array is not None:
+                array = np.moveaxis(array, src_axes, [-2, -1])
+            else:
+                shape[:] = [size for idx, size in enumerate(shape) if idx not in src_axes] + \
+                           [shape[idx] for idx in src_axes]
+            dimension_order = "".join(d for d in dimension_order if d not in "YX") + "YX"
+
         # expand 3D data to 5D
         if ndims == 3:
             # expand double
-            if array is not None:
+            if isinstance(array, _ChunkedArrayView):
+                array = array.expand_dims().expand_dims()
+            elif array is not None:
                 array = np.expand_dims(array, axis=0)
                 array = np.expand_dims(array, axis=0)
             else:
@@ -302,7 +569,9 @@ class OMETIFFWriter:
 
         # if it's 4D expand to 5D
         elif ndims == 4:
-            if array is not None:
+            if isinstance(array, _ChunkedArrayView):
+                array = array.expand_dims()
+            elif array is not None:
                 array = np.expand_dims(array, axis=0)
             else:
                 shape.insert(0, 1)
@@ -315,4 +584,114 @@ class OMETIFFWriter:
             elif first2 == "CZ" or first2 == "ZC":
                 dimension_order = "T" + dimension_order
 
-        return array, dimension_order
+        return array, dimension_order, shape
+
+
+class AsyncOMETIFFWriter:
+    _STOP = object()
+
+    def __init__(self, writer: OMETIFFWriter, max_queue_size: int = 16):
+        """
+        AsyncOMETIFFWriter class for writing OME-TIFF files from a background thread.
+
+        Planes passed to submit_plane() go through a bounded queue to a thread that compresses and writes them in
+        order through OMETIFFWriter.write_planes. When the queue is full submit_plane() blocks until the writer
+        catches up. Errors raised while writing are re-raised by close() (and by any later submit_plane()).
+
+        :param writer: an OMETIFFWriter created with array=None, arr_shape and arr_dtype
+        :param max_queue_size: maximum number of planes waiting to be written
+        """
+        self.writer = writer
+        self.max_queue_size = max_queue_size
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._error = None
+        self._closed = False
+        self._submitted = 0
+        self._written = 0
+        self._max_queue_depth = 0
+        self._total_latency = 0.
+        self._max_latency = 0.
+        self._in_flight = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="AsyncOMETIFFWriter", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # don't mask the original exception with the incomplete write
+            try:
+                self.close()
+            except Exception:
+                pass
+
+    def submit_plane(self, plane: np.ndarray, timeout: float = None):
+        """
+        Queue a YX plane for writing, blocking while the queue is full.
+
+        :param plane: the next plane, in the order expected by OMETIFFWriter.write_planes
+        :param timeout: maximum time to wait for a free queue slot, queue.Full is raised when it expires
+        """
+        if self._error is not None:
+            raise self._error
+        if self._closed:
+            raise RuntimeError("AsyncOMETIFFWriter is closed")
+        self._queue.put((plane, time.perf_counter()), timeout=timeout)
+        self._submitted += 1
+        self._max_queue_depth = max(self._max_queue_depth, self._queue.qsize())
+
+    def close(self):
+        """Wait for all queued planes to be written and re-raise any writing error."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(self._STOP)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    @property
+    def statistics(self) -> dict:
+        """queue depth and submit-to-write latency statistics, latencies in seconds"""
+        return {
+            "submitted": self._submitted,
+            "written": self._written,
+            "queue_depth": self._queue.qsize(),
+            "max_queue_depth": self._max_queue_depth,
+            "mean_latency": self._total_latency / self._written if self._written else None,
+            "max_latency": self._max_latency,
+        }
+
+    def _mark_written(self):
+        if self._in_flight is not None:
+            latency = time.perf_counter() - self._in_flight
+            self._in_flight = None
+            self._written += 1
+            self._total_latency += latency
+            self._max_latency = max(self._max_latency, latency)
+
+    def _iter_queue(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                self._stopped = True
+                return
+            plane, self._in_flight = item
+            yield plane
+            # the writer only asks for the next plane once the previous one is written
+            self._mark_written()
+
+    def _run(self):
+        try:
+            self.writer.write_planes(self._iter_queue())
+            self._mark_written()
+            if not self._stopped and self._queue.get() is not self._STOP:
+                raise ValueError("more planes were submitted than the image holds")
+        except Exception as e:
+            self._error = e
+            # keep draining so that producers blocked on a full queue are released
+            while not self._stopped:
+                self._stopped = self._queue.get() is self._STOP
@@ -23,17 +23,26 @@
 """
 from __future__ import annotations # needed for python < 3.10
 
+import copy
 import datetime
+import functools
+import gc
 import logging
 from functools import reduce
+from io import BytesIO
+from itertools import islice
+import os
 import re
+import time
+from typing import Iterator, NamedTuple
 import uuid
-from xml.etree import cElementTree as ElementTree
+from xml.sax.saxutils import escape, quoteattr
 
-from io import StringIO
+from lxml import etree as ElementTree
 import numpy as np
 
 uenc = 'unicode'
+XML_DECLARATION = "<?xml version='1.0' encoding='utf-8'?>\n"
 
 logger = logging.getLogger(__file__)
 
@@ -50,6 +59,8 @@ NS_BINARY_FILE = "http://www.openmicroscopy.org/Schemas/BinaryFile/2013-06"
 NS_ORIGINAL_METADATA = "openmicroscopy.org/OriginalMetadata"
 NS_DEFAULT = "http://www.openmicroscopy.org/Schemas/{ns_key}/2013-06"
 NS_RE = r"http://www.openmicroscopy.org/Schemas/(?P<ns_key>.*)/[0-9/-]"
+# prefix of the namespace of new OriginalMetadata elements
+ElementTree.register_namespace("om", NS_ORIGINAL_METADATA)
 
 default_xml = f"""<?xml version="1.0" encoding="UTF-8"?>
 <!-- Warning: this comment is an OME-XML metadata block, which contains
@@ -125,6 +136,26 @@ DO_XYCZT = "XYCZT"
 DO_XYTCZ = "XYTCZ"
 DO_XYTZC = "XYTZC"
 #
+# Plane attributes that can be set per plane from arrays
+#
+PLANE_COLUMNS = (
+    "DeltaT", "DeltaTUnit",
+    "ExposureTime", "ExposureTimeUnit",
+    "PositionX", "PositionXUnit",
+    "PositionY", "PositionYUnit",
+    "PositionZ", "PositionZUnit",
+)
+PLANE_INDEX_COLUMNS = ("TheZ", "TheC", "TheT")
+#
+# The columns of OMEXML.add_rectangles and OMEXML.rectangles_table, the
+# plane indices are optional
+#
+RECTANGLE_COLUMNS = ("X", "Y", "Width", "Height", "TheZ", "TheC", "TheT")
+#
+# The number in the ROI:<n> and Shape:<n>:<m> IDs add_rectangles generates
+#
+ROI_NUMBER_RE = re.compile(r"^(?:ROI|Shape):(\d+)")
+#
 # Original metadata corresponding to TIFF tags
 # The text for these can be found in
 # loci.formats.in.BaseTiffReader.initStandardMetadata
@@ -241,6 +272,20 @@ NC_LETTER = "letter"
 NC_NUMBER = "number"
 
 
+def get_well_label(index: int, convention: str) -> str:
+    """Format a row or column index with a naming convention, 26 is "27" or "AA" for instance"""
+    if convention == NC_NUMBER:
+        return "%02d" % (index + 1)
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    # bijective base 26: Z is followed by AA, ZZ by AAA
+    label = ""
+    number = index + 1
+    while number > 0:
+        number, digit = divmod(number - 1, len(letters))
+        label = letters[digit] + label
+    return label
+
+
 def page_name_original_metadata(index: int) -> str:
     """Get the key name for the page name metadata data for the indexed tiff page
 
@@ -276,17 +321,447 @@ def split_qn(_qualified_name: str) -> (str, str) | None:
 
 
 def get_namespaces(node: ElementTree.Element) -> dict[str, str]:
-    """Get top-level XML namespaces from a node."""
+    """Get top-level XML namespaces from a node.
+
+    These are the namespace of the node and the namespaces in scope at the
+    node, plus the ones declared anywhere in the document for the root node.
+    """
+    namespaces = [ElementTree.QName(node).namespace] + list(node.nsmap.values())
+    if node.getparent() is None:
+        namespaces += [ns for _, (_, ns) in ElementTree.iterwalk(node, events=("start-ns",))]
+    return match_namespaces(namespaces)
+
+
+def match_namespaces(namespaces: list[str | None]) -> dict[str, str]:
+    """Map the OME namespace keys to the matching namespace URIs"""
     ns_lib = {'ome': None, 'sa': None, 'spw': None}
-    for child in node.iter():
-        ns = split_qn(child.tag)[0]
-        match = re.match(NS_RE, ns)
+    for ns in namespaces:
+        match = re.match(NS_RE, ns or "")
         if match:
             ns_key = match.group('ns_key').lower()
             ns_lib[ns_key] = ns
+    # since the 2016-06 schema, annotations and plates are in the OME namespace
+    for ns_key in ('sa', 'spw'):
+        if ns_lib[ns_key] is None:
+            ns_lib[ns_key] = ns_lib['ome']
     return ns_lib
 
 
+def get_end_children(node: ElementTree.Element) -> tuple[ElementTree.Element, ElementTree.Element] | None:
+    """Return the first and the last child of a node, None if it has no children"""
+    try:
+        return node[0], node[-1]
+    except IndexError:
+        return None
+
+
+class NamespaceContext(dict):
+    """The namespaces of a document, resolved once and shared by the wrappers of its nodes
+
+    This is the dictionary returned by get_namespaces, which also caches the
+    qualified tag names built from it, and the indexes of the children of
+    the nodes. The wrappers drop the indexes of the nodes they edit, code
+    editing the nodes with lxml directly must call invalidate.
+    """
+
+    def __init__(self, namespaces: dict[str, str]) -> None:
+        super().__init__(namespaces)
+        self.qualified_names = {}
+        self.child_indexes = {}
+        self.annotation_indexes = {}
+        self.plate_indexes = {}
+
+    @classmethod
+    def resolve(cls, node: ElementTree.Element, namespaces: dict[str, str] | None = None) -> "NamespaceContext":
+        """Return the shared context if given, otherwise resolve the namespaces from the node"""
+        if isinstance(namespaces, NamespaceContext):
+            return namespaces
+        return cls(get_namespaces(node) if namespaces is None else namespaces)
+
+    def qn(self, ns_key: str, tag_name: str) -> str:
+        """Return the qualified name of a tag in the namespace with the given key"""
+        try:
+            return self.qualified_names[ns_key, tag_name]
+        except KeyError:
+            qualified_name = self.qualified_names[ns_key, tag_name] = get_qualified_name(self[ns_key], tag_name)
+            return qualified_name
+
+    def children(self, node: ElementTree.Element, ns_key: str, tag_name: str) -> list[ElementTree.Element]:
+        """Return the children of a node with the given tag, from an index built on first use
+
+        The index is rebuilt when the number of children of the node changed
+        since, the wrappers editing a node also drop its index with
+        invalidate.
+        """
+        key = (node, ns_key, tag_name)
+        length = len(node)
+        entry = self.child_indexes.get(key)
+        if entry is None or entry[0] != length:
+            entry = self.child_indexes[key] = (length, get_end_children(node),
+                                               find_children(node, self.qn(ns_key, tag_name)))
+        return entry[2]
+
+    def child(self, node: ElementTree.Element, ns_key: str, tag_name: str, index: int) -> ElementTree.Element:
+        """Return the indexed child of a node with the given tag, in constant time
+
+        Counting the children takes linear time, so instead of the length of
+        the node the index only checks its first and last child and that the
+        child returned is still attached. This catches children appended,
+        prepended or removed with lxml, but not children inserted in the
+        middle: after such edits call invalidate on the node.
+        """
+        entry = self.child_indexes.get((node, ns_key, tag_name))
+        if entry is None:
+            return self.children(node, ns_key, tag_name)[index]
+        if entry[1] != get_end_children(node):
+            # children were added without invalidating the index
+            self.invalidate(node)
+            return self.children(node, ns_key, tag_name)[index]
+        try:
+            child = entry[2][index]
+        except IndexError:
+            child = None
+        if child is None or child.getparent() is not node:
+            # the node was edited without invalidating its index
+            self.invalidate(node)
+            child = self.children(node, ns_key, tag_name)[index]
+        return child
+
+    def invalidate(self, node: ElementTree.Element) -> None:
+        """Drop the child indexes of a node"""
+        for key in [key for key in self.child_indexes if key[0] is node]:
+            del self.child_indexes[key]
+        self.annotation_indexes.pop(node, None)
+        self.plate_indexes.pop(node, None)
+
+
+# the top-level elements that come after Plate in the OME schema
+PLATE_FOLLOWING_ELEMENTS = ("Screen", "Experimenter", "ExperimenterGroup", "Instrument", "Image",
+                            "StructuredAnnotations", "ROI", "BinaryOnly")
+LAZY_SECTIONS = ("Image", "Instrument", "Plate", "ROI", "StructuredAnnotations")
+LAZY_PLACEHOLDER = "pyometiff lazy section"
+# CDATA sections, comments and processing instructions, which may contain anything looking like a tag
+LAZY_SKIP_PATTERN = rb"(<!\[CDATA\[.*?\]\]>|<!--.*?-->|<\?.*?\?>)"
+# start tag of a top-level section, attribute values may contain ">"
+LAZY_SECTION_RE = re.compile(
+    LAZY_SKIP_PATTERN + rb"|<(?:([\w.-]+):)?(%s)((?:\s+[^\s=/>]+\s*=\s*(?:\"[^\"]*\"|'[^']*'))*\s*)(/?)>"
+    % "|".join(LAZY_SECTIONS).encode(), re.DOTALL)
+LAZY_SKIP_RE = re.compile(LAZY_SKIP_PATTERN, re.DOTALL)
+LAZY_SKIP_OPENERS = (b"<![CDATA[", b"<!--", b"<?")
+LAZY_XMLNS_RE = re.compile(rb"xmlns(?::[\w.-]+)?\s*=\s*[\"']([^\"']*)[\"']")
+
+
+class LazySections(object):
+    """The top-level sections of an OME-XML document, parsed on first access
+
+    The document is scanned once for the byte ranges of its Image,
+    Instrument, Plate, ROI and StructuredAnnotations elements, which none of
+    the OME schemas nest into each other. CDATA sections, comments and
+    processing instructions are skipped by the scan. Everything else (the
+    skeleton) is parsed right away, with a placeholder comment standing for
+    each section.
+    """
+
+    def __init__(self, xml: bytes, parser: ElementTree.XMLParser) -> None:
+        self.xml = xml
+        self.ranges = []
+        # the namespaces declared by the section elements themselves, as older schemas do
+        self.declared_namespaces = []
+        skeleton = []
+        position = 0
+        scan = 0
+        while True:
+            match = LAZY_SECTION_RE.search(xml, scan)
+            if match is None:
+                break
+            skipped, prefix, tag_name, _, empty = match.groups()
+            if skipped is not None:
+                scan = match.end()
+                continue
+            if empty:
+                end = match.end()
+            else:
+                qname = re.escape(prefix + b":" + tag_name if prefix else tag_name)
+                close = self.find_close_tag(xml, re.compile(rb"</" + qname + rb"\s*>"), match.end())
+                if close is None:
+                    raise ValueError("Unterminated %s element" % tag_name.decode())
+                end = close.end()
+            skeleton += [xml[position:match.start()], b"<!--" + LAZY_PLACEHOLDER.encode() + b"-->"]
+            self.ranges.append((tag_name.decode(), match.start(), end))
+            self.declared_namespaces += [ns.decode() for ns in LAZY_XMLNS_RE.findall(match.group(3))]
+            position = scan = end
+        skeleton.append(xml[position:])
+        self.root = ElementTree.fromstring(b"".join(skeleton), parser)
+
+        # the sections in document order, placeholders until they are parsed
+        placeholders = [node for node in self.root.iterchildren(ElementTree.Comment)
+                        if node.text == LAZY_PLACEHOLDER]
+        if len(placeholders) != len(self.ranges):
+            raise ValueError("Sections could not be told apart from comments")
+        self.nodes = placeholders
+        self.sections = {tag_name: [] for tag_name in LAZY_SECTIONS}
+        for position, (tag_name, _, _) in enumerate(self.ranges):
+            self.sections[tag_name].append(position)
+        self.pending = len(self.ranges)
+
+    @staticmethod
+    def find_close_tag(xml: bytes, close_re: re.Pattern, position: int) -> re.Match | None:
+        """Return the first match of a close tag after a position, outside of CDATA, comments and PIs
+
+        The close tag is searched first and the markup to skip only looked
+        for before it, sections rarely hold any.
+        """
+        while True:
+            close = close_re.search(xml, position)
+            if close is None:
+                return None
+            openers = [xml.find(opener, position, close.start()) for opener in LAZY_SKIP_OPENERS]
+            openers = [opener for opener in openers if opener >= 0]
+            if not openers:
+                return close
+            skipped = LAZY_SKIP_RE.match(xml, min(openers))
+            if skipped is None:
+                return None
+            position = skipped.end()
+
+    def count(self, tag_name: str) -> int:
+        """Return the number of sections with a tag, without parsing them"""
+        return len(self.sections[tag_name])
+
+    def get(self, tag_name: str, index: int) -> ElementTree.Element:
+        """Return the indexed section with a tag, parsing it if needed"""
+        return self.parse(self.sections[tag_name][index])
+
+    def get_all(self, tag_name: str) -> list[ElementTree.Element]:
+        """Return every section with a tag, parsing them if needed"""
+        self.parse_runs(self.sections[tag_name])
+        return [self.nodes[position] for position in self.sections[tag_name]]
+
+    def parse(self, position: int) -> ElementTree.Element:
+        self.parse_runs([position])
+        return self.nodes[position]
+
+    def parse_runs(self, positions: list[int]) -> None:
+        """Parse the pending sections at some positions
+
+        Sections next to each other in the document, with only whitespace in
+        between, are parsed together: documents with 10^5 ROIs would
+        otherwise be parsed one ROI at a time.
+        """
+        run = []
+        for position in positions:
+            if self.nodes[position].tag is not ElementTree.Comment:
+                continue
+            if run and (position != run[-1] + 1 or
+                        self.xml[self.ranges[run[-1]][2]:self.ranges[position][1]].strip()):
+                self._parse_run(run)
+                run = []
+            run.append(position)
+        if run:
+            self._parse_run(run)
+
+    def _parse_run(self, run: list[int]) -> None:
+        start, end = self.ranges[run[0]][1], self.ranges[run[-1]][2]
+        # the sections are parsed under the namespace declarations of the root
+        declarations = "".join(' xmlns%s=%s' % (":" + prefix if prefix else "", quoteattr(uri))
+                               for prefix, uri in self.root.nsmap.items())
+        wrapper = ElementTree.fromstring(
+            b"<wrapper%s>" % declarations.encode() + self.xml[start:end] + b"</wrapper>",
+            ElementTree.XMLParser(huge_tree=True))
+        elements = [element for element in wrapper if isinstance(element.tag, str)]
+        if [ElementTree.QName(element).localname for element in elements] != \
+                [self.ranges[position][0] for position in run]:
+            raise ValueError("The OME-XML sections were not told apart correctly")
+        for position, element in zip(run, elements):
+            node = self.nodes[position]
+            element.tail = node.tail
+            self.root.replace(node, element)
+            self.nodes[position] = element
+        self.pending -= len(run)
+        if not self.pending:
+            # nothing left to parse, release the document
+            self.xml = None
+
+    def parse_all(self) -> None:
+        self.parse_runs(range(len(self.nodes)))
+
+    def append(self, tag_name: str, element: ElementTree.Element) -> None:
+        """Register a section added to the root after the last one"""
+        self.sections[tag_name].append(len(self.nodes))
+        self.ranges.append((tag_name, None, None))
+        self.nodes.append(element)
+
+
+@functools.lru_cache(maxsize=None)
+def get_child_xpaths(qualified_name: str) -> tuple[ElementTree.XPath, ElementTree.XPath]:
+    """Return compiled XPath expressions selecting and counting the children with a qualified name
+
+    The expressions are compiled once per qualified name and shared by every
+    document.
+    """
+    namespace, tag_name = split_qn(qualified_name)
+    namespaces = {"ns": namespace}
+    return (ElementTree.XPath("ns:%s" % tag_name, namespaces=namespaces),
+            ElementTree.XPath("count(ns:%s)" % tag_name, namespaces=namespaces))
+
+
+# the OME 2016-06 schema bundled with the package, documents are validated without network access
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schemas")
+OME_SCHEMA_PATH = os.path.join(SCHEMA_DIR, "ome-2016-06.xsd")
+# the remote schemas imported by the OME schemas, mapped to their bundled copies
+BUNDLED_SCHEMAS = {"http://www.w3.org/2001/xml.xsd": os.path.join(SCHEMA_DIR, "xml.xsd")}
+
+
+class BundledSchemaResolver(ElementTree.Resolver):
+    """Resolve the remote schemas imported by the OME schemas to their bundled copies"""
+
+    def resolve(self, system_url, public_id, context):
+        if system_url in BUNDLED_SCHEMAS:
+            return self.resolve_filename(BUNDLED_SCHEMAS[system_url], context)
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def get_schema(schema_path: str = OME_SCHEMA_PATH) -> ElementTree.XMLSchema:
+    """Return the compiled XML schema at a path, compiled once per process
+
+    Imported and included schemas are resolved relative to the schema file,
+    or to the copies bundled in pyometiff/schemas for the W3C ones. The
+    network is never accessed.
+    """
+    if not os.path.exists(schema_path):
+        raise FileNotFoundError("XML schema not found at %s" % schema_path)
+    parser = ElementTree.XMLParser(no_network=True, huge_tree=True)
+    parser.resolvers.add(BundledSchemaResolver())
+    return ElementTree.XMLSchema(ElementTree.parse(schema_path, parser))
+
+
+class ValidationResult(NamedTuple):
+    """The outcome of OMEXML.validate"""
+    valid: bool
+    errors: list[str]
+    seconds: float
+
+
+def find_children(node: ElementTree.Element, qualified_name: str) -> list[ElementTree.Element]:
+    """Return the children of a node with the given qualified name"""
+    return get_child_xpaths(qualified_name)[0](node)
+
+
+def find_child(node: ElementTree.Element, qualified_name: str, index: int = 0) -> ElementTree.Element:
+    """Return the indexed child of a node with the given qualified name
+
+    Raises IndexError if there is no such child, like list indexing.
+    """
+    if index < 0:
+        return find_children(node, qualified_name)[index]
+    # libxml2 evaluates positional predicates over every child, the tag
+    # filtered iterator stops at the requested one
+    child = next(islice(node.iterchildren(qualified_name), index, None), None)
+    if child is None:
+        raise IndexError("%s index out of range" % qualified_name)
+    return child
+
+
+def count_children(node: ElementTree.Element, qualified_name: str) -> int:
+    """Return the number of children of a node with the given qualified name"""
+    return int(get_child_xpaths(qualified_name)[1](node))
+
+
+def get_plane_indices(dimension_order: str, size_z: int, size_c: int, size_t: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return the Z, C and T index of every plane, in IFD order
+
+    dimension_order - the OME DimensionOrder, for instance DO_XYCZT. The third
+                      letter is the most rapidly varying plane index.
+    """
+    sizes = {"Z": size_z, "C": size_c, "T": size_t}
+    slowest_first = dimension_order[-3:][::-1]
+    indices = np.indices([sizes[dim] for dim in slowest_first]).reshape(3, -1)
+    by_dim = dict(zip(slowest_first, indices))
+    return by_dim["Z"], by_dim["C"], by_dim["T"]
+
+
+def get_attr_strings(values) -> list[str | None]:
+    """Format an array of attribute values as strings, NaN values and empty strings become None"""
+    values = np.asarray(values).ravel()
+    if values.dtype.kind in "iu" and values.size and 0 <= values.min() and values.max() < 4 * values.size:
+        # small non-negative integers (plane indices, IFDs): format each distinct value once
+        labels = np.array([str(i) for i in range(values.max() + 1)], dtype=object)
+        return labels[values].tolist()
+    strings = list(map(str, values.tolist()))
+    if values.dtype.kind == "f":
+        for idx in np.flatnonzero(np.isnan(values)).tolist():
+            strings[idx] = None
+    elif values.dtype.kind == "U":
+        for idx in np.flatnonzero(values == "").tolist():
+            strings[idx] = None
+    return strings
+
+
+def make_elements(parent: ElementTree.Element, qualified_name: str, attributes: dict[str, list[str | None]],
+                  index: int | None = None) -> None:
+    """Create one child element per row of attribute columns in a single pass
+
+    parent - the parent node of the new elements
+    qualified_name - the qualified tag name of the new elements
+    attributes - a mapping of attribute name to a list of string values, as
+                 returned by get_attr_strings. None values are skipped.
+    index - position of the first new element among the parent's children,
+            new elements are appended if None
+    """
+    namespace, tag_name = split_qn(qualified_name)
+    columns = []
+    for key, column in attributes.items():
+        # one pass over the joined values rather than one test per value
+        joined = "".join(filter(None, column))
+        if "&" in joined or "<" in joined or '"' in joined:
+            column = [None if value is None else escape(value, {'"': "&quot;"}) for value in column]
+        columns.append((key, column))
+
+    # the elements are serialized and parsed back at once, which is much
+    # faster than setting every attribute of every element through lxml
+    if any(None in column for _, column in columns):
+        cells = [['' if value is None else ' %s="%s"' % (key, value) for value in column] for key, column in columns]
+        elements = ["<%s%s/>" % (tag_name, "".join(row)) for row in zip(*cells)]
+    else:
+        template = "<%s %s/>" % (tag_name, " ".join('%s="%%s"' % key for key, _ in columns))
+        elements = [template % row for row in zip(*[column for _, column in columns])]
+    fragment = '<fragment xmlns="%s">%s</fragment>' % (namespace, "".join(elements))
+    container = ElementTree.fromstring(fragment.encode("utf-8"), ElementTree.XMLParser(huge_tree=True))
+
+    # the cyclic garbage collector would otherwise rescan the growing tree many times
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if index is None:
+            parent.extend(list(container))
+        else:
+            parent[index:index] = list(container)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+OM_KEY_TAG = get_qualified_name(NS_ORIGINAL_METADATA, "Key")
+OM_VALUE_TAG = get_qualified_name(NS_ORIGINAL_METADATA, "Value")
+
+
+def get_original_metadata_nodes(om_node: ElementTree.Element) -> tuple[ElementTree.Element, ElementTree.Element] | None:
+    """Return the Key and Value nodes of an OriginalMetadata node, None if either is missing or empty"""
+    key_node = value_node = None
+    for child in om_node:
+        if child.tag == OM_KEY_TAG:
+            key_node = child
+        elif child.tag == OM_VALUE_TAG:
+            value_node = child
+    if key_node is None or value_node is None:
+        return None
+    if key_node.text is None or value_node.text is None:
+        logger.warning("Original metadata was missing key or value:" + ElementTree.tostring(om_node, encoding=uenc))
+        return None
+    return key_node, value_node
+
+
 def get_float_attr(node: ElementTree.Element, attribute: str) -> float | None:
     """Cast an element attribute to a float or return None if not present"""
     attr = node.get(attribute)
@@ -314,6 +789,58 @@ def make_text_node(parent: ElementTree.Element, namespace: str, tag_name: str, t
     set_text(node, text)
 
 
+def iterparse_images(source, headers_only: bool = False) -> Iterator[tuple[ElementTree.Element, NamespaceContext, ElementTree.Element]]:
+    """Parse OME-XML incrementally, yielding every Image element once it is complete
+
+    source - the OME-XML as a str or bytes, the path of an XML file or a
+             binary file object
+    headers_only - drop the Plane and TiffData elements while parsing
+
+    Yields (root, namespaces, image) tuples. Processed elements are removed
+    from the tree: the top-level elements other than Image and Instrument as
+    soon as they are parsed, and each image when the next one is requested,
+    so memory is bounded by the largest image (or annotation) rather than by
+    the document. The root keeps the Instrument elements parsed so far.
+    """
+    if isinstance(source, str) and source.lstrip().startswith("<"):
+        source = source.encode("utf-8")
+    if isinstance(source, bytes):
+        source = BytesIO(source)
+    elif isinstance(source, os.PathLike):
+        source = os.fspath(source)
+
+    uris = []
+    root = namespaces = None
+    kept_tags = dropped_tags = image_tag = None
+    context = ElementTree.iterparse(source, events=("start-ns", "end"), huge_tree=True)
+    for event, item in context:
+        if event == "start-ns":
+            uris.append(item[1])
+            continue
+        if root is None:
+            root = item.getroottree().getroot()
+            namespaces = NamespaceContext(match_namespaces(uris + [ElementTree.QName(root).namespace]))
+            if namespaces['ome'] is None:
+                raise Exception("Error: String not in OME-XML format")
+            image_tag = namespaces.qn('ome', "Image")
+            kept_tags = {image_tag, namespaces.qn('ome', "Instrument")}
+            dropped_tags = {namespaces.qn('ome', "Plane"), namespaces.qn('ome', "TiffData")} if headers_only else ()
+
+        parent = item.getparent()
+        if parent is None:
+            break
+        if parent is root:
+            if item.tag == image_tag:
+                yield root, namespaces, item
+                if item.getparent() is root:
+                    root.remove(item)
+            elif item.tag not in kept_tags:
+                root.remove(item)
+        elif item.tag in dropped_tags or parent.getparent() is root and parent.tag not in kept_tags:
+            # the children of the elements about to be dropped, annotations are the bulk of these
+            parent.remove(item)
+
+
 class OMEXML(object):
     """Reads and writes OME-XML with methods to get and set it.
 
@@ -358,18 +885,35 @@ class OMEXML(object):
 
     """
 
-    def __init__(self, xml: str | None = None) -> None:
+    def __init__(self, xml: str | None = None, lazy: bool = False) -> None:
+        """Parse the OME-XML, or start from a one-image document if None
+
+        xml - the OME-XML document
+        lazy - only index the top-level Image, Instrument, Plate, ROI and
+               StructuredAnnotations elements, parsing each of them the first
+               time it is accessed. Accessing root_node parses them all.
+        """
         if xml is None:
             xml = default_xml
         if isinstance(xml, str):
             xml = xml.encode("utf-8")
-        try:
-            self.dom = ElementTree.ElementTree(ElementTree.fromstring(xml))
-        except UnicodeEncodeError:
-            xml = xml.encode("utf-8")
-            self.dom = ElementTree.ElementTree(ElementTree.fromstring(xml))
+        # huge_tree lifts libxml2 limits on text size and tree depth hit by large plane lists
+        parser = ElementTree.XMLParser(huge_tree=True)
+        self.lazy_sections = None
+        if lazy:
+            try:
+                self.lazy_sections = LazySections(xml, parser)
+            except (ValueError, ElementTree.XMLSyntaxError):
+                logger.debug("Could not index the OME-XML sections, parsing the whole document")
+        if self.lazy_sections is not None:
+            self.dom = ElementTree.ElementTree(self.lazy_sections.root)
+        else:
+            self.dom = ElementTree.ElementTree(ElementTree.fromstring(xml, parser))
         # determine OME namespaces
-        self.namespaces = get_namespaces(self.dom.getroot())
+        namespaces = get_namespaces(self.dom.getroot())
+        if self.lazy_sections is not None and self.lazy_sections.declared_namespaces:
+            namespaces = match_namespaces(list(namespaces.values()) + self.lazy_sections.declared_namespaces)
+        self.namespaces = NamespaceContext(namespaces)
         if self.namespaces['ome'] is None:
             raise Exception("Error: String not in OME-XML format")
 
@@ -379,51 +923,151 @@ class OMEXML(object):
         #     omeElem.set('UUID', 'urn:uuid:'+str(uuid.uuid4()))
         # self.uuidStr = omeElem.get('UUID')
 
+    @classmethod
+    def from_root(cls, root: ElementTree.Element, namespaces: NamespaceContext | None = None) -> "OMEXML":
+        """Wrap an already parsed OME root element"""
+        ox = cls.__new__(cls)
+        ox.lazy_sections = None
+        ox.dom = root.getroottree()
+        ox.namespaces = NamespaceContext.resolve(root, namespaces)
+        return ox
+
+    @classmethod
+    def iter_images(cls, source, headers_only: bool = True) -> Iterator["OMEXML.Image"]:
+        """Iterate over the images of an OME-XML document without loading it whole
+
+        source - the OME-XML as a str or bytes, the path of an XML file or a
+                 binary file object
+        headers_only - drop the Plane and TiffData elements while parsing,
+                       leaving the Image attributes, the Pixels attributes and
+                       the Channels
+
+        Each image is parsed incrementally and released when the next one is
+        requested, read what you need before moving on.
+        """
+        for _, namespaces, node in iterparse_images(source, headers_only):
+            yield cls.Image(node, namespaces)
+
+    @classmethod
+    def parse_image(cls, source, index: int = 0, headers_only: bool = False) -> "OMEXML":
+        """Parse a single image of an OME-XML document with bounded memory
+
+        The returned document holds the root element, the Instrument elements
+        and the selected image only. Parsing stops at the end of the image.
+
+        source - the OME-XML as a str or bytes, the path of an XML file or a
+                 binary file object
+        index - the index of the image, counting from the first
+        headers_only - drop the Plane and TiffData elements while parsing
+        """
+        if index < 0:
+            raise IndexError("images are parsed in order, index must be non-negative")
+        images = iterparse_images(source, headers_only)
+        for position, (root, namespaces, node) in enumerate(images):
+            if position == index:
+                images.close()
+                # the parser may have started building the following elements
+                for sibling in list(node.itersiblings()):
+                    root.remove(sibling)
+                return cls.from_root(root, namespaces)
+        raise IndexError("image index out of range")
+
     def __str__(self) -> str:
         #
-        # need to register the ome namespace because BioFormats expects
-        # that namespace to be the default or to be explicitly named "ome"
+        # the namespace prefixes of the parsed document are kept, BioFormats
+        # expects the ome namespace to be the default or to be explicitly
+        # named "ome", as it is in any OME-XML it writes
         #
-        for ns_key in ["ome", "sa", "spw"]:
-            ns = self.namespaces.get(ns_key) or NS_DEFAULT.format(ns_key=ns_key)
-            ElementTree.register_namespace(ns_key, ns)
-        ElementTree.register_namespace("om", NS_ORIGINAL_METADATA)
-        result = StringIO()
-        ElementTree.ElementTree(self.root_node).write(result,
-                                                      xml_declaration=True,
-                                                      encoding=uenc,
-                                                      method="xml")
-        return result.getvalue()
+        return XML_DECLARATION + ElementTree.tostring(self.root_node, encoding=uenc, method="xml")
 
     def to_xml(self, indent: str ="\t", newline: str ="\n", encoding: str =uenc) -> str:
         return str(self)
 
+    def to_bytes(self, pretty: bool = False) -> bytes:
+        """Serialize the OME-XML to UTF-8, with an XML declaration
+
+        pretty - indent elements that have no whitespace around them yet
+        """
+        return ElementTree.tostring(self.root_node, encoding="utf-8", xml_declaration=True, pretty_print=pretty)
+
+    def write_to(self, fileobj, pretty: bool = False) -> None:
+        """Serialize the OME-XML to a binary file object or a path, as to_bytes does
+
+        The document is encoded and written incrementally, without building
+        the whole serialization in memory first.
+        """
+        with ElementTree.xmlfile(fileobj, encoding="utf-8") as xf:
+            xf.write_declaration()
+            xf.write(self.root_node, pretty_print=pretty)
+
+    def validate(self, schema_path: str | None = None) -> ValidationResult:
+        """Validate the document against the OME schema
+
+        schema_path - the XSD file to validate against, the bundled OME
+                      2016-06 schema if None. Documents written with other
+                      versions of the schema need the matching XSD.
+
+        The schema is compiled on the first call and reused by every later
+        validation in the process. Returns whether the document is valid, the
+        validation errors and the seconds spent validating, which are also
+        logged at debug level.
+        """
+        schema = get_schema(OME_SCHEMA_PATH if schema_path is None else os.fspath(schema_path))
+        start = time.perf_counter()
+        valid = schema.validate(self.root_node)
+        errors = ["line %d: %s" % (error.line, error.message) for error in schema.error_log]
+        seconds = time.perf_counter() - start
+        logger.debug("OME-XML validated in %.6fs, %d errors", seconds, len(errors))
+        return ValidationResult(valid, errors, seconds)
+
     def get_ns(self, key: str) -> str:
         return self.namespaces[key]
 
+    def get_UUID(self) -> str:
+        """The UUID of the file holding this OME-XML block, as a urn:uuid string"""
+        return self.dom.getroot().get("UUID")
+
+    def set_UUID(self, value: str) -> None:
+        self.dom.getroot().set("UUID", value)
+
+    UUID = property(get_UUID, set_UUID)
+
     @property
     def root_node(self) -> ElementTree.Element:
+        if self.lazy_sections is not None:
+            self.lazy_sections.parse_all()
+            self.lazy_sections = None
+            self.namespaces.invalidate(self.dom.getroot())
+        return self.dom.getroot()
+
+    def section_root(self, tag_name: str) -> ElementTree.Element:
+        """Return the root node once the top-level elements with a tag are parsed"""
+        if self.lazy_sections is not None:
+            self.lazy_sections.get_all(tag_name)
+            self.namespaces.invalidate(self.dom.getroot())
         return self.dom.getroot()
 
     def get_image_count(self) -> int:
         """The number of images (= series) specified by the XML"""
-        return len(self.root_node.findall(get_qualified_name(self.namespaces['ome'], "Image")))
+        if self.lazy_sections is not None:
+            return self.lazy_sections.count("Image")
+        return count_children(self.root_node, self.namespaces.qn('ome', "Image"))
 
     def set_image_count(self, value: int) -> None:
         """Add or remove image nodes as needed"""
         assert value > 0
         root = self.root_node
         if self.image_count > value:
-            image_nodes = root.find(get_qualified_name(self.namespaces['ome'], "Image"))
+            image_nodes = root.find(self.namespaces.qn('ome', "Image"))
             for image_node in image_nodes[value:]:
                 root.remove(image_node)
         while self.image_count < value:
-            new_image = self.Image(ElementTree.SubElement(root, get_qualified_name(self.namespaces['ome'], "Image")))
+            new_image = self.Image(ElementTree.SubElement(root, self.namespaces.qn('ome', "Image")), self.namespaces)
             new_image.ID = str(uuid.uuid4())
             new_image.Name = "default.png"
             new_image.AcquisitionDate = xsd_now()
             new_pixels = self.Pixels(
-                ElementTree.SubElement(new_image.node, get_qualified_name(self.namespaces['ome'], "Pixels")))
+                ElementTree.SubElement(new_image.node, self.namespaces.qn('ome', "Pixels")), self.namespaces)
             new_pixels.ID = str(uuid.uuid4())
             new_pixels.DimensionOrder = DO_XYCTZ
             new_pixels.PixelType = PT_UINT8
@@ -433,16 +1077,117 @@ class OMEXML(object):
             new_pixels.SizeY = 512
             new_pixels.SizeZ = 1
             new_channel = self.Channel(
-                ElementTree.SubElement(new_pixels.node, get_qualified_name(self.namespaces['ome'], "Channel")))
+                ElementTree.SubElement(new_pixels.node, self.namespaces.qn('ome', "Channel")), self.namespaces)
             new_channel.ID = "Channel%d:0" % self.image_count
             new_channel.Name = new_channel.ID
             new_channel.SamplesPerPixel = 1
+        self.namespaces.invalidate(root)
 
     image_count = property(get_image_count, set_image_count)
 
     @property
     def plates(self) -> "PlatesDucktype":
-        return self.PlatesDucktype(self.root_node)
+        return self.PlatesDucktype(self.section_root("Plate"), self.namespaces)
+
+    def build_plate(self, rows: int, columns: int, fields: int = 1, image_refs=None, name: str = "Plate",
+                    plate_id: str | None = None) -> "OMEXML.Plate":
+        """Add a plate with every well and field of view in one pass
+
+        rows, columns - the size of the plate, all of its wells are created
+        fields - the number of WellSample elements per well
+        image_refs - the Image IDs the well samples refer to, an array of
+                     shape (rows, columns, fields) with None or "" where a
+                     sample has no image. If None, one image per well sample
+                     is added after the images of the document, copied from
+                     the first image without its TiffData and Plane elements.
+        name - the Name of the plate
+        plate_id - the ID of the plate, Plate:<n> for the n-th plate if None
+
+        The wells are named with letters for the rows and numbers for the
+        columns, and IDs are derived from the plate ID and the well and sample
+        positions. Returns the new plate.
+        """
+        root = self.root_node
+        plate_number = count_children(root, self.namespaces.qn('spw', "Plate"))
+        if plate_id is None:
+            plate_id = "Plate:%d" % plate_number
+        suffix = plate_id.split(":", 1)[1] if plate_id.startswith("Plate:") else str(plate_number)
+        n_samples = rows * columns * fields
+        # the sample indexes are the positions of the images they refer to when the images are added
+        first_index = 0
+        if image_refs is None:
+            existing = [node.get("ID") for node in find_children(root, self.namespaces.qn('ome', "Image"))]
+            if not existing:
+                raise ValueError("The document has no image to copy for the well samples, pass image_refs")
+            image_ids = ["Image:%s:%d" % (suffix, sample) for sample in range(n_samples)]
+            if not set(existing).isdisjoint(image_ids):
+                raise ValueError("The images of plate {} are already in the document".format(plate_id))
+            first_index = len(existing)
+        else:
+            image_refs = np.asarray(image_refs, dtype=object)
+            if image_refs.shape != (rows, columns, fields):
+                raise ValueError("image_refs has shape {}, expected {}".format(
+                    image_refs.shape, (rows, columns, fields)))
+            image_ids = image_refs.ravel().tolist()
+
+        well_names = [get_well_label(row, NC_LETTER) + get_well_label(column, NC_NUMBER)
+                      for row in range(rows) for column in range(columns)]
+        wells = []
+        sample = 0
+        for well, well_name in enumerate(well_names):
+            samples = []
+            for _ in range(fields):
+                image_id = image_ids[sample]
+                image_ref = '<ImageRef ID=%s/>' % quoteattr(image_id) if image_id else ''
+                samples.append('<WellSample ID="WellSample:%s:%d" Index="%d">%s</WellSample>' % (
+                    suffix, sample, first_index + sample, image_ref))
+                sample += 1
+            wells.append('<Well ID="Well:%s:%d" Row="%d" Column="%d">%s</Well>' % (
+                suffix, well, well // columns, well % columns, "".join(samples)))
+        plate_xml = ('<Plate xmlns="%s" ID=%s Name=%s Rows="%d" Columns="%d" RowNamingConvention="%s" '
+                     'ColumnNamingConvention="%s">%s</Plate>') % (
+            self.namespaces['spw'], quoteattr(plate_id), quoteattr(name), rows, columns, NC_LETTER, NC_NUMBER,
+            "".join(wells))
+        plate_node = ElementTree.fromstring(plate_xml.encode("utf-8"), ElementTree.XMLParser(huge_tree=True))
+
+        # the schema puts plates before the screens, the people, the instruments and the images
+        position = len(root)
+        for index, child in enumerate(root):
+            if isinstance(child.tag, str) and ElementTree.QName(child).localname in PLATE_FOLLOWING_ELEMENTS:
+                position = index
+                break
+        root.insert(position, plate_node)
+
+        if image_refs is None:
+            self._append_images(image_ids, ["%s_%d" % (well_name, field)
+                                            for well_name in well_names for field in range(fields)])
+        self.namespaces.invalidate(root)
+        return self.Plate(plate_node, self.namespaces)
+
+    def _append_images(self, image_ids: list[str], names: list[str]) -> None:
+        """Add copies of the first image after the last one, with the given IDs and names"""
+        root = self.root_node
+        image_nodes = find_children(root, self.namespaces.qn('ome', "Image"))
+        template = copy.deepcopy(image_nodes[0])
+        pixels = OMEXML.Pixels(find_child(template, self.namespaces.qn('ome', "Pixels")), self.namespaces)
+        for tag_name in ("TiffData", "Plane"):
+            for node in find_children(pixels.node, self.namespaces.qn('ome', tag_name)):
+                pixels.node.remove(node)
+        # the IDs and names of every copy are substituted into a single serialization
+        template.set("ID", "Image:@ID@")
+        template.set("Name", "@NAME@")
+        pixels.node.set("ID", "Pixels:@ID@")
+        for index, channel in enumerate(find_children(pixels.node, self.namespaces.qn('ome', "Channel"))):
+            channel.set("ID", "Channel:@ID@:%d" % index)
+        template.tail = None
+        template_xml = ElementTree.tostring(template, encoding=uenc)
+        images = [template_xml.replace("@NAME@", escape(name, {'"': "&quot;"})).replace(
+            "@ID@", escape(image_id.split(":", 1)[-1], {'"': "&quot;"})) for image_id, name in zip(image_ids, names)]
+        container = ElementTree.fromstring(
+            ('<fragment xmlns="%s">%s</fragment>' % (self.namespaces['ome'], "".join(images))).encode("utf-8"),
+            ElementTree.XMLParser(huge_tree=True))
+        position = root.index(image_nodes[-1]) + 1
+        root[position:position] = list(container)
 
     @property
     def structured_annotations(self) -> "StructuredAnnotations":
@@ -451,19 +1196,21 @@ class OMEXML(object):
         returns a wrapping of OME/StructuredAnnotations. It creates
         the element if it doesn't exist.
         """
-        node = self.root_node.find(get_qualified_name(self.namespaces['sa'], "StructuredAnnotations"))
+        root = self.section_root("StructuredAnnotations")
+        node = root.find(self.namespaces.qn('sa', "StructuredAnnotations"))
         if node is None:
             node = ElementTree.SubElement(
-                self.root_node, get_qualified_name(self.namespaces['sa'], "StructuredAnnotations"))
-        return self.StructuredAnnotations(node)
+                self.root_node, self.namespaces.qn('sa', "StructuredAnnotations"))
+            self.namespaces.invalidate(self.root_node)
+        return self.StructuredAnnotations(node, self.namespaces)
 
     class Image(object):
         """Representation of the OME/Image element"""
 
-        def __init__(self, node: ElementTree.Element) -> None:
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             """Initialize with the DOM Image node"""
             self.node = node
-            self.namespaces = get_namespaces(self.node)
+            self.namespaces = NamespaceContext.resolve(self.node, namespaces)
 
         def get_ID(self) -> str:
             return self.node.get("ID")
@@ -483,16 +1230,16 @@ class OMEXML(object):
 
         def get_AcquisitionDate(self) -> str:
             """The date in ISO-8601 format"""
-            acquired_date = self.node.find(get_qualified_name(self.namespaces["ome"], "AcquisitionDate"))
+            acquired_date = self.node.find(self.namespaces.qn('ome', "AcquisitionDate"))
             if acquired_date is None:
                 return None
             return get_text(acquired_date)
 
         def set_AcquisitionDate(self, date: str) -> None:
-            acquired_date = self.node.find(get_qualified_name(self.namespaces["ome"], "AcquisitionDate"))
+            acquired_date = self.node.find(self.namespaces.qn('ome', "AcquisitionDate"))
             if acquired_date is None:
                 acquired_date = ElementTree.SubElement(
-                    self.node, get_qualified_name(self.namespaces["ome"], "AcquisitionDate"))
+                    self.node, self.namespaces.qn('ome', "AcquisitionDate"))
             set_text(acquired_date, date)
 
         AcquisitionDate = property(get_AcquisitionDate, set_AcquisitionDate)
@@ -500,39 +1247,43 @@ class OMEXML(object):
         @property
         def Pixels(self):
             """The OME/Image/Pixels element."""
-            return OMEXML.Pixels(self.node.find(get_qualified_name(self.namespaces['ome'], "Pixels")))
+            return OMEXML.Pixels(find_child(self.node, self.namespaces.qn('ome', "Pixels")), self.namespaces)
 
         def roiref(self, index: int = 0) -> "OMEXML.ROIRef":
             """The OME/Image/ROIRef element"""
-            return OMEXML.ROIRef(self.node.findall(get_qualified_name(self.namespaces['ome'], "ROIRef"))[index])
+            return OMEXML.ROIRef(self.node.findall(self.namespaces.qn('ome', "ROIRef"))[index], self.namespaces)
 
         def get_roiref_count(self) -> int:
-            return len(self.node.findall(get_qualified_name(self.namespaces['ome'], "ROIRef")))
+            return len(self.node.findall(self.namespaces.qn('ome', "ROIRef")))
 
         def set_roiref_count(self, value: int) -> None:
             """Add or remove roirefs as needed"""
             assert value > 0
             if self.roiref_count > value:
-                roiref_nodes = self.node.find(get_qualified_name(self.namespaces['ome'], "ROIRef"))
+                roiref_nodes = self.node.find(self.namespaces.qn('ome', "ROIRef"))
                 for roiref_node in roiref_nodes[value:]:
                     self.node.remove(roiref_node)
             while self.roiref_count < value:
                 iteration = self.roiref_count - 1
-                new_roiref = OMEXML.ROIRef(ElementTree.SubElement(self.node, get_qualified_name(self.namespaces['ome'], "ROIRef")))
+                new_roiref = OMEXML.ROIRef(
+                    ElementTree.SubElement(self.node, self.namespaces.qn('ome', "ROIRef")), self.namespaces)
                 new_roiref.set_ID(value=iteration)
+            self.namespaces.invalidate(self.node)
 
         roiref_count = property(get_roiref_count, set_roiref_count)
 
     def image(self, index: int = 0) -> Image:
         """Return an image node by index"""
-        return self.Image(self.root_node.findall(get_qualified_name(self.namespaces['ome'], "Image"))[index])
+        if self.lazy_sections is not None:
+            return self.Image(self.lazy_sections.get("Image", index), self.namespaces)
+        return self.Image(find_child(self.root_node, self.namespaces.qn('ome', "Image"), index), self.namespaces)
 
     class Channel(object):
         """The OME/Image/Pixels/Channel element"""
 
-        def __init__(self, node: ElementTree.Element) -> None:
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             self.node = node
-            self.namespaces = get_namespaces(node)
+            self.namespaces = NamespaceContext.resolve(self.node, namespaces)
 
         def get_ID(self) -> str:
             return self.node.get("ID")
@@ -677,9 +1428,9 @@ class OMEXML(object):
         For our purposes, there will be one TiffData per 2-dimensional image plane.
         """
 
-        def __init__(self, node: ElementTree.Element) -> None:
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = NamespaceContext.resolve(self.node, namespaces)
 
         def get_FirstZ(self) -> int:
             """The Z index of the plane"""
@@ -726,6 +1477,33 @@ class OMEXML(object):
 
         PlaneCount = property(get_PlaneCount, set_PlaneCount)
 
+        def get_UUID(self) -> str:
+            """The urn:uuid of the file holding the planes, None for single-file datasets"""
+            uuid_node = self.node.find(self.ns.qn('ome', "UUID"))
+            if uuid_node is None:
+                return None
+            return get_text(uuid_node)
+
+        def set_UUID(self, value: str) -> None:
+            make_text_node(self.node, self.ns['ome'], "UUID", value)
+
+        UUID = property(get_UUID, set_UUID)
+
+        def get_FileName(self) -> str:
+            """The name of the file holding the planes, relative to this one"""
+            uuid_node = self.node.find(self.ns.qn('ome', "UUID"))
+            if uuid_node is None:
+                return None
+            return uuid_node.get("FileName")
+
+        def set_FileName(self, value: str) -> None:
+            uuid_node = self.node.find(self.ns.qn('ome', "UUID"))
+            if uuid_node is None:
+                uuid_node = ElementTree.SubElement(self.node, self.ns.qn('ome', "UUID"))
+            uuid_node.set("FileName", value)
+
+        FileName = property(get_FileName, set_FileName)
+
     class Plane(object):
         """The OME/Image/Pixels/Plane element
 
@@ -734,9 +1512,9 @@ class OMEXML(object):
         X, Y, Z, exposure time and a relative time delta.
         """
 
-        def __init__(self, node: ElementTree.Element) -> None:
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = NamespaceContext.resolve(self.node, namespaces)
 
         def get_TheZ(self) -> int:
             """The Z index of the plane"""
@@ -774,6 +1552,14 @@ class OMEXML(object):
 
         DeltaT = property(get_DeltaT, set_DeltaT)
 
+        def get_DeltaTUnit(self) -> str:
+            return self.node.get("DeltaTUnit")
+
+        def set_DeltaTUnit(self, value: str) -> None:
+            self.node.set("DeltaTUnit", str(value))
+
+        DeltaTUnit = property(get_DeltaTUnit, set_DeltaTUnit)
+
         def get_ExposureTime(self) -> float:
             exposure_time = self.node.get("ExposureTime")
             if exposure_time is not None:
@@ -786,6 +1572,14 @@ class OMEXML(object):
 
         ExposureTime = property(get_ExposureTime, set_ExposureTime)
 
+        def get_ExposureTimeUnit(self) -> str:
+            return self.node.get("ExposureTimeUnit")
+
+        def set_ExposureTimeUnit(self, value: str) -> None:
+            self.node.set("ExposureTimeUnit", str(value))
+
+        ExposureTimeUnit = property(get_ExposureTimeUnit, set_ExposureTimeUnit)
+
         def get_PositionX(self) -> float:
             """X position of stage"""
             position_x = self.node.get("PositionX")
@@ -849,9 +1643,9 @@ class OMEXML(object):
         and it specifies the channel interleaving and channel depth.
         """
 
-        def __init__(self, node: ElementTree.Element) -> None:
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             self.node = node
-            self.namespaces = get_namespaces(self.node)
+            self.namespaces = NamespaceContext.resolve(self.node, namespaces)
 
         def get_ID(self) -> str:
             return self.node.get("ID")
@@ -1016,29 +1810,30 @@ class OMEXML(object):
             pixels.Channel(0).Name = "Red"
             ...
             """
-            return len(self.node.findall(get_qualified_name(self.namespaces['ome'], "Channel")))
+            return len(self.namespaces.children(self.node, 'ome', "Channel"))
 
         def set_channel_count(self, value: int) -> None:
             assert value > 0
             channel_count = self.channel_count
             if channel_count > value:
-                channels = self.node.findall(get_qualified_name(self.namespaces['ome'], "Channel"))
+                channels = find_children(self.node, self.namespaces.qn('ome', "Channel"))
                 for channel in channels[value:]:
                     self.node.remove(channel)
             else:
                 for _ in range(channel_count, value):
                     new_channel = OMEXML.Channel(
-                        ElementTree.SubElement(self.node, get_qualified_name(self.namespaces['ome'], "Channel")))
+                        ElementTree.SubElement(self.node, self.namespaces.qn('ome', "Channel")), self.namespaces)
                     new_channel.ID = str(uuid.uuid4())
                     new_channel.Name = new_channel.ID
                     new_channel.SamplesPerPixel = 1
+            self.namespaces.invalidate(self.node)
 
         channel_count = property(get_channel_count, set_channel_count)
 
         def Channel(self, index: int = 0) -> "OMEXML.Channel":
             """Get the indexed channel from the Pixels element"""
-            channel = self.node.findall(get_qualified_name(self.namespaces['ome'], "Channel"))[index]
-            return OMEXML.Channel(channel)
+            channel = self.namespaces.child(self.node, 'ome', "Channel", index)
+            return OMEXML.Channel(channel, self.namespaces)
 
         channel = Channel
 
@@ -1059,47 +1854,49 @@ class OMEXML(object):
             pixels.Plane(0).TheZ=pixels.Plane(0).TheC=pixels.Plane(0).TheT=0
             ...
             """
-            return len(self.node.findall(get_qualified_name(self.namespaces['ome'], "Plane")))
+            return len(self.namespaces.children(self.node, 'ome', "Plane"))
 
         def set_plane_count(self, value: int) -> None:
             assert value >= 0
             plane_count = self.plane_count
             if plane_count > value:
-                planes = self.node.findall(get_qualified_name(self.namespaces['ome'], "Plane"))
+                planes = find_children(self.node, self.namespaces.qn('ome', "Plane"))
                 for plane in planes[value:]:
                     self.node.remove(plane)
             else:
                 for _ in range(plane_count, value):
                     new_plane = OMEXML.Plane(
-                        ElementTree.SubElement(self.node, get_qualified_name(self.namespaces['ome'], "Plane")))
+                        ElementTree.SubElement(self.node, self.namespaces.qn('ome', "Plane")), self.namespaces)
+            self.namespaces.invalidate(self.node)
 
         plane_count = property(get_plane_count, set_plane_count)
 
         def Plane(self, index: int = 0) -> "OMEXML.Plane":
             """Get the indexed plane from the Pixels element"""
-            plane = self.node.findall(get_qualified_name(self.namespaces['ome'], "Plane"))[index]
-            return OMEXML.Plane(plane)
+            plane = self.namespaces.child(self.node, 'ome', "Plane", index)
+            return OMEXML.Plane(plane, self.namespaces)
 
         plane = Plane
 
         def get_tiffdata_count(self) -> int:
-            return len(self.node.findall(get_qualified_name(self.namespaces['ome'], "TiffData")))
+            return len(self.namespaces.children(self.node, 'ome', "TiffData"))
 
         def set_tiffdata_count(self, value: int) -> None:
             assert value >= 0
-            tiffdatas = self.node.findall(get_qualified_name(self.namespaces['ome'], "TiffData"))
+            tiffdatas = find_children(self.node, self.namespaces.qn('ome', "TiffData"))
             for td in tiffdatas:
                 self.node.remove(td)
             for _ in range(0, value):
                 new_tiffdata = OMEXML.TiffData(
-                    ElementTree.SubElement(self.node, get_qualified_name(self.namespaces['ome'], "TiffData")))
+                    ElementTree.SubElement(self.node, self.namespaces.qn('ome', "TiffData")), self.namespaces)
+            self.namespaces.invalidate(self.node)
 
         tiffdata_count = property(get_tiffdata_count, set_tiffdata_count)
 
         # changed from tiffdata to Tiffdata
         def Tiffdata(self, index: int = 0) -> "OMEXML.TiffData":
-            tiffData = self.node.findall(get_qualified_name(self.namespaces['ome'], "TiffData"))[index]
-            return OMEXML.TiffData(tiffData)
+            tiffData = self.namespaces.child(self.node, 'ome', "TiffData", index)
+            return OMEXML.TiffData(tiffData, self.namespaces)
 
         # adaoted from AICSIMAGEIO
         def populate_TiffData(self, explicit: bool = False) -> None:
@@ -1109,54 +1906,120 @@ class OMEXML(object):
             total = self.SizeC * self.SizeT * self.SizeZ
 
             # bye bye old tiffdatas
-            tiffdatas = self.node.findall(get_qualified_name(self.namespaces['ome'], "TiffData"))
+            tiffdatas = find_children(self.node, self.namespaces.qn('ome', "TiffData"))
+            for td in tiffdatas:
+                self.node.remove(td)
+
+            # TiffData elements precede any Plane element in the schema
+            planes = find_children(self.node, self.namespaces.qn('ome', "Plane"))
+            index = list(self.node).index(planes[0]) if planes else None
 
             if explicit:
-                for td in tiffdatas:
-                    self.node.remove(td)
-
-                sizes = {
-                    "Z": self.SizeZ,
-                    "C": self.SizeC,
-                    "T": self.SizeT}
-
-                setters = {
-                    "Z": OMEXML.TiffData.set_FirstZ,
-                    "C": OMEXML.TiffData.set_FirstC,
-                    "T": OMEXML.TiffData.set_FirstT,
-                }
-                dims = self.DimensionOrder[-3:]
-                ifd = 0
-                for i in range(sizes[dims[2]]):
-                    for j in range(sizes[dims[1]]):
-                        for k in range(sizes[dims[0]]):
-                            new_tiffdata = OMEXML.TiffData(
-                                ElementTree.SubElement(self.node, get_qualified_name(self.namespaces['ome'], "TiffData")))
-                            setters[dims[2]](new_tiffdata, i)
-                            setters[dims[1]](new_tiffdata, j)
-                            setters[dims[0]](new_tiffdata, k)
-                            new_tiffdata.set_IFD(ifd)
-                            new_tiffdata.set_PlaneCount(1)
-                            # child element <UUID FileName=""></UUID> is omitted here for single file ome tiffs
-                            # UUID has an optional FileName attribute for image data that
-                            # are split among several files but we do not currently support it.
-                            # uuidelem = ElementTree.SubElement(new_tiffdata.node, qn(self.ns['ome'], "UUID"))
-                            # uuidelem.text = self.ome_uuid
-                            ifd = ifd + 1
+                # one TiffData per plane, built from index arrays in one pass.
+                # child element <UUID FileName=""></UUID> is omitted here for single file ome tiffs
+                first_z, first_c, first_t = get_plane_indices(self.DimensionOrder, self.SizeZ, self.SizeC, self.SizeT)
+                make_elements(self.node, self.namespaces.qn('ome', "TiffData"), {
+                    "FirstZ": get_attr_strings(first_z),
+                    "FirstC": get_attr_strings(first_c),
+                    "FirstT": get_attr_strings(first_t),
+                    "IFD": get_attr_strings(np.arange(total)),
+                    "PlaneCount": ["1"] * total,
+                }, index=index)
             else:
                 # implicit only supports single-stack OME-XMLs (no multiple image stacks in same file)
-                new_tiffdata = OMEXML.TiffData(
-                    ElementTree.SubElement(self.node, get_qualified_name(self.namespaces["ome"], "TiffData"))
-                )
-                new_tiffdata.set_IFD(0)
-                new_tiffdata.set_PlaneCount(total)
+                make_elements(self.node, self.namespaces.qn('ome', "TiffData"), {
+                    "IFD": ["0"],
+                    "PlaneCount": [str(total)],
+                }, index=index)
+            self.namespaces.invalidate(self.node)
+
+        def populate_Planes(self, columns: dict | np.ndarray | None = None) -> None:
+            """Replace the Plane elements with one Plane per image plane, in IFD order
+
+            columns - optional per-plane attributes (see PLANE_COLUMNS), either
+                      a dictionary of attribute name to values or a structured
+                      array with one field per attribute. Values can be scalars,
+                      which apply to every plane, arrays with one entry per
+                      plane in IFD order, or arrays of shape (SizeZ, SizeC, SizeT)
+                      indexed by (Z, C, T). NaN values and empty strings are
+                      left out. TheZ, TheC and TheT columns are ignored, as
+                      in the table returned by plane_table.
+            """
+            assert self.SizeC is not None
+            assert self.SizeZ is not None
+            assert self.SizeT is not None
+
+            for plane in find_children(self.node, self.namespaces.qn('ome', "Plane")):
+                self.node.remove(plane)
+
+            the_z, the_c, the_t = get_plane_indices(self.DimensionOrder, self.SizeZ, self.SizeC, self.SizeT)
+            attributes = {
+                "TheZ": get_attr_strings(the_z),
+                "TheC": get_attr_strings(the_c),
+                "TheT": get_attr_strings(the_t),
+            }
+
+            if columns is None:
+                columns = {}
+            elif isinstance(columns, np.ndarray):
+                columns = {name: columns[name] for name in columns.dtype.names}
+
+            total = len(the_z)
+            zct_shape = (self.SizeZ, self.SizeC, self.SizeT)
+            for name, values in columns.items():
+                if name in PLANE_INDEX_COLUMNS:
+                    continue
+                if name not in PLANE_COLUMNS:
+                    raise ValueError("Plane has no per-plane attribute {}".format(name))
+                values = np.asarray(values)
+                if values.ndim == 0:
+                    attributes[name] = get_attr_strings(values) * total
+                elif values.shape == zct_shape:
+                    attributes[name] = get_attr_strings(values[the_z, the_c, the_t])
+                elif values.shape == (total,):
+                    attributes[name] = get_attr_strings(values)
+                else:
+                    raise ValueError("{} has shape {}, expected ({},) or {}".format(
+                        name, values.shape, total, zct_shape))
+
+            make_elements(self.node, self.namespaces.qn('ome', "Plane"), attributes)
+            self.namespaces.invalidate(self.node)
+
+        def plane_table(self) -> np.ndarray:
+            """Return the attributes of every Plane as a structured array
+
+            The table has one row per Plane element, in document order, read
+            in a single pass over the planes. Its fields are TheZ, TheC and
+            TheT (-1 where missing) and the PLANE_COLUMNS attributes: values
+            are floats (NaN where missing) and units are strings (empty where
+            missing). The table can be passed back to populate_Planes.
+            """
+            planes = self.namespaces.children(self.node, 'ome', "Plane")
+            names = PLANE_INDEX_COLUMNS + PLANE_COLUMNS
+            rows = [tuple(plane.get(name) for name in names) for plane in planes]
+            columns = list(zip(*rows)) if rows else [()] * len(names)
+
+            fields = []
+            for name, column in zip(names, columns):
+                if name in PLANE_INDEX_COLUMNS:
+                    values = np.array(["-1" if value is None else value for value in column]).astype(np.int64)
+                elif name.endswith("Unit"):
+                    values = np.array(["" if value is None else value for value in column], dtype=str)
+                else:
+                    values = np.array(["nan" if value is None else value for value in column]).astype(np.float64)
+                fields.append((name, values))
+
+            table = np.empty(len(planes), dtype=[(name, values.dtype) for name, values in fields])
+            for name, values in fields:
+                table[name] = values
+            return table
 
     class Instrument(object):
         """Representation of the OME/Instrument element"""
 
-        def __init__(self, node: ElementTree.Element) -> None:
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             self.node = node
-            self.namespaces = get_namespaces(self.node)
+            self.namespaces = NamespaceContext.resolve(self.node, namespaces)
 
         def get_ID(self) -> str:
             return self.node.get("ID")
@@ -1168,23 +2031,25 @@ class OMEXML(object):
 
         @property
         def Detector(self) -> "OMEXML.Detector":
-            return OMEXML.Detector(self.node.find(get_qualified_name(self.namespaces['ome'], "Detector")))
+            return OMEXML.Detector(self.node.find(self.namespaces.qn('ome', "Detector")), self.namespaces)
 
         @property
         def Objective(self) -> "OMEXML.Objective":
-            return OMEXML.Objective(self.node.find(get_qualified_name(self.namespaces['ome'], "Objective")))
+            return OMEXML.Objective(self.node.find(self.namespaces.qn('ome', "Objective")), self.namespaces)
 
         @property
         def Microscope(self) -> "OMEXML.Microscope":
-            return OMEXML.Microscope(self.node.find(get_qualified_name(self.namespaces['ome'], "Microscope")))
+            return OMEXML.Microscope(self.node.find(self.namespaces.qn('ome', "Microscope")), self.namespaces)
 
     def instrument(self, index: int = 0) -> "OMEXML.Instrument":
-        return self.Instrument(self.root_node.findall(get_qualified_name(self.namespaces['ome'], "Instrument"))[index])
+        if self.lazy_sections is not None:
+            return self.Instrument(self.lazy_sections.get("Instrument", index), self.namespaces)
+        return self.Instrument(self.root_node.findall(self.namespaces.qn('ome', "Instrument"))[index], self.namespaces)
 
     class Objective(object):
-        def __init__(self, node: ElementTree.Element) -> None:
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             self.node = node
-            self.namespaces = get_namespaces(self.node)
+            self.namespaces = NamespaceContext.resolve(self.node, namespaces)
 
         def get_ID(self) -> str:
             return self.node.get("ID")
@@ -1219,9 +2084,9 @@ class OMEXML(object):
         WorkingDistanceUnit = property(get_WorkingDistanceUnit, set_WorkingDistanceUnit)
 
     class Detector(object):
-        def __init__(self, node: ElementTree.Element) -> None:
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             self.node = node
-            self.namespaces = get_namespaces(self.node)
+            self.namespaces = NamespaceContext.resolve(self.node, namespaces)
 
         def get_ID(self) -> str:
             return self.node.get("ID")
@@ -1257,9 +2122,9 @@ class OMEXML(object):
 
     class Microscope(object):
 
-        def __init__(self, node: ElementTree.Element) -> None:
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = NamespaceContext.resolve(self.node, namespaces)
 
         def get_Type(self) -> str:
             return self.node.get("Type")
@@ -1321,29 +2186,33 @@ class OMEXML(object):
 
         """
 
-        def __init__(self, node: ElementTree.Element) -> None:
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             super().__init__()
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = NamespaceContext.resolve(self.node, namespaces)
+
+        @property
+        def index(self) -> "OMEXML.AnnotationIndex":
+            """The ID and original metadata key indexes of this element, built on first use"""
+            index = self.ns.annotation_indexes.get(self.node)
+            if index is None:
+                index = self.ns.annotation_indexes[self.node] = OMEXML.AnnotationIndex(self)
+            return index
 
         def __getitem__(self, key: str) -> ElementTree.Element:
-            for child in self.node:
-                if child.get("ID") == key:
-                    return child
-            raise IndexError('ID "%s" not found' % key)
+            try:
+                return self.index.by_id[key]
+            except KeyError:
+                raise IndexError('ID "%s" not found' % key) from None
 
         def __contains__(self, key: str) -> bool:
             return self.has_key(key)
 
         def keys(self) -> list[str]:
-            return filter(lambda x: x is not None,
-                          [child.get("ID") for child in self.node])
+            return list(self.index.by_id)
 
         def has_key(self, key: str) -> bool:
-            for child in self.node:
-                if child.get("ID") == key:
-                    return True
-            return False
+            return key in self.index.by_id
 
         def add_original_metadata(self, key: str | int, value: str) -> str:
             """Create an original data key/value pair
@@ -1355,10 +2224,10 @@ class OMEXML(object):
             returns the ID for the structured annotation.
             """
             xml_annotation = ElementTree.SubElement(
-                self.node, get_qualified_name(self.ns['sa'], "XMLAnnotation"))
+                self.node, self.ns.qn('sa', "XMLAnnotation"))
             node_id = str(uuid.uuid4())
             xml_annotation.set("ID", node_id)
-            xa_value = ElementTree.SubElement(xml_annotation, get_qualified_name(self.ns['sa'], "Value"))
+            xa_value = ElementTree.SubElement(xml_annotation, self.ns.qn('sa', "Value"))
             ov = ElementTree.SubElement(
                 xa_value, get_qualified_name(NS_ORIGINAL_METADATA, "OriginalMetadata"))
             ov_key = ElementTree.SubElement(ov, get_qualified_name(NS_ORIGINAL_METADATA, "Key"))
@@ -1366,20 +2235,37 @@ class OMEXML(object):
             ov_value = ElementTree.SubElement(
                 ov, get_qualified_name(NS_ORIGINAL_METADATA, "Value"))
             set_text(ov_value, value)
+            index = self.ns.annotation_indexes.get(self.node)
+            if index is not None:
+                index.add(xml_annotation)
             return node_id
 
-        def iter_original_metadata(self) -> tuple[str, tuple[str, str]]:
-            """An iterator over the original metadata in structured annotations
+        def add_original_metadata_items(self, items: dict[str, str]) -> list[str]:
+            """Create an original metadata annotation per key/value pair in one pass
 
-            returns (<annotation ID>, (<key, value>))
-
-            where <annotation ID> is the ID attribute of the annotation (which
-            can be used to tie an annotation to an image)
-
-                  <key> is the original metadata key, typically one of the
-                  OM_* names of a TIFF tag
-                  <value> is the value for the metadata
+            returns the IDs of the new structured annotations.
             """
+            items = [(str(key), str(value)) for key, value in items.items()]
+            node_ids = [str(uuid.uuid4()) for _ in items]
+            om_prefix = "{%s}" % NS_ORIGINAL_METADATA
+            # the annotations are serialized and parsed back at once, as in make_elements
+            annotations = "".join(
+                '<XMLAnnotation ID="%s"><Value><om:OriginalMetadata><om:Key>%s</om:Key>'
+                '<om:Value>%s</om:Value></om:OriginalMetadata></Value></XMLAnnotation>'
+                % (node_id, escape(key), escape(value)) for node_id, (key, value) in zip(node_ids, items))
+            fragment = '<fragment xmlns="%s" xmlns:om="%s">%s</fragment>' % (
+                self.ns['sa'], NS_ORIGINAL_METADATA, annotations)
+            container = ElementTree.fromstring(fragment.encode("utf-8"), ElementTree.XMLParser(huge_tree=True))
+            new_annotations = list(container)
+            self.node.extend(new_annotations)
+            index = self.ns.annotation_indexes.get(self.node)
+            if index is not None:
+                for xml_annotation in new_annotations:
+                    index.add(xml_annotation)
+            return node_ids
+
+        def iter_original_metadata_nodes(self) -> tuple[str, str, ElementTree.Element]:
+            """Scan the original metadata, yielding (<annotation ID>, <key>, <Value node>)"""
             #
             # Here's the XML we're traversing:
             #
@@ -1394,30 +2280,37 @@ class OMEXML(object):
             #    </XMLAnnotation>
             # </StructuredAnnotations>
             #
-            for annotation_node in self.node.findall(get_qualified_name(self.ns['sa'], "XMLAnnotation")):
+            om_tag = get_qualified_name(NS_ORIGINAL_METADATA, "OriginalMetadata")
+            for annotation_node in self.node.iterchildren(self.ns.qn('sa', "XMLAnnotation")):
                 # <XMLAnnotation/>
                 annotation_id = annotation_node.get("ID")
-                for xa_value_node in annotation_node.findall(get_qualified_name(self.ns['sa'], "Value")):
+                for xa_value_node in annotation_node.iterchildren(self.ns.qn('sa', "Value")):
                     # <Value/>
-                    for om_node in xa_value_node.findall(
-                            get_qualified_name(NS_ORIGINAL_METADATA, "OriginalMetadata")):
+                    for om_node in xa_value_node.iterchildren(om_tag):
                         # <OriginalMetadata>
-                        key_node = om_node.find(get_qualified_name(NS_ORIGINAL_METADATA, "Key"))
-                        value_node = om_node.find(get_qualified_name(NS_ORIGINAL_METADATA, "Value"))
-                        if key_node is not None and value_node is not None:
-                            key_text = get_text(key_node)
-                            value_text = get_text(value_node)
-                            if key_text is not None and value_text is not None:
-                                yield annotation_id, (key_text, value_text)
-                            else:
-                                logger.warning("Original metadata was missing key or value:" + om_node.toxml())
+                        key_value = get_original_metadata_nodes(om_node)
+                        if key_value is not None:
+                            yield annotation_id, get_text(key_value[0]), key_value[1]
             return
 
+        def iter_original_metadata(self) -> tuple[str, tuple[str, str]]:
+            """An iterator over the original metadata in structured annotations
+
+            returns (<annotation ID>, (<key, value>))
+
+            where <annotation ID> is the ID attribute of the annotation (which
+            can be used to tie an annotation to an image)
+
+                  <key> is the original metadata key, typically one of the
+                  OM_* names of a TIFF tag
+                  <value> is the value for the metadata
+            """
+            for annotation_id, key, value_node in self.index.original_metadata:
+                yield annotation_id, (key, get_text(value_node))
+
         def has_original_metadata(self, key: str) -> bool:
             """True if there is an original metadata item with the given key"""
-            return any([k == key
-                        for annotation_id, (k, v)
-                        in self.iter_original_metadata()])
+            return key in self.index.original_metadata_keys
 
         def get_original_metadata_value(self, key: str, default: str | None = None):
             """Return the value for a particular original metadata key
@@ -1425,10 +2318,10 @@ class OMEXML(object):
             key - key to search for
             default - default value to return if not found
             """
-            for annotation_id, (k, v) in self.iter_original_metadata():
-                if k == key:
-                    return v
-            return default
+            entry = self.index.original_metadata_keys.get(key)
+            if entry is None:
+                return default
+            return get_text(entry[2])
 
         def get_original_metadata_refs(self, ids: list[str]) -> dict[str, str]:
             """For a given ID, get the matching original metadata references
@@ -1463,7 +2356,7 @@ class OMEXML(object):
             return self.structured_annotations.get_original_metadata_value(key)
 
         def __setitem__(self, key: str, value: str) -> None:
-            self.structured_annotations.add_original_metadata(key, value)
+            self.update({key: value})
 
         def __contains__(self, key: str) -> bool:
             return self.has_key(key)
@@ -1473,7 +2366,7 @@ class OMEXML(object):
                 yield key
 
         def __len__(self) -> int:
-            return len(list(self.structured_annotations.iter_original_metadata()))
+            return len(self.structured_annotations.index.original_metadata)
 
         def keys(self) -> list[str]:
             return [key
@@ -1481,41 +2374,139 @@ class OMEXML(object):
                     in self.structured_annotations.iter_original_metadata()]
 
         def has_key(self, key: str) -> bool:
-            for annotation_id, (k, value) in self.structured_annotations.iter_original_metadata():
-                if k == key:
-                    return True
-            return False
+            return self.structured_annotations.has_original_metadata(key)
 
         def iteritems(self) -> tuple[str, str]:
             for annotation_id, (key, value) in self.structured_annotations.iter_original_metadata():
                 yield key, value
 
+        def to_dict(self) -> dict[str, str]:
+            """Return the original metadata as a dictionary, the first value of a repeated key wins"""
+            return {key: get_text(value_node)
+                    for key, (_, _, value_node) in self.structured_annotations.index.original_metadata_keys.items()}
+
+        def update(self, items: dict[str, str] = (), **kwargs: str) -> None:
+            """Set the values of existing keys and add the new keys in one pass"""
+            items = dict(items, **kwargs)
+            existing = self.structured_annotations.index.original_metadata_keys
+            new_items = {}
+            for key, value in items.items():
+                entry = existing.get(str(key))
+                if entry is None:
+                    new_items[key] = value
+                else:
+                    set_text(entry[2], str(value))
+            if new_items:
+                self.structured_annotations.add_original_metadata_items(new_items)
+
+    class AnnotationIndex(object):
+        """Hash indexes over the annotations of a StructuredAnnotations element
+
+        by_id maps annotation IDs to their nodes. The original metadata is
+        scanned on first use into a list of (<annotation ID>, <key>, <Value
+        node>) entries in document order and into original_metadata_keys,
+        which maps every key to its first entry. Annotations added through
+        StructuredAnnotations are added to the indexes, other edits to the
+        element must invalidate them through NamespaceContext.invalidate.
+        """
+
+        def __init__(self, structured_annotations: "OMEXML.StructuredAnnotations") -> None:
+            self.structured_annotations = structured_annotations
+            self.by_id = {}
+            for child in structured_annotations.node:
+                annotation_id = child.get("ID")
+                if annotation_id is not None:
+                    self.by_id.setdefault(annotation_id, child)
+            self._original_metadata = None
+            self._original_metadata_keys = None
+
+        def _build_original_metadata(self) -> None:
+            self._original_metadata = list(self.structured_annotations.iter_original_metadata_nodes())
+            self._original_metadata_keys = {}
+            for entry in self._original_metadata:
+                self._original_metadata_keys.setdefault(entry[1], entry)
+
+        @property
+        def original_metadata(self) -> list[tuple[str, str, ElementTree.Element]]:
+            if self._original_metadata is None:
+                self._build_original_metadata()
+            return self._original_metadata
+
+        @property
+        def original_metadata_keys(self) -> dict[str, tuple[str, str, ElementTree.Element]]:
+            if self._original_metadata_keys is None:
+                self._build_original_metadata()
+            return self._original_metadata_keys
+
+        def add(self, annotation_node: ElementTree.Element) -> None:
+            """Index an annotation appended to the element"""
+            annotation_id = annotation_node.get("ID")
+            self.by_id.setdefault(annotation_id, annotation_node)
+            if self._original_metadata is None:
+                return
+            # <XMLAnnotation><Value><OriginalMetadata>
+            for om_node in annotation_node[0]:
+                key_value = get_original_metadata_nodes(om_node)
+                if key_value is None:
+                    continue
+                entry = (annotation_id, get_text(key_value[0]), key_value[1])
+                self._original_metadata.append(entry)
+                self._original_metadata_keys.setdefault(entry[1], entry)
+
     class PlatesDucktype(object):
         """It looks like a list of plates"""
 
-        def __init__(self, root: ElementTree.Element) -> None:
+        def __init__(self, root: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             self.root = root
-            self.namespaces = get_namespaces(self.root)
+            self.namespaces = NamespaceContext.resolve(self.root, namespaces)
 
         def __getitem__(self, key: int | slice) -> "OMEXML.Plate" | list["OMEXML.Plate"]:
-            plates = self.root.findall(get_qualified_name(self.namespaces['spw'], "Plate"))
+            plates = self.root.findall(self.namespaces.qn('spw', "Plate"))
             if isinstance(key, slice):
-                return [OMEXML.Plate(plate) for plate in plates[key]]
-            return OMEXML.Plate(plates[key])
+                return [OMEXML.Plate(plate, self.namespaces) for plate in plates[key]]
+            return OMEXML.Plate(plates[key], self.namespaces)
 
         def __len__(self) -> int:
-            return len(self.root.findall(get_qualified_name(self.namespaces['spw'], "Plate")))
+            return len(self.root.findall(self.namespaces.qn('spw', "Plate")))
 
         def __iter__(self) -> "OMEXML.Plate":
-            for plate in self.root.iterfind(get_qualified_name(self.namespaces['spw'], "Plate")):
-                yield OMEXML.Plate(plate)
+            for plate in self.root.iterfind(self.namespaces.qn('spw', "Plate")):
+                yield OMEXML.Plate(plate, self.namespaces)
+
+        def get_image_locations(self) -> dict[str, tuple["OMEXML.Plate", "OMEXML.Well", "OMEXML.WellSample"]]:
+            """Map the Image IDs referenced by well samples to their (plate, well, sample)
 
-        def newPlate(self, name: str, plate_id: str =str(uuid.uuid4())) -> "OMEXML.Plate":
+            The map is built on first use with a single pass over the plates,
+            and dropped when plates, wells or samples are added or
+            an ImageRef is set through these wrappers.
+            """
+            locations = self.namespaces.plate_indexes.get(self.root)
+            if locations is None:
+                locations = self.namespaces.plate_indexes[self.root] = {}
+                qn = self.namespaces.qn
+                for plate_node in self.root.iterchildren(qn('spw', "Plate")):
+                    plate = OMEXML.Plate(plate_node, self.namespaces)
+                    for well_node in plate_node.iterchildren(qn('spw', "Well")):
+                        well = OMEXML.Well(well_node, self.namespaces)
+                        for sample_node in well_node.iterchildren(qn('spw', "WellSample")):
+                            for image_ref in sample_node.iterchildren(qn('spw', "ImageRef")):
+                                locations.setdefault(image_ref.get("ID"), (
+                                    plate, well, OMEXML.WellSample(sample_node, self.namespaces)))
+            return locations
+
+        def locate_image(self, image_id: str) -> tuple["OMEXML.Plate", "OMEXML.Well", "OMEXML.WellSample"]:
+            """Return the (plate, well, sample) of an image, raise KeyError if no well sample references it"""
+            return self.get_image_locations()[image_id]
+
+        def newPlate(self, name: str, plate_id: str | None = None) -> "OMEXML.Plate":
+            if plate_id is None:
+                plate_id = str(uuid.uuid4())
             new_plate_node = ElementTree.SubElement(
-                self.root, get_qualified_name(self.namespaces['spw'], "Plate"))
-            new_plate = OMEXML.Plate(new_plate_node)
+                self.root, self.namespaces.qn('spw', "Plate"))
+            new_plate = OMEXML.Plate(new_plate_node, self.namespaces)
             new_plate.ID = plate_id
             new_plate.Name = name
+            self.namespaces.invalidate(self.root)
             return new_plate
 
     class Plate(object):
@@ -1525,9 +2516,9 @@ class OMEXML(object):
         http://www.openmicroscopy.org/Schemas/SPW/2007-06/
         """
 
-        def __init__(self, node: ElementTree.Element) -> None:
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             self.node = node
-            self.namespaces = get_namespaces(self.node)
+            self.namespaces = NamespaceContext.resolve(self.node, namespaces)
 
         def get_ID(self) -> str:
             return self.node.get("ID")
@@ -1568,6 +2559,8 @@ class OMEXML(object):
         def set_ColumnNamingConvention(self, value: str) -> None:
             assert value in (NC_LETTER, NC_NUMBER)
             self.node.set("ColumnNamingConvention", value)
+            # the well names of the index follow the naming conventions
+            self.namespaces.plate_indexes.pop(self.node, None)
 
         ColumnNamingConvention = property(get_ColumnNamingConvention,
                                           set_ColumnNamingConvention)
@@ -1579,6 +2572,8 @@ class OMEXML(object):
         def set_RowNamingConvention(self, value: str) -> None:
             assert value in (NC_LETTER, NC_NUMBER)
             self.node.set("RowNamingConvention", value)
+            # the well names of the index follow the naming conventions
+            self.namespaces.plate_indexes.pop(self.node, None)
 
         RowNamingConvention = property(get_RowNamingConvention,
                                        set_RowNamingConvention)
@@ -1616,7 +2611,7 @@ class OMEXML(object):
         Columns = property(get_Columns, set_Columns)
 
         def get_Description(self) -> str:
-            description = self.node.find(get_qualified_name(self.namespaces['spw'], "Description"))
+            description = self.node.find(self.namespaces.qn('spw', "Description"))
             if description is None:
                 return None
             return get_text(description)
@@ -1634,13 +2629,16 @@ class OMEXML(object):
 
         def get_well_name(self, well: "OMEXML.Well") -> str:
             """Get a well's name, using the row and column convention"""
-            result = "".join([
-                "%02d" % (i + 1) if convention == NC_NUMBER
-                else "ABCDEFGHIJKLMNOP"[i]
-                for i, convention
-                in ((well.Row, self.RowNamingConvention or NC_LETTER),
-                    (well.Column, self.ColumnNamingConvention or NC_NUMBER))])
-            return result
+            return (get_well_label(well.Row, self.RowNamingConvention or NC_LETTER) +
+                    get_well_label(well.Column, self.ColumnNamingConvention or NC_NUMBER))
+
+        @property
+        def well_index(self) -> "OMEXML.WellIndex":
+            """The name, position and ID indexes of the wells, built on first use"""
+            index = self.namespaces.plate_indexes.get(self.node)
+            if index is None:
+                index = self.namespaces.plate_indexes[self.node] = OMEXML.WellIndex(self)
+            return index
 
     class WellsDucktype(dict):
         """The WellsDucktype lets you retrieve and create wells
@@ -1662,31 +2660,24 @@ class OMEXML(object):
             super().__init__()
             self.plate_node = plate.node
             self.plate = plate
-            self.ns = get_namespaces(self.plate_node)
+            self.ns = plate.namespaces
 
         def __len__(self) -> int:
-            return len(self.plate_node.findall(get_qualified_name(self.ns['spw'], "Well")))
+            return len(self.plate.well_index.wells)
 
         def __getitem__(self, key: str) ->"OMEXML.Well" | None:
-            all_wells = self.plate_node.findall(get_qualified_name(self.ns['spw'], "Well"))
+            index = self.plate.well_index
             if isinstance(key, slice):
-                return [OMEXML.Well(w) for w in all_wells[key]]
-            if hasattr(key, "__len__") and len(key) == 2:
-                well = OMEXML.Well(None)
-                for w in all_wells:
-                    well.node = w
-                    if well.Row == key[0] and well.Column == key[1]:
-                        return well
+                return [OMEXML.Well(w, self.ns) for w in index.wells[key]]
             if isinstance(key, int):
-                return OMEXML.Well(all_wells[key])
-            well = OMEXML.Well(None)
-            for w in all_wells:
-                well.node = w
-                if self.plate.get_well_name(well) == key:
-                    return well
-                if well.ID == key:
-                    return well
-            return None
+                return OMEXML.Well(index.wells[key], self.ns)
+            if not isinstance(key, str) and hasattr(key, "__len__") and len(key) == 2:
+                node = index.by_position.get(tuple(key))
+                return None if node is None else OMEXML.Well(node, self.ns)
+            node = index.by_name.get(key)
+            if node is None:
+                node = index.by_id.get(key)
+            return None if node is None else OMEXML.Well(node, self.ns)
 
         def __iter__(self) -> "OMEXML.Well":
             """Return the standard name for all wells on the plate
@@ -1694,30 +2685,65 @@ class OMEXML(object):
             for instance, 'B03' for a well with Row=1, Column=2 for a plate
             with the standard row and column naming convention
             """
-            all_wells = self.plate_node.findall(get_qualified_name(self.ns['spw'], "Well"))
-            well = OMEXML.Well(None)
-            for w in all_wells:
-                well.node = w
-                yield self.plate.get_well_name(well)
+            return iter(self.plate.well_index.names)
 
-        def new(self, row, column, well_id=str(uuid.uuid4())) -> "OMEXML.Well":
+        def new(self, row, column, well_id: str | None = None) -> "OMEXML.Well":
             """Create a new well at the given row and column
 
             row - index of well's row
             column - index of well's column
-            well_id - the ID attribute for the well
+            well_id - the ID attribute for the well, a new UUID if None
             """
+            if well_id is None:
+                well_id = str(uuid.uuid4())
             well_node = ElementTree.SubElement(
-                self.plate_node, get_qualified_name(self.ns['spw'], "Well"))
-            well = OMEXML.Well(well_node)
+                self.plate_node, self.ns.qn('spw', "Well"))
+            well = OMEXML.Well(well_node, self.ns)
             well.Row = row
             well.Column = column
             well.ID = well_id
+            index = self.ns.plate_indexes.get(self.plate_node)
+            if index is not None:
+                index.add(well_node)
+            self.ns.plate_indexes.pop(well_node.getroottree().getroot(), None)
             return well
 
+    class WellIndex(object):
+        """Hash indexes over the wells of a plate
+
+        wells lists the Well nodes in document order and names their names,
+        by_name, by_position and by_id map the well names, (row, column)
+        pairs and IDs to the nodes. Wells created through WellsDucktype.new
+        are added to the indexes, other edits to the plate must invalidate
+        them through NamespaceContext.invalidate.
+        """
+
+        def __init__(self, plate: "OMEXML.Plate") -> None:
+            self.row_convention = plate.RowNamingConvention or NC_LETTER
+            self.column_convention = plate.ColumnNamingConvention or NC_NUMBER
+            self.wells = []
+            self.names = []
+            self.by_name = {}
+            self.by_position = {}
+            self.by_id = {}
+            for well_node in plate.node.iterchildren(plate.namespaces.qn('spw', "Well")):
+                self.add(well_node)
+
+        def add(self, well_node: ElementTree.Element) -> None:
+            """Index a well appended to the plate"""
+            row, column = get_int_attr(well_node, "Row"), get_int_attr(well_node, "Column")
+            name = get_well_label(row, self.row_convention) + get_well_label(column, self.column_convention)
+            self.wells.append(well_node)
+            self.names.append(name)
+            # the first of duplicated wells wins, as in a scan
+            self.by_name.setdefault(name, well_node)
+            self.by_position.setdefault((row, column), well_node)
+            self.by_id.setdefault(well_node.get("ID"), well_node)
+
     class Well(object):
-        def __init__(self, node: ElementTree.Element) -> None:
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             self.node = node
+            self.namespaces = namespaces
 
         def get_Column(self) -> int:
             return get_int_attr(self.node, "Column")
@@ -1744,7 +2770,7 @@ class OMEXML(object):
         ID = property(get_ID, set_ID)
 
         def get_Sample(self) -> "OMEXML.WellSampleDucktype":
-            return OMEXML.WellSampleDucktype(self.node)
+            return OMEXML.WellSampleDucktype(self.node, self.namespaces)
 
         Sample = property(get_Sample)
 
@@ -1780,44 +2806,47 @@ class OMEXML(object):
         wellsamples[0:2]
         """
 
-        def __init__(self, well_node: ElementTree.Element) -> None:
+        def __init__(self, well_node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             super().__init__()
             self.well_node = well_node
-            self.ns = get_namespaces(self.well_node)
+            self.ns = NamespaceContext.resolve(self.well_node, namespaces)
 
         def __len__(self) -> int:
-            return len(self.well_node.findall(get_qualified_name(self.ns['spw'], "WellSample")))
+            return len(self.well_node.findall(self.ns.qn('spw', "WellSample")))
 
         def __getitem__(self, key: int | slice) -> "OMEXML.WellSample" | list["OMEXML.WellSample"]:
-            all_samples = self.well_node.findall(get_qualified_name(self.ns['spw'], "WellSample"))
+            all_samples = self.well_node.findall(self.ns.qn('spw', "WellSample"))
             if isinstance(key, slice):
-                return [OMEXML.WellSample(s)
+                return [OMEXML.WellSample(s, self.ns)
                         for s in all_samples[key]]
-            return OMEXML.WellSample(all_samples[int(key)])
+            return OMEXML.WellSample(all_samples[int(key)], self.ns)
 
         def __iter__(self) -> "OMEXML.WellSample":
             """Iterate through the well samples."""
-            all_samples = self.well_node.findall(get_qualified_name(self.ns['spw'], "WellSample"))
+            all_samples = self.well_node.findall(self.ns.qn('spw', "WellSample"))
             for s in all_samples:
-                yield OMEXML.WellSample(s)
+                yield OMEXML.WellSample(s, self.ns)
 
-        def new(self, wellsample_id: str =str(uuid.uuid4()), index: int | None = None) -> "OMEXML.WellSample":
-            """Create a new well sample
+        def new(self, wellsample_id: str | None = None, index: int | None = None) -> "OMEXML.WellSample":
+            """Create a new well sample, with a new UUID as ID if wellsample_id is None
             """
+            if wellsample_id is None:
+                wellsample_id = str(uuid.uuid4())
             if index is None:
                 index = reduce(max, [s.Index for s in self], -1) + 1
             new_node = ElementTree.SubElement(
-                self.well_node, get_qualified_name(self.ns['spw'], "WellSample"))
-            wellsample = OMEXML.WellSample(new_node)
+                self.well_node, self.ns.qn('spw', "WellSample"))
+            wellsample = OMEXML.WellSample(new_node, self.ns)
             wellsample.ID = wellsample_id
             wellsample.Index = index
+            self.ns.plate_indexes.pop(new_node.getroottree().getroot(), None)
 
     class WellSample(object):
         """The WellSample is a location within a well"""
 
-        def __init__(self, node: ElementTree.Element) -> None:
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             self.node = node
-            self.namespaces = get_namespaces(self.node)
+            self.namespaces = NamespaceContext.resolve(self.node, namespaces)
 
         def get_ID(self) -> str:
             return self.node.get("ID")
@@ -1863,25 +2892,26 @@ class OMEXML(object):
 
         def get_ImageRef(self) -> str:
             """Get the ID of the image of this site"""
-            ref = self.node.find(get_qualified_name(self.namespaces['spw'], "ImageRef"))
+            ref = self.node.find(self.namespaces.qn('spw', "ImageRef"))
             if ref is None:
                 return None
             return ref.get("ID")
 
         def set_ImageRef(self, value: str) -> None:
             """Add a reference to the image of this site"""
-            ref = self.node.find(get_qualified_name(self.namespaces['spw'], "ImageRef"))
+            ref = self.node.find(self.namespaces.qn('spw', "ImageRef"))
             if ref is None:
-                ref = ElementTree.SubElement(self.node, get_qualified_name(self.namespaces['spw'], "ImageRef"))
+                ref = ElementTree.SubElement(self.node, self.namespaces.qn('spw', "ImageRef"))
             ref.set("ID", value)
+            self.namespaces.plate_indexes.pop(self.node.getroottree().getroot(), None)
 
         ImageRef = property(get_ImageRef, set_ImageRef)
 
     class ROIRef(object):
 
-        def __init__(self, node: ElementTree.Element):
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None):
             self.node = node
-            self.namespaces = get_namespaces(self.node)
+            self.namespaces = NamespaceContext.resolve(self.node, namespaces)
 
         def get_ID(self) -> str:
             return self.node.get("ID")
@@ -1897,26 +2927,28 @@ class OMEXML(object):
         ID = property(get_ID, set_ID)
 
     def get_roi_count(self) -> int:
-        return len(self.root_node.findall(get_qualified_name(self.namespaces['ome'], "ROI")))
+        if self.lazy_sections is not None:
+            return self.lazy_sections.count("ROI")
+        return count_children(self.root_node, self.namespaces.qn('ome', "ROI"))
 
     def set_roi_count(self, value: int) -> None:
         """Add or remove roi nodes as needed"""
         assert value > 0
         root = self.root_node
         if self.roi_count > value:
-            roi_nodes = root.find(get_qualified_name(self.namespaces['ome'], "ROI"))
+            roi_nodes = root.find(self.namespaces.qn('ome', "ROI"))
             for roi_node in roi_nodes[value:]:
                 root.remove(roi_node)
         while (self.roi_count < value):
             iteration = self.roi_count - 1
 
-            new_roi = self.ROI(ElementTree.SubElement(root, get_qualified_name(self.namespaces['ome'], "ROI")))
+            new_roi = self.ROI(ElementTree.SubElement(root, self.namespaces.qn('ome', "ROI")), self.namespaces)
             new_roi.ID = str(iteration)
             new_roi.Name = "Marker " + str(iteration)
             new_Union = self.Union(
-                ElementTree.SubElement(new_roi.node, get_qualified_name(self.namespaces['ome'], "Union")))
+                ElementTree.SubElement(new_roi.node, self.namespaces.qn('ome', "Union")), self.namespaces)
             new_Rectangle = self.Rectangle(
-                ElementTree.SubElement(new_Union.node, get_qualified_name(self.namespaces['ome'], "Rectangle")))
+                ElementTree.SubElement(new_Union.node, self.namespaces.qn('ome', "Rectangle")), self.namespaces)
             new_Rectangle.set_ID("Shape:" + str(iteration) + ":0")
             new_Rectangle.set_TheZ(0)
             new_Rectangle.set_TheC(0)
@@ -1928,18 +2960,135 @@ class OMEXML(object):
             new_Rectangle.set_Height(512)
             new_Rectangle.set_X(0)
             new_Rectangle.set_Y(0)
+        self.namespaces.invalidate(root)
 
     roi_count = property(get_roi_count, set_roi_count)
 
     def roi(self, index: int = 0) -> "OMEXML.ROI":
         """Return an ROI node by index"""
-        return self.ROI(self.root_node.findall(get_qualified_name(self.namespaces['ome'], "ROI"))[index])
+        if self.lazy_sections is not None:
+            return self.ROI(self.lazy_sections.get("ROI", index), self.namespaces)
+        return self.ROI(self.namespaces.child(self.root_node, 'ome', "ROI", index), self.namespaces)
+
+    def _next_roi_number(self) -> int:
+        """Return one past the highest number in the ROI:<n> and Shape:<n>:<m> IDs of the ROIs"""
+        root = self.section_root("ROI")
+        namespaces = {"ome": self.namespaces['ome']}
+        # two queries, libxml2 merges the results of a union in quadratic time
+        ids = ElementTree.XPath("ome:ROI/@ID", namespaces=namespaces)(root) + \
+            ElementTree.XPath("ome:ROI/ome:Union/*/@ID", namespaces=namespaces)(root)
+        numbers = [int(match.group(1)) for match in map(ROI_NUMBER_RE.match, ids) if match is not None]
+        return max(numbers) + 1 if numbers else 0
+
+    def add_rectangles(self, rectangles, image: int | None = None) -> list[str]:
+        """Add one ROI holding a single Rectangle per row of an array, in one pass
+
+        rectangles - either an array of shape (N, 4) or (N, 7) with the
+                     columns X, Y, Width, Height and optionally TheZ, TheC
+                     and TheT, or a structured array with some of the
+                     RECTANGLE_COLUMNS fields, as returned by rectangles_table.
+                     NaN values and negative plane indices are left out,
+                     plane indices that are not whole numbers raise a
+                     ValueError.
+        image - the index of an image to link the new ROIs to with ROIRef
+                elements, the ROIs are not linked if None
+
+        The ROIs get the IDs ROI:<n> and their rectangles Shape:<n>:0,
+        numbered after the highest ROI:<n> or Shape:<n> ID already in the
+        document. Returns the IDs of the new ROIs.
+        """
+        rectangles = np.asarray(rectangles)
+        if rectangles.dtype.names is not None:
+            unknown = set(rectangles.dtype.names) - set(RECTANGLE_COLUMNS)
+            if unknown:
+                raise ValueError("Rectangle has no attribute {}".format(", ".join(sorted(unknown))))
+            columns = {name: rectangles[name] for name in RECTANGLE_COLUMNS if name in rectangles.dtype.names}
+        elif rectangles.ndim == 2 and rectangles.shape[1] in (4, 7):
+            columns = dict(zip(RECTANGLE_COLUMNS, rectangles.T))
+        else:
+            raise ValueError("rectangles has shape {}, expected (N, 4) or (N, 7)".format(rectangles.shape))
+
+        cells = []
+        for name, values in columns.items():
+            if name in PLANE_INDEX_COLUMNS:
+                indices = np.asarray(values, dtype=np.float64)
+                present = ~np.isnan(indices)
+                with np.errstate(invalid="ignore"):
+                    invalid = present & ~(np.isfinite(indices) & (indices == np.round(indices)))
+                if invalid.any():
+                    raise ValueError("Rectangle {} must be a whole number, got {}".format(
+                        name, indices[invalid][0]))
+                indices = np.where(present, indices, -1).astype(np.int64)
+                present = (indices >= 0).tolist()
+                strings = [value if keep else None
+                           for value, keep in zip(get_attr_strings(np.maximum(indices, 0)), present)]
+            else:
+                strings = get_attr_strings(values)
+            cells.append(['' if value is None else ' %s="%s"' % (name, value) for value in strings])
+
+        if self.lazy_sections is not None:
+            root = self.dom.getroot()
+        else:
+            root = self.root_node
+        first = self._next_roi_number()
+        roi_ids = ["ROI:%d" % number for number in range(first, first + len(rectangles))]
+        # the ROIs are serialized and parsed back at once, as in make_elements
+        rois = "".join('<ROI ID="%s"><Union><Rectangle ID="Shape:%d:0"%s/></Union></ROI>' % (
+            roi_id, number, "".join(row)) for number, (roi_id, row) in enumerate(
+            zip(roi_ids, zip(*cells) if cells else [()] * len(roi_ids)), first))
+        fragment = '<fragment xmlns="%s">%s</fragment>' % (self.namespaces['ome'], rois)
+        container = ElementTree.fromstring(fragment.encode("utf-8"), ElementTree.XMLParser(huge_tree=True))
+        new_rois = list(container)
+
+        # the schema puts the ROIs after the images and the structured annotations
+        position = len(root)
+        for index, child in enumerate(root):
+            if isinstance(child.tag, str) and ElementTree.QName(child).localname == "BinaryOnly":
+                position = index
+                break
+        root[position:position] = new_rois
+        if self.lazy_sections is not None:
+            for roi in new_rois:
+                self.lazy_sections.append("ROI", roi)
+        self.namespaces.invalidate(root)
+
+        if image is not None and roi_ids:
+            image_node = self.image(image).node
+            position = len(image_node)
+            for index, child in enumerate(image_node):
+                if isinstance(child.tag, str) and \
+                        ElementTree.QName(child).localname in ("MicrobeamManipulationRef", "AnnotationRef"):
+                    position = index
+                    break
+            make_elements(image_node, self.namespaces.qn('ome', "ROIRef"), {"ID": roi_ids}, index=position)
+            self.namespaces.invalidate(image_node)
+        return roi_ids
+
+    def rectangles_table(self) -> np.ndarray:
+        """Return the rectangles of every ROI as a structured array
+
+        The table has one row per Rectangle element of the ROI unions, in
+        document order, read in a single pass. Its fields are the
+        RECTANGLE_COLUMNS: X, Y, Width and Height are floats (NaN where
+        missing) and TheZ, TheC and TheT integers (-1 where missing). Other
+        shapes are left out. The table can be passed back to add_rectangles.
+        """
+        root = self.section_root("ROI")
+        rectangles = ElementTree.XPath(
+            "ome:ROI/ome:Union/ome:Rectangle", namespaces={"ome": self.namespaces['ome']})(root)
+        table = np.empty(len(rectangles), dtype=[
+            (name, np.int64 if name in PLANE_INDEX_COLUMNS else np.float64) for name in RECTANGLE_COLUMNS])
+        for name in RECTANGLE_COLUMNS:
+            missing = "-1" if name in PLANE_INDEX_COLUMNS else "nan"
+            table[name] = np.array([rectangle.get(name, missing) for rectangle in rectangles],
+                                   dtype=object).astype(table.dtype[name])
+        return table
 
     class ROI(object):
 
-        def __init__(self, node: ElementTree.Element) -> None:
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             self.node = node
-            self.namespaces = get_namespaces(self.node)
+            self.namespaces = NamespaceContext.resolve(self.node, namespaces)
 
         def get_ID(self) -> str:
             return self.node.get("ID")
@@ -1965,23 +3114,23 @@ class OMEXML(object):
         @property
         def Union(self) -> "OMEXML.Union":
             """The OME/ROI/Union element."""
-            return OMEXML.Union(self.node.find(get_qualified_name(self.namespaces['ome'], "Union")))
+            return OMEXML.Union(self.node.find(self.namespaces.qn('ome', "Union")), self.namespaces)
 
     class Union(object):
 
-        def __init__(self, node: ElementTree.Element) -> None:
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             self.node = node
-            self.namespaces = get_namespaces(self.node)
+            self.namespaces = NamespaceContext.resolve(self.node, namespaces)
 
         def Rectangle(self) -> "OMEXML.Rectangle":
             """The OME/ROI/Union element. Currently only rectangle ROIs are available."""
-            return OMEXML.Rectangle(self.node.find(get_qualified_name(self.namespaces['ome'], "Rectangle")))
+            return OMEXML.Rectangle(self.node.find(self.namespaces.qn('ome', "Rectangle")), self.namespaces)
 
     class Rectangle(object):
 
-        def __init__(self, node: ElementTree.Element) -> None:
+        def __init__(self, node: ElementTree.Element, namespaces: NamespaceContext | None = None) -> None:
             self.node = node
-            self.namespaces = get_namespaces(self.node)
+            self.namespaces = NamespaceContext.resolve(self.node, namespaces)
 
         def get_ID(self) -> str:
             return self.node.get("ID")
@@ -0,0 +1,134 @@
+# This file is part of the pyometiff library.
+
+# pyometiff is distributed under the GNU General Public License v3.0 (GNU GPLv3),
+# specific files are distributed under different licenses, please refer to the
+# file header.
+
+# Modification and redistribution is possible under the terms of the applied
+# license agreement.
+
+# This software is distributed WITHOUT ANY WARRANTY.
+# See the GNU General Public License v3.0 for further details.
+
+# A copy of the GNU General Public License v3.0 should be included in pyometiff,
+# if you didn't receive a copy, visit <http://www.gnu.org/licenses/>.
+
+# Copyright (c) 2021, Filippo Maria Castelli
+
+import sys
+import os
+import inspect
+
+import numpy as np
+import pytest
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from pyometiff.omexml import OMEXML, ElementTree
+from pyometiff import omemodel
+from pyometiff.omemodel import OMEModel
+
+
+def _canonical(xml: str) -> bytes:
+    return ElementTree.tostring(ElementTree.fromstring(xml.encode()), method="c14n2", strip_text=True)
+
+
+def _document(n_planes: int) -> OMEXML:
+    ox = OMEXML()
+    instrument = ElementTree.Element(ox.namespaces.qn('ome', "Instrument"), ID="Instrument:0")
+    ElementTree.SubElement(instrument, ox.namespaces.qn('ome', "Microscope"), Model="Eclipse")
+    ElementTree.SubElement(instrument, ox.namespaces.qn('ome', "Detector"), ID="Detector:0", Gain="2.5")
+    ox.root_node.insert(0, instrument)
+    ox.image().Name = "first & <only>"
+    ox.image().Description = "acquired by hand"
+    pixels = ox.image().Pixels
+    pixels.SizeZ = n_planes
+    pixels.channel_count = 2
+    pixels.Channel(1).Name = "GFP"
+    pixels.PhysicalSizeX = 0.65
+    pixels.populate_Planes({"DeltaT": np.arange(n_planes) * 0.5, "DeltaTUnit": "s",
+                            "PositionZ": np.arange(n_planes) * 0.25})
+    pixels.populate_TiffData(explicit=True)
+    ox.structured_annotations.add_original_metadata("Objective", "60x")
+    image_refs = np.full((2, 3, 1), None, dtype=object)
+    image_refs[1, 2, 0] = ox.image(0).ID
+    ox.build_plate(2, 3, image_refs=image_refs)
+    return ox
+
+
+class TestOMEModel:
+
+    def test_round_trip(self) -> None:
+        ox = _document(100)
+        model = OMEModel.from_omexml(ox)
+        pixels = model.images[0].pixels
+        assert len(model.images) == 1 and len(model.instruments) == 1
+        assert model.images[0].Name == "first & <only>"
+        assert (pixels.SizeZ, pixels.channels[1].Name, pixels.PhysicalSizeX) == (100, "GFP", 0.65)
+        assert pixels.planes.dtype.names == ("TheZ", "TheC", "TheT", "DeltaT", "DeltaTUnit", "PositionZ")
+        assert pixels.planes["PositionZ"][-1] == 24.75 and pixels.tiffdata["IFD"][-1] == 99
+        assert model.instruments[0].Detectors[0]["Gain"] == "2.5"
+        assert [name for name, _ in model.children] == ["Plate", "StructuredAnnotations"]
+
+        xml = model.to_xml()
+        assert _canonical(xml) == _canonical(ox.to_xml())
+        assert OMEXML(xml).plates[0].Well["B03"].Sample[0].ImageRef == ox.image(0).ID
+
+    def test_prefixed_document(self) -> None:
+        xml = ('<ome:OME xmlns:ome="http://www.openmicroscopy.org/Schemas/OME/2016-06" '
+               'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="somewhere">'
+               '<ome:Image ID="Image:0"><ome:Pixels ID="Pixels:0" DimensionOrder="XYZCT" Type="uint8" SizeX="2" '
+               'SizeY="2" SizeZ="2" SizeC="1" SizeT="1"><ome:Channel ID="Channel:0"><ome:LightPath/></ome:Channel>'
+               '<ome:TiffData><ome:UUID FileName="other.ome.tif">urn:uuid:1</ome:UUID></ome:TiffData>'
+               '<ome:Plane TheZ="0" TheC="0" TheT="0"/><ome:Plane TheZ="1" TheC="0" TheT="0" ExposureTime="1.5"/>'
+               '</ome:Pixels></ome:Image></ome:OME>')
+        model = OMEModel.from_xml(xml)
+        pixels = model.images[0].pixels
+        assert pixels.tiffdata is None and [name for name, _ in pixels.data] == ["TiffData"]
+        assert np.isnan(pixels.planes["ExposureTime"][0]) and pixels.planes["ExposureTime"][1] == 1.5
+        assert _canonical(model.to_xml()) == _canonical(xml)
+
+    def test_missing_marker_values(self) -> None:
+        xml = ('<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06"><Image ID="Image:0">'
+               '<Pixels ID="Pixels:0" DimensionOrder="XYZCT" Type="uint8" SizeX="2" SizeY="2" SizeZ="2" SizeC="1" '
+               'SizeT="1"><Channel ID="Channel:0"/><TiffData IFD="0" PlaneCount="2"/>'
+               '<Plane TheZ="0" TheC="0" TheT="0" PositionX="NaN"/><Plane TheZ="1" TheC="0" TheT="0"/>'
+               '</Pixels></Image></OME>')
+        model = OMEModel.from_xml(xml)
+        pixels = model.images[0].pixels
+        # a NaN set on a plane is not mistaken for a missing value
+        assert pixels.planes is None and len(pixels.plane_data) == 2
+        assert pixels.tiffdata["PlaneCount"][0] == 2
+        assert _canonical(model.to_xml()) == _canonical(xml)
+
+        model = OMEModel.from_xml(xml.replace('PositionX="NaN"', 'PositionX="1.5"'))
+        pixels = model.images[0].pixels
+        assert pixels.plane_data is None and np.isnan(pixels.planes["PositionX"][1])
+        assert 'PositionX' not in OMEXML(model.to_xml()).image().Pixels.Plane(1).node.attrib
+
+    def test_to_bytes(self) -> None:
+        xml = _document(1000).to_xml()
+        model = OMEModel.from_xml(xml)
+        data = model.to_bytes()
+        decoded = OMEModel.from_bytes(data)
+
+        assert _canonical(decoded.to_xml()) == _canonical(xml)
+        assert _canonical(OMEModel.from_bytes(bytearray(data)).to_xml()) == _canonical(xml)
+        pixels = decoded.images[0].pixels
+        assert pixels.planes.dtype == model.images[0].pixels.planes.dtype
+        assert np.array_equal(pixels.planes, model.images[0].pixels.planes)
+        assert pixels.planes["DeltaTUnit"][0] == "s"
+        assert pixels.PhysicalSizeXUnit is model.images[0].pixels.PhysicalSizeXUnit
+        # the decoded arrays own their memory
+        pixels.tiffdata["IFD"] += 1
+
+        with pytest.raises(ValueError):
+            OMEModel.from_bytes(xml.encode())
+        # truncated in the header length, the header and the buffers, and with trailing bytes
+        for end in (len(omemodel.BINARY_MAGIC) + 2, 20, len(data) - 1):
+            with pytest.raises(ValueError, match="truncated"):
+                OMEModel.from_bytes(data[:end])
+        with pytest.raises(ValueError, match="after the last buffer"):
+            OMEModel.from_bytes(data + b"\0")
@@ -36,7 +36,7 @@ test_img_path = parentdir_path.joinpath("tests/cell.ome.tiff")
 
 class MockedOMEXML:
 
-    def __init__(self, arg):
+    def __init__(self, arg, lazy=False):
         pass
 
     class Image:
@@ -0,0 +1,281 @@
+# This file is part of the pyometiff library.
+
+# pyometiff is distributed under the GNU General Public License v3.0 (GNU GPLv3),
+# specific files are distributed under different licenses, please refer to the
+# file header.
+
+# Modification and redistribution is possible under the terms of the applied
+# license agreement.
+
+# This software is distributed WITHOUT ANY WARRANTY.
+# See the GNU General Public License v3.0 for further details.
+
+# A copy of the GNU General Public License v3.0 should be included in pyometiff,
+# if you didn't receive a copy, visit <http://www.gnu.org/licenses/>.
+
+# Copyright (c) 2021, Filippo Maria Castelli
+
+import sys
+import os
+import inspect
+import pytest
+import tifffile
+import numpy as np
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from pyometiff.omewriter import OMETIFFWriter
+from pyometiff.omereader import OMETIFFReader
+from pyometiff.omexml import OMEXML
+from pyometiff.ometools import update_metadata, transcode, concat, extract
+
+metadata_dict = {
+    "PhysicalSizeX": 0.5,
+    "PhysicalSizeXUnit": "µm",
+    "PhysicalSizeY": 0.5,
+    "PhysicalSizeYUnit": "µm",
+    "PhysicalSizeZ": 2.0,
+    "PhysicalSizeZUnit": "µm",
+    "Channels": {
+        "405": {"Name": "405", "ExcitationWavelength": 405., "ExcitationWavelengthUnit": "nm"},
+        "488": {"Name": "488", "ExcitationWavelength": 488., "ExcitationWavelengthUnit": "nm"},
+    },
+}
+
+
+def _write(fpath, shape=(2, 3, 2, 32, 48), dimension_order="TZCYX", **kwargs):
+    array = np.random.randint(0, 255, shape).astype(np.uint8)
+    OMETIFFWriter(fpath=fpath, array=array, metadata=metadata_dict, dimension_order=dimension_order,
+                  **kwargs).write()
+    return array
+
+
+def _raw_segments(fpath):
+    with tifffile.TiffFile(fpath) as tif:
+        fh = tif.filehandle
+        return [data for page in tif.pages
+                for data, _ in fh.read_segments(page.dataoffsets, page.databytecounts)]
+
+
+class TestUpdateMetadata:
+
+    @pytest.mark.parametrize("channel_name", ["DAPI", "a much longer channel name " * 200])
+    def test_update_metadata(self, channel_name, tmp_path) -> None:
+        fpath = tmp_path.joinpath("update.ome.tiff")
+        array = _write(fpath, compression="zlib")
+        segments = _raw_segments(fpath)
+
+        update_metadata(fpath, {"PhysicalSizeX": 0.25, "Channels": {"405": {"Name": channel_name}}})
+
+        assert _raw_segments(fpath) == segments
+        array_readback, metadata_readback, _ = OMETIFFReader(fpath).read()
+        assert np.array_equal(array_readback, array)
+        assert metadata_readback["PhysicalSizeX"] == 0.25
+        assert metadata_readback["PhysicalSizeY"] == 0.5
+        assert list(metadata_readback["Channels"].keys()) == [channel_name, "488"]
+
+    def test_update_metadata_callable(self, tmp_path) -> None:
+        fpath = tmp_path.joinpath("update.ome.tiff")
+        _write(fpath)
+        update_metadata(fpath, lambda ox: ox.image().set_Name("renamed"))
+        _, metadata_readback, _ = OMETIFFReader(fpath).read()
+        assert metadata_readback["Name"] == "renamed"
+
+    def test_update_metadata_unknown_key(self, tmp_path) -> None:
+        fpath = tmp_path.joinpath("update.ome.tiff")
+        _write(fpath)
+        with pytest.raises(KeyError):
+            update_metadata(fpath, {"PhysicalSizeW": 1.0})
+
+
+class TestTranscode:
+
+    def test_transcode_passthrough(self, tmp_path) -> None:
+        src = tmp_path.joinpath("src.ome.tiff")
+        dst = tmp_path.joinpath("dst.ome.tiff")
+        array = _write(src, compression="zlib")
+        transcode(src, dst, compression="zlib")
+
+        assert _raw_segments(dst) == _raw_segments(src)
+        array_readback, metadata_readback, xml_readback = OMETIFFReader(dst).read()
+        assert np.array_equal(array_readback, array)
+        with tifffile.TiffFile(src) as tif:
+            assert xml_readback == tif.ome_metadata
+
+    @pytest.mark.parametrize("compression,tile", [("zstd", None), ("zlib", (16, 16)), (None, (16, 32))])
+    def test_transcode(self, compression, tile, tmp_path) -> None:
+        src = tmp_path.joinpath("src.ome.tiff")
+        dst = tmp_path.joinpath("dst.ome.tiff")
+        array = _write(src, compression="lzw")
+        transcode(src, dst, compression=compression, tile=tile, maxworkers=2)
+
+        with tifffile.TiffFile(dst) as tif:
+            assert len(tif.pages) == 12
+            assert tif.pages[0].compression == tifffile.COMPRESSION(
+                {"zstd": 50000, "zlib": 8, None: 1}[compression])
+            assert tif.pages[-1].is_tiled == (tile is not None)
+        array_readback, metadata_readback, _ = OMETIFFReader(dst).read()
+        assert np.array_equal(array_readback, array)
+        assert metadata_readback["PhysicalSizeZ"] == 2.0
+
+    def test_transcode_not_ome(self, tmp_path) -> None:
+        src = tmp_path.joinpath("plain.tiff")
+        tifffile.imwrite(src, np.zeros((16, 16), dtype=np.uint8), description=None, metadata=None)
+        with pytest.raises(ValueError):
+            transcode(src, tmp_path.joinpath("dst.ome.tiff"))
+
+        tifffile.imwrite(src, np.zeros((16, 16), dtype=np.uint8), description="not OME-XML", metadata=None)
+        with pytest.raises(ValueError):
+            transcode(src, tmp_path.joinpath("dst.ome.tiff"))
+
+
+class TestConcat:
+
+    @pytest.mark.parametrize("dimension_order", ["TZCYX", "CZTYX", "ZTCYX"])
+    def test_concat_T(self, dimension_order, tmp_path) -> None:
+        shape = {"T": 1, "Z": 3, "C": 2, "Y": 16, "X": 24}
+        paths = [tmp_path.joinpath("t{}.ome.tiff".format(t)) for t in range(4)]
+        arrays = []
+        for t, fpath in enumerate(paths):
+            plane_metadata = {"DeltaT": float(t), "DeltaTUnit": "s"}
+            arrays.append(_write(fpath, shape=[shape[dim] for dim in dimension_order],
+                                 dimension_order=dimension_order, compression="zlib", plane_metadata=plane_metadata))
+        out = tmp_path.joinpath("merged.ome.tiff")
+        ox = concat(paths, out, axis="T")
+
+        pixels = ox.image().Pixels
+        assert (pixels.SizeZ, pixels.SizeC, pixels.SizeT) == (3, 2, 4)
+        assert pixels.plane_count == 24
+        assert sorted(pixels.Plane(i).TheT for i in range(24)) == [t for t in range(4) for _ in range(6)]
+        assert all(pixels.Plane(i).DeltaT == pixels.Plane(i).TheT for i in range(24))
+
+        array_readback, metadata_readback, _ = OMETIFFReader(out).read()
+        expected = np.concatenate(arrays, axis=dimension_order.index("T"))
+        assert np.array_equal(array_readback, expected)
+        assert sorted(_raw_segments(out)) == sorted(sum([_raw_segments(fpath) for fpath in paths], []))
+
+    def test_concat_C(self, tmp_path) -> None:
+        paths = [tmp_path.joinpath("c{}.ome.tiff".format(c)) for c in range(2)]
+        arrays = [_write(fpath) for fpath in paths]
+        out = tmp_path.joinpath("merged.ome.tiff")
+        ox = concat(paths, out, axis="C")
+
+        array_readback, _, _ = OMETIFFReader(out).read()
+        assert np.array_equal(array_readback, np.concatenate(arrays, axis=2))
+        pixels = ox.image().Pixels
+        assert pixels.get_channel_names() == ["405", "488", "405", "488"]
+        assert pixels.Channel(3).ID == "Channel:0:3"
+
+    def test_concat_mismatch(self, tmp_path) -> None:
+        paths = [tmp_path.joinpath("a.ome.tiff"), tmp_path.joinpath("b.ome.tiff")]
+        _write(paths[0])
+        _write(paths[1], shape=(2, 3, 2, 32, 40))
+        with pytest.raises(ValueError):
+            concat(paths, tmp_path.joinpath("merged.ome.tiff"), axis="T")
+        with pytest.raises(ValueError):
+            concat(paths[:1], tmp_path.joinpath("merged.ome.tiff"), axis="X")
+
+
+class TestExtract:
+
+    @pytest.mark.parametrize("tile", [None, (16, 16)])
+    def test_extract(self, tile, tmp_path) -> None:
+        src = tmp_path.joinpath("src.ome.tiff")
+        array = _write(tmp_path.joinpath("strips.ome.tiff"), shape=(3, 4, 2, 64, 80), compression="zlib",
+                       plane_metadata={"PositionX": 100.0, "PositionXUnit": "µm", "PositionY": 10.0})
+        transcode(tmp_path.joinpath("strips.ome.tiff"), src, compression="zlib", tile=tile)
+
+        dst = tmp_path.joinpath("crop.ome.tiff")
+        ox = extract(src, dst, z=slice(1, 3), c=[1], t=2, region=(20, 8, 33, 40))
+
+        array_readback, metadata_readback, _ = OMETIFFReader(dst).read()
+        assert np.array_equal(array_readback, array[2, 1:3, 1, 8:48, 20:53])
+        assert list(metadata_readback["Channels"].keys()) == ["488"]
+        pixels = ox.image().Pixels
+        assert (pixels.SizeX, pixels.SizeY, pixels.SizeZ, pixels.SizeC, pixels.SizeT) == (33, 40, 2, 1, 1)
+        assert pixels.plane_count == 2
+        # PositionX unit matches the pixel size unit, PositionY has none
+        assert pixels.Plane(0).PositionX == 110.0
+        assert pixels.Plane(0).PositionY == 10.0
+        with tifffile.TiffFile(dst) as tif:
+            assert tif.pages[0].is_tiled == (tile is not None)
+            assert tif.pages[0].compression == tifffile.COMPRESSION.ADOBE_DEFLATE
+
+    def test_extract_reads_intersecting_tiles(self, tmp_path, monkeypatch) -> None:
+        src = tmp_path.joinpath("src.ome.tiff")
+        _write(tmp_path.joinpath("strips.ome.tiff"), shape=(1, 1, 2, 128, 128))
+        transcode(tmp_path.joinpath("strips.ome.tiff"), src, compression="zlib", tile=(32, 32))
+
+        read_indices = []
+        read_segments = tifffile.FileHandle.read_segments
+
+        def counting_read_segments(self, offsets, bytecounts, indices=None, *args, **kwargs):
+            read_indices.extend(indices)
+            return read_segments(self, offsets, bytecounts, indices, *args, **kwargs)
+
+        monkeypatch.setattr(tifffile.FileHandle, "read_segments", counting_read_segments)
+        extract(src, tmp_path.joinpath("crop.ome.tiff"), c=1, region=(40, 40, 30, 30))
+        assert sorted(read_indices) == [5, 6, 9, 10]
+
+    def test_extract_without_region(self, tmp_path) -> None:
+        src = tmp_path.joinpath("src.ome.tiff")
+        array = _write(src, compression="zlib")
+        dst = tmp_path.joinpath("planes.ome.tiff")
+        extract(src, dst, t=[1, 0])
+
+        array_readback, _, _ = OMETIFFReader(dst).read()
+        assert np.array_equal(array_readback, array[[1, 0]])
+        assert sorted(_raw_segments(dst)) == sorted(_raw_segments(src))
+
+        with pytest.raises(ValueError):
+            extract(src, dst, region=(40, 0, 16, 16))
+        with pytest.raises(IndexError):
+            extract(src, dst, c=[2])
+
+    def test_extract_without_channels(self, tmp_path) -> None:
+        src = tmp_path.joinpath("src.ome.tiff")
+        array = _write(src)
+
+        def remove_channels(ox):
+            pixels = ox.image().Pixels
+            for channel in pixels.node.findall(pixels.namespaces.qn('ome', "Channel")):
+                pixels.node.remove(channel)
+
+        update_metadata(src, remove_channels)
+        dst = tmp_path.joinpath("planes.ome.tiff")
+        ox = extract(src, dst, c=1)
+        pixels = ox.image().Pixels
+        assert pixels.SizeC == 1 and pixels.channel_count == 0
+        assert np.array_equal(tifffile.imread(dst), array[:, :, 1])
+
+    def test_extract_from_plate(self, tmp_path) -> None:
+        src = tmp_path.joinpath("src.ome.tiff")
+        array = _write(src)
+
+        def add_plate(ox):
+            # two more images sharing the pixel data of the first one, in the wells of a plate
+            ox.build_plate(1, 2)
+            for index in (1, 2):
+                ox.image(index).Pixels.populate_TiffData()
+            ox.add_rectangles(np.array([[0, 0, 4, 4]]), image=1)
+            ox.add_rectangles(np.array([[4, 4, 4, 4]]), image=2)
+
+        update_metadata(src, add_plate)
+        assert OMETIFFReader(src).read()[2] is not None
+        with tifffile.TiffFile(src) as tif:
+            assert OMEXML(tif.ome_metadata).validate().valid
+
+        dst = tmp_path.joinpath("well.ome.tiff")
+        ox = extract(src, dst, c=1, imageseries=1)
+        assert ox.image_count == 1 and ox.image().ID == "Image:0:0"
+        assert ox.image().Pixels.Channel(0).ID == "Channel:0:0"
+        assert ox.image().roiref_count == 1 and ox.roi_count == 2
+        well_samples = ox.plates[0].Well["A01"], ox.plates[0].Well["A02"]
+        assert [sample.ImageRef for well in well_samples for sample in well.Sample] == ["Image:0:0", None]
+        with tifffile.TiffFile(dst) as tif:
+            result = OMEXML(tif.ome_metadata).validate()
+        assert result.valid, result.errors
+        assert np.array_equal(tifffile.imread(dst), array[:, :, 1])
+
@@ -16,6 +16,7 @@
 # Copyright (c) 2021, Filippo Maria Castelli
 
 import os,sys,inspect
+import tracemalloc
 from pathlib import Path
 import pytest
 import tifffile
@@ -24,8 +25,9 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir)
 
-from pyometiff.omewriter import OMETIFFWriter
+from pyometiff.omewriter import OMETIFFWriter, AsyncOMETIFFWriter, InvalidDimensionOrderingError
 from pyometiff.omereader import OMETIFFReader
+from pyometiff.omexml import OMEXML
 
 #TODO: implement readback tests
 
@@ -101,6 +103,24 @@ testdata = [
     ]
 
 
+class LazyChunkedArray:
+    """Minimal chunked lazy array: indexing computes the block, converting the whole array is refused"""
+
+    def __init__(self, array):
+        self._array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.chunks = tuple((1,) * n for n in array.shape[:-2]) + tuple((n,) for n in array.shape[-2:])
+        self.requested = []
+
+    def __getitem__(self, key):
+        self.requested.append(key)
+        return self._array[key].copy()
+
+    def __array__(self, *args, **kwargs):
+        raise AssertionError("the lazy array was materialized as a whole")
+
+
 class TestOMETIFFWriter:
     
     @pytest.fixture
@@ -184,6 +204,214 @@ class TestOMETIFFWriter:
 
         # pudb.set_trace()
         
+    @pytest.mark.parametrize("dimension_order", npy_dimension_order)
+    def test_write_valid_ome(self, dimension_order, clean_fixture) -> None:
+        writer = OMETIFFWriter(fpath=test_out_path,
+                               array=np.zeros((2, 10, 3, 20, 20), dtype=np.uint8),
+                               metadata=npy_metadata_dict,
+                               dimension_order=dimension_order)
+        writer.write()
+        with tifffile.TiffFile(test_out_path) as tif:
+            result = OMEXML(tif.ome_metadata).validate()
+        assert result.valid, result.errors
+
+    def test_write_multifile(self, tmp_path) -> None:
+        array = np.arange(2 * 3 * 3 * 8 * 8, dtype=np.uint16).reshape(2, 3, 3, 8, 8)
+        plane_bytes = 8 * 8 * array.itemsize
+        fpath = tmp_path.joinpath("multi.ome.tiff")
+        writer = OMETIFFWriter(fpath=fpath,
+                               array=array,
+                               metadata=npy_metadata_dict,
+                               dimension_order="TZCYX",
+                               max_file_size=5 * plane_bytes)
+        writer.write()
+
+        assert len(writer.written_files) == 4
+        assert all(f.exists() for f in writer.written_files)
+        assert writer.written_files[1].name == "multi_1.ome.tiff"
+        for f, n_planes in zip(writer.written_files, [5, 5, 5, 3]):
+            with tifffile.TiffFile(f) as tif:
+                assert len(tif.pages) == n_planes
+
+        pixels = writer._ox.image().Pixels
+        assert pixels.tiffdata_count == 4
+        assert [pixels.Tiffdata(i).PlaneCount for i in range(4)] == [5, 5, 5, 3]
+        assert pixels.Tiffdata(1).FileName == "multi_1.ome.tiff"
+        assert (pixels.Tiffdata(3).FirstC, pixels.Tiffdata(3).FirstZ, pixels.Tiffdata(3).FirstT) == (0, 2, 1)
+
+        array_readback = tifffile.imread(fpath)
+        assert np.array_equal(array_readback, array)
+
+    def test_create_empty(self, tmp_path) -> None:
+        fpath = tmp_path.joinpath("empty.ome.tiff")
+        memmap = OMETIFFWriter.create_empty(fpath=fpath,
+                                            shape=(4, 3, 20, 20),
+                                            dtype=np.uint16,
+                                            metadata=npy_metadata_dict,
+                                            dimension_order="ZCYX")
+        assert isinstance(memmap, np.memmap)
+        assert memmap.shape == (1, 4, 3, 20, 20)
+
+        # a second mapping, as another process would open it
+        other = tifffile.memmap(fpath)
+        memmap[0, :2] = 1
+        other[2:] = 2
+        memmap.flush()
+        other.flush()
+        del memmap, other
+
+        array_readback, metadata_readback, _ = OMETIFFReader(fpath).read()
+        expected = np.repeat([1, 1, 2, 2], 3 * 20 * 20).reshape(4, 3, 20, 20)
+        assert np.array_equal(array_readback, expected)
+        assert metadata_readback["SizeZ"] == 4
+        assert metadata_readback["SizeC"] == 3
+
+    def test_write_plane_metadata(self, clean_fixture) -> None:
+        array = np.zeros((2, 4, 3, 20, 20), dtype=np.uint8)
+        plane_metadata = {
+            "DeltaT": np.arange(24, dtype=float),
+            "DeltaTUnit": "s",
+            "PositionZ": np.broadcast_to(np.arange(4.)[:, None, None], (4, 3, 2)),
+        }
+        writer = OMETIFFWriter(fpath=test_out_path,
+                               array=array,
+                               metadata=npy_metadata_dict,
+                               dimension_order="TZCYX",
+                               plane_metadata=plane_metadata)
+        writer.write()
+
+        reader = OMETIFFReader(test_out_path)
+        reader.read()
+        pixels = reader.ox.image().Pixels
+        assert pixels.plane_count == 24
+        plane = pixels.Plane(17)
+        assert (plane.TheC, plane.TheZ, plane.TheT) == (2, 1, 1)
+        assert plane.DeltaT == 17.0
+        assert plane.DeltaTUnit == "s"
+        assert plane.PositionZ == 1.0
+
+    def test_write_planes(self, clean_fixture) -> None:
+        array = np.random.randint(0, 255, (2, 4, 3, 20, 20)).astype(np.uint8)
+        writer = OMETIFFWriter(fpath=test_out_path,
+                               array=None,
+                               metadata=npy_metadata_dict,
+                               dimension_order="TZCYX",
+                               arr_shape=list(array.shape),
+                               arr_dtype=array.dtype,
+                               compression="zlib")
+        writer.write_planes(iter(array.reshape(-1, 20, 20)))
+        assert np.array_equal(tifffile.imread(test_out_path), array)
+
+    @pytest.mark.parametrize("container", [list, tuple])
+    def test_write_planes_shape_untouched(self, container, clean_fixture) -> None:
+        array = np.random.randint(0, 255, (2, 20, 24, 3)).astype(np.uint8)
+        arr_shape = container(array.shape)
+        writer = OMETIFFWriter(fpath=test_out_path,
+                               array=None,
+                               metadata=npy_metadata_dict,
+                               dimension_order="ZYXC",
+                               arr_shape=arr_shape,
+                               arr_dtype=array.dtype)
+        # the shape given is not reordered, YX are moved last in the writer's own copy
+        assert arr_shape == container([2, 20, 24, 3]) and writer.arr_shape is arr_shape
+        planes = np.moveaxis(array, 3, 1)
+        writer.write_planes(iter(planes.reshape(-1, 20, 24)))
+        assert np.array_equal(tifffile.imread(test_out_path), planes)
+
+    def test_write_without_array(self, clean_fixture) -> None:
+        writer = OMETIFFWriter(fpath=test_out_path,
+                               array=None,
+                               metadata=npy_metadata_dict,
+                               dimension_order="ZCYX",
+                               arr_shape=[2, 3, 20, 20],
+                               arr_dtype=np.uint8)
+        with pytest.raises(ValueError):
+            writer.write()
+
+    def test_async_writer(self, clean_fixture) -> None:
+        array = np.random.randint(0, 255, (2, 4, 3, 20, 20)).astype(np.uint8)
+        writer = OMETIFFWriter(fpath=test_out_path,
+                               array=None,
+                               metadata=npy_metadata_dict,
+                               dimension_order="TZCYX",
+                               arr_shape=list(array.shape),
+                               arr_dtype=array.dtype)
+        with AsyncOMETIFFWriter(writer, max_queue_size=2) as async_writer:
+            for plane in array.reshape(-1, 20, 20):
+                async_writer.submit_plane(plane)
+
+        statistics = async_writer.statistics
+        assert statistics["submitted"] == statistics["written"] == 24
+        assert statistics["max_queue_depth"] <= 2
+        assert statistics["max_latency"] >= statistics["mean_latency"] > 0
+        assert np.array_equal(tifffile.imread(test_out_path), array)
+
+    def test_async_writer_error(self, clean_fixture) -> None:
+        writer = OMETIFFWriter(fpath=test_out_path,
+                               array=None,
+                               metadata=npy_metadata_dict,
+                               dimension_order="ZCYX",
+                               arr_shape=[2, 3, 20, 20],
+                               arr_dtype=np.uint8)
+        with pytest.raises(ValueError):
+            # leaving the block closes the writer and joins its thread, whichever call raised
+            with AsyncOMETIFFWriter(writer, max_queue_size=1) as async_writer:
+                for _ in range(6):
+                    async_writer.submit_plane(np.zeros((10, 10)))
+        assert not async_writer._thread.is_alive()
+
+    @pytest.mark.parametrize("dimension_order, on_disk_order", [("ZYXC", "ZCYX"), ("TCXY", "TCYX"), ("YXZ", "ZYX")])
+    def test_write_any_axis_order(self, dimension_order, on_disk_order, clean_fixture) -> None:
+        sizes = {"T": 2, "C": 3, "Z": 4, "Y": 20, "X": 30}
+        array = np.random.randint(0, 255, [sizes[d] for d in dimension_order]).astype(np.uint8)
+        writer = OMETIFFWriter(fpath=test_out_path,
+                               array=array,
+                               metadata={},
+                               dimension_order=dimension_order)
+        writer.write()
+
+        reader = OMETIFFReader(test_out_path)
+        array_readback, metadata_readback, _ = reader.read()
+        expected = np.transpose(array, [dimension_order.find(d) for d in on_disk_order])
+        assert np.array_equal(array_readback, expected)
+        for dim in on_disk_order:
+            assert metadata_readback["Size" + dim] == sizes[dim]
+
+    def test_write_transposed_without_copy(self, clean_fixture) -> None:
+        array = np.zeros((8, 256, 256, 4), dtype=np.uint16)
+        writer = OMETIFFWriter(fpath=test_out_path,
+                               array=array,
+                               metadata={},
+                               dimension_order="ZYXC")
+        tracemalloc.start()
+        writer.write()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert peak < array.nbytes / 4
+        assert tifffile.imread(test_out_path).shape == (8, 4, 256, 256)
+
+    def test_invalid_dimension_order(self) -> None:
+        with pytest.raises(InvalidDimensionOrderingError):
+            OMETIFFWriter(fpath=test_out_path,
+                          array=np.zeros((2, 3, 4)),
+                          metadata={},
+                          dimension_order="ZCY")
+
+    @pytest.mark.parametrize("blocks_in_flight", [1, 4])
+    def test_write_chunked_array(self, blocks_in_flight, clean_fixture) -> None:
+        array = np.random.randint(0, 255, (3, 20, 30, 4)).astype(np.uint8)
+        lazy_array = LazyChunkedArray(array)
+        writer = OMETIFFWriter(fpath=test_out_path,
+                               array=lazy_array,
+                               metadata={},
+                               dimension_order="ZYXC",
+                               blocks_in_flight=blocks_in_flight)
+        writer.write()
+
+        assert len(lazy_array.requested) == 3 * 4
+        assert all(isinstance(key[0], int) and isinstance(key[3], int) for key in lazy_array.requested)
+        assert np.array_equal(tifffile.imread(test_out_path), np.moveaxis(array, 3, 1))
+
     @staticmethod
     def _remove_s_from_dim_order(dim_order):
         if "S" in dim_order:
@@ -0,0 +1,627 @@
+# This file is part of the pyometiff library.
+
+# pyometiff is distributed under the GNU General Public License v3.0 (GNU GPLv3),
+# specific files are distributed under different licenses, please refer to the
+# file header.
+
+# Modification and redistribution is possible under the terms of the applied
+# license agreement.
+
+# This software is distributed WITHOUT ANY WARRANTY.
+# See the GNU General Public License v3.0 for further details.
+
+# A copy of the GNU General Public License v3.0 should be included in pyometiff,
+# if you didn't receive a copy, visit <http://www.gnu.org/licenses/>.
+
+# Copyright (c) 2021, Filippo Maria Castelli
+
+import sys
+import os
+import inspect
+import io
+import time
+
+import numpy as np
+import pytest
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from benchmarks.omexml_benchmark import baseline_pixels, compare_tiffdata, populate_TiffData_baseline
+from pyometiff import omexml
+from pyometiff.omexml import OMEXML, ElementTree, get_plane_indices, get_qualified_name
+
+
+def _pixels(size_z, size_c, size_t, dimension_order="XYCZT"):
+    ox = OMEXML()
+    pixels = ox.image().Pixels
+    pixels.SizeZ = size_z
+    pixels.SizeC = size_c
+    pixels.SizeT = size_t
+    pixels.DimensionOrder = dimension_order
+    return ox, pixels
+
+
+class TestOMEXML:
+
+    def test_get_plane_indices(self) -> None:
+        the_z, the_c, the_t = get_plane_indices("XYZTC", size_z=3, size_c=2, size_t=4)
+        assert list(the_z[:4]) == [0, 1, 2, 0]
+        assert list(the_t[:4]) == [0, 0, 0, 1]
+        assert list(the_c[11:13]) == [0, 1]
+
+    def test_populate_TiffData_explicit(self) -> None:
+        _, pixels = _pixels(3, 2, 4, "XYZTC")
+        pixels.populate_TiffData(explicit=True)
+        assert pixels.tiffdata_count == 24
+        the_z, the_c, the_t = get_plane_indices("XYZTC", 3, 2, 4)
+        for ifd in (0, 5, 23):
+            tiffdata = pixels.Tiffdata(ifd)
+            assert tiffdata.IFD == ifd
+            assert tiffdata.PlaneCount == 1
+            assert (tiffdata.FirstZ, tiffdata.FirstC, tiffdata.FirstT) == (the_z[ifd], the_c[ifd], the_t[ifd])
+
+        pixels.populate_TiffData(explicit=False)
+        assert pixels.tiffdata_count == 1
+        assert pixels.Tiffdata(0).PlaneCount == 24
+
+    def test_populate_Planes(self) -> None:
+        _, pixels = _pixels(3, 2, 4)
+        pixels.populate_Planes()
+        pixels.populate_TiffData(explicit=True)
+        assert pixels.plane_count == 24
+        assert (pixels.Plane(3).TheZ, pixels.Plane(3).TheC, pixels.Plane(3).TheT) == (1, 1, 0)
+
+        # TiffData must come before the Plane elements
+        tags = [child.tag.split("}")[1] for child in pixels.node]
+        assert tags.index("Plane") > max(idx for idx, tag in enumerate(tags) if tag == "TiffData")
+
+    def test_populate_Planes_columns(self) -> None:
+        _, pixels = _pixels(3, 2, 4)
+        delta_t = np.arange(24) * 0.5
+        exposure = np.full((3, 2, 4), 0.01)
+        exposure[1, 0, 2] = np.nan
+        pixels.populate_Planes({"DeltaT": delta_t, "DeltaTUnit": "s", "ExposureTime": exposure})
+
+        plane = pixels.Plane(7)
+        assert plane.DeltaT == 3.5
+        assert plane.DeltaTUnit == "s"
+        assert plane.ExposureTime == 0.01
+        the_z, the_c, the_t = get_plane_indices("XYCZT", 3, 2, 4)
+        missing = int(np.flatnonzero((the_z == 1) & (the_c == 0) & (the_t == 2))[0])
+        assert pixels.Plane(missing).ExposureTime is None
+
+        table = np.zeros((3, 2, 4), dtype=[("PositionX", "f8"), ("PositionY", "f8")])
+        table["PositionX"] = np.arange(3)[:, None, None]
+        pixels.populate_Planes(table)
+        assert pixels.plane_count == 24
+        assert pixels.Plane(4).TheZ == 2
+        assert pixels.Plane(4).PositionX == 2.0
+
+        with pytest.raises(ValueError):
+            pixels.populate_Planes({"DeltaT": np.arange(5)})
+        with pytest.raises(ValueError):
+            pixels.populate_Planes({"Exposure": 1.0})
+
+    def test_populate_TiffData_bulk(self) -> None:
+        _, pixels = _pixels(5, 4, 6, "XYZCT")
+        pixels.populate_TiffData(explicit=True)
+        the_z, the_c, the_t = get_plane_indices("XYZCT", 5, 4, 6)
+        nodes = pixels.node.iterchildren(pixels.namespaces.qn('ome', "TiffData"))
+        rows = [tuple(int(node.get(key)) for key in ("IFD", "FirstZ", "FirstC", "FirstT", "PlaneCount"))
+                for node in nodes]
+        assert rows == list(zip(range(120), the_z.tolist(), the_c.tolist(), the_t.tolist(), [1] * 120))
+
+    @pytest.mark.benchmark
+    def test_populate_TiffData_benchmark(self) -> None:
+        # the previous engine on xml.etree, see benchmarks/omexml_benchmark.py; the bound is loose for busy machines
+        count, baseline_time, bulk_time = compare_tiffdata(10, 4, 250)
+        assert count == 10 * 4 * 250
+        assert bulk_time < 1.5 * baseline_time
+
+        baseline = baseline_pixels(3, 2, 4)
+        populate_TiffData_baseline(baseline)
+        _, pixels = _pixels(3, 2, 4)
+        pixels.populate_TiffData(explicit=True)
+        assert [dict(node.attrib) for node in baseline if node.tag.endswith("TiffData")] == \
+            [dict(node.attrib) for node in pixels.node.iterchildren(pixels.namespaces.qn('ome', "TiffData"))]
+
+    def test_comments_are_kept(self) -> None:
+        ox, pixels = _pixels(1, 1, 3)
+        pixels.populate_Planes({"DeltaT": [0.0, 1.0, 2.0]})
+        pixels.node.insert(0, ElementTree.Comment(" acquired by hand "))
+        pixels.node.insert(3, ElementTree.Comment(" between planes "))
+
+        ox = OMEXML(ox.to_xml())
+        pixels = ox.image().Pixels
+        assert pixels.plane_count == 3
+        assert [pixels.Plane(i).DeltaT for i in range(3)] == [0.0, 1.0, 2.0]
+        assert pixels.Plane(-1).DeltaT == 2.0
+        with pytest.raises(IndexError):
+            pixels.Plane(3)
+        assert "<!-- between planes -->" in ox.to_xml()
+
+    def test_namespaces_resolved_once(self, monkeypatch) -> None:
+        ox, pixels = _pixels(1000, 4, 1)
+        pixels.channel_count = 4
+        pixels.populate_Planes()
+        ox = OMEXML(ox.to_xml())
+
+        calls = []
+        get_namespaces = omexml.get_namespaces
+        monkeypatch.setattr(omexml, "get_namespaces", lambda node: calls.append(node) or get_namespaces(node))
+        pixels = ox.image().Pixels
+        names = pixels.get_channel_names()
+        the_z = [pixels.Plane(i).TheZ for i in range(0, pixels.plane_count, 100)]
+
+        assert len(names) == 4
+        assert the_z == list(range(0, 1000, 25))
+        assert pixels.Plane(0).ns is pixels.Channel(0).namespaces is ox.namespaces
+        assert calls == []
+
+    def test_child_indexes_invalidated(self) -> None:
+        ox, pixels = _pixels(2, 1, 3)
+        pixels.populate_Planes({"DeltaT": np.arange(6) * 1.0})
+        assert pixels.Plane(5).DeltaT == 5.0
+
+        pixels.plane_count = 4
+        assert pixels.plane_count == 4
+        with pytest.raises(IndexError):
+            pixels.Plane(4)
+        pixels.plane_count = 7
+        assert pixels.Plane(6).DeltaT is None
+
+        assert pixels.Channel(0).SamplesPerPixel == 1
+        pixels.channel_count = 3
+        pixels.Channel(2).Name = "third"
+        assert pixels.get_channel_names()[2] == "third"
+        pixels.channel_count = 1
+        assert pixels.channel_count == 1
+
+        pixels.populate_TiffData(explicit=True)
+        assert pixels.tiffdata_count == 6
+        assert pixels.Tiffdata(5).IFD == 5
+        pixels.populate_TiffData(explicit=False)
+        assert pixels.tiffdata_count == 1
+        assert pixels.Tiffdata(0).PlaneCount == 6
+        pixels.tiffdata_count = 2
+        assert pixels.Tiffdata(1).IFD is None
+
+        # the index is shared by every wrapper of the same document
+        assert ox.image().Pixels.plane_count == 7
+        plane = pixels.node.findall(get_qualified_name(pixels.namespaces["ome"], "Plane"))[0]
+        pixels.node.remove(plane)
+        assert pixels.Plane(0).DeltaT == 1.0
+
+    def test_indexed_access(self) -> None:
+        ox, pixels = _pixels(10 ** 4, 1, 1)
+        pixels.populate_Planes({"PositionZ": np.arange(10 ** 4) * 1.0})
+        pixels.populate_TiffData(explicit=True)
+        pixels = OMEXML(ox.to_xml()).image().Pixels
+        positions = [pixels.Plane(i).PositionZ for i in range(pixels.plane_count)]
+        ifds = [pixels.Tiffdata(i).IFD for i in range(pixels.tiffdata_count)]
+        assert positions == list(range(10 ** 4))
+        assert ifds == list(range(10 ** 4))
+
+        # children added without the wrappers are picked up too
+        plane = ElementTree.SubElement(pixels.node, pixels.namespaces.qn('ome', "Plane"), PositionZ="-1")
+        assert pixels.plane_count == 10 ** 4 + 1
+        assert pixels.Plane(10 ** 4).PositionZ == -1
+        pixels.node.remove(plane)
+        pixels.node.insert(0, plane)
+        assert pixels.Plane(0).PositionZ == -1 and pixels.Plane(1).PositionZ == 0
+
+        # children inserted in the middle need the index to be dropped
+        pixels.Plane(2).node.addprevious(ElementTree.Element(pixels.namespaces.qn('ome', "Plane"), PositionZ="99"))
+        pixels.namespaces.invalidate(pixels.node)
+        assert [pixels.Plane(i).PositionZ for i in range(4)] == [-1, 0, 99, 1]
+
+    def test_indexed_access_scaling(self) -> None:
+        # reading every plane by index takes linear time, the ratio would be about 100 in quadratic time
+        timings = []
+        for n_planes in (10 ** 4, 10 ** 5):
+            ox, pixels = _pixels(n_planes, 1, 1)
+            pixels.populate_Planes({"PositionZ": np.arange(n_planes) * 1.0})
+            pixels = OMEXML(ox.to_xml()).image().Pixels
+            best = float("inf")
+            for _ in range(3):
+                start = time.perf_counter()
+                positions = [pixels.Plane(i).PositionZ for i in range(n_planes)]
+                best = min(best, time.perf_counter() - start)
+            assert positions[-1] == n_planes - 1
+            timings.append(best)
+        assert timings[1] < 30 * timings[0]
+
+    def test_plane_table(self) -> None:
+        ox, pixels = _pixels(3, 2, 4)
+        exposure = np.full((3, 2, 4), 0.01)
+        exposure[1, 0, 2] = np.nan
+        pixels.populate_Planes({"DeltaT": np.arange(24) * 0.5, "DeltaTUnit": "s", "ExposureTime": exposure,
+                                "PositionZ": np.arange(3)[:, None, None] * np.ones((3, 2, 4))})
+        table = OMEXML(ox.to_xml()).image().Pixels.plane_table()
+
+        the_z, the_c, the_t = get_plane_indices("XYCZT", 3, 2, 4)
+        assert table.shape == (24,)
+        assert np.array_equal(table["TheZ"], the_z)
+        assert np.array_equal(table["TheC"], the_c)
+        assert np.array_equal(table["TheT"], the_t)
+        assert np.array_equal(table["DeltaT"], np.arange(24) * 0.5)
+        assert np.all(table["DeltaTUnit"] == "s")
+        assert np.all(table["ExposureTimeUnit"] == "")
+        assert np.isnan(table["ExposureTime"][(the_z == 1) & (the_c == 0) & (the_t == 2)]).all()
+        assert np.array_equal(table["PositionZ"], the_z.astype(float))
+        assert np.isnan(table["PositionX"]).all()
+
+        # the table round-trips through populate_Planes
+        pixels.populate_Planes(table)
+        assert pixels.plane_table().tobytes() == table.tobytes()
+        assert pixels.Plane(0).ExposureTimeUnit is None
+
+        pixels.plane_count = 0
+        assert pixels.plane_table().shape == (0,)
+
+    def test_iterparse(self, tmp_path) -> None:
+        ox = OMEXML()
+        ox.image_count = 3
+        for index in range(3):
+            pixels = ox.image(index).Pixels
+            pixels.SizeZ = 10 * (index + 1)
+            pixels.populate_Planes({"PositionZ": np.arange(pixels.SizeZ) * 1.0})
+            pixels.populate_TiffData(explicit=True)
+        for key in range(100):
+            ox.structured_annotations.add_original_metadata("key%d" % key, "value")
+        xml = ox.to_xml()
+        fpath = tmp_path / "large.ome.xml"
+        fpath.write_text(xml, encoding="utf-8")
+
+        sizes = []
+        for image in OMEXML.iter_images(fpath):
+            # the elements parsed before the image being read are released, except the instruments
+            assert all(node.tag.endswith("}Instrument") for node in image.node.itersiblings(preceding=True))
+            assert image.Pixels.plane_count == image.Pixels.tiffdata_count == 0
+            sizes.append(image.Pixels.SizeZ)
+        assert sizes == [10, 20, 30]
+        assert [image.Pixels.plane_count for image in OMEXML.iter_images(xml, headers_only=False)] == [10, 20, 30]
+
+        single = OMEXML.parse_image(xml.encode(), 1)
+        assert single.image_count == 1
+        assert single.image().ID == ox.image(1).ID
+        assert single.image().Pixels.Plane(19).PositionZ == 19.0
+        assert single.root_node.find(single.namespaces.qn('sa', "StructuredAnnotations")) is None
+        assert OMEXML(single.to_xml()).image().Pixels.tiffdata_count == 20
+
+        with open(fpath, "rb") as fh:
+            assert OMEXML.parse_image(fh, 2, headers_only=True).image().Pixels.plane_count == 0
+        with pytest.raises(IndexError):
+            OMEXML.parse_image(xml, 3)
+
+    def test_lazy(self) -> None:
+        ox = OMEXML()
+        ox.image_count = 3
+        for index in range(3):
+            ox.image(index).Pixels.SizeT = 4
+            ox.image(index).Pixels.populate_Planes({"DeltaT": np.arange(4) * 1.0})
+        for key in range(100):
+            ox.structured_annotations.add_original_metadata("key%d" % key, "a > b")
+        ox.roi_count = 2
+        xml = ox.to_xml()
+
+        lazy = OMEXML(xml, lazy=True)
+        sections = lazy.lazy_sections
+        assert lazy.image_count == 3
+        assert lazy.roi_count == 2
+        assert lazy.UUID == ox.UUID
+        assert lazy.image(1).ID == ox.image(1).ID
+        assert lazy.image(-1).Pixels.Plane(3).DeltaT == 3.0
+        # only the images that were accessed are parsed
+        assert sections.pending == len(sections.ranges) - 2
+        assert lazy.structured_annotations.OriginalMetadata["key99"] == "a > b"
+        assert lazy.roi(1).ID == ox.roi(1).ID
+
+        assert lazy.to_xml() == xml
+        assert lazy.lazy_sections is None
+        assert lazy.image_count == 3
+
+    def test_lazy_markup_in_sections(self) -> None:
+        ox = OMEXML()
+        ox.image_count = 2
+        ox.roi_count = 1
+        xml = ox.to_xml()
+        # section tags inside CDATA, comments and processing instructions, within and between the sections
+        xml = xml.replace("<Pixels", '<Description><![CDATA[ </Image><Image ID="fake"> ]]></Description><Pixels', 1)
+        xml = xml.replace("</Pixels>", '<!-- </Image> <ROI ID="fake"> --></Pixels>', 1)
+        xml = xml.replace("<Image", '<?note <Image ID="fake"/> ?><!-- <Image ID="fake"/> --><Image', 1)
+        xml = xml.replace("</OME>", '<!-- <Plate ID="fake"> --></OME>')
+
+        eager = OMEXML(xml)
+        lazy = OMEXML(xml, lazy=True)
+        assert lazy.lazy_sections is not None
+        assert (lazy.image_count, lazy.roi_count) == (eager.image_count, eager.roi_count) == (2, 1)
+        assert [lazy.image(i).ID for i in range(2)] == [eager.image(i).ID for i in range(2)]
+        description = lazy.image(0).node.find(lazy.namespaces.qn('ome', "Description"))
+        assert description.text.strip() == '</Image><Image ID="fake">'
+        assert lazy.to_xml() == eager.to_xml()
+
+    def test_to_bytes(self, tmp_path) -> None:
+        ox, pixels = _pixels(2, 1, 1)
+        pixels.Channel(0).Name = "GFP µ"
+        pixels.populate_Planes()
+        assert ox.to_bytes() == ox.to_xml().encode()
+
+        buffer = io.BytesIO()
+        ox.write_to(buffer)
+        assert buffer.getvalue() == ox.to_bytes()
+
+        pretty = ox.to_bytes(pretty=True)
+        assert pretty.count(b"\n") > ox.to_bytes().count(b"\n")
+        ox.write_to(tmp_path / "pretty.xml", pretty=True)
+        assert (tmp_path / "pretty.xml").read_bytes() == pretty
+        assert OMEXML(pretty).image().Pixels.Channel(0).Name == "GFP µ"
+
+    def test_original_metadata_index(self) -> None:
+        ox = OMEXML()
+        original_metadata = ox.structured_annotations.OriginalMetadata
+        items = {"key%d" % i: "value & %d" % i for i in range(50000)}
+        original_metadata.update(items)
+        ox = OMEXML(ox.to_xml())
+        original_metadata = ox.structured_annotations.OriginalMetadata
+        assert original_metadata.to_dict() == items
+        assert all(original_metadata[key] == value for key, value in items.items())
+        assert len(original_metadata) == 50000
+
+        # the indexes follow the annotations added afterwards
+        node_id = ox.structured_annotations.add_original_metadata("extra", "1")
+        assert "extra" in original_metadata
+        assert ox.structured_annotations[node_id].get("ID") == node_id
+        original_metadata["key7"] = "replaced"
+        original_metadata.update({"key8": "updated", "new": "2"})
+        assert (original_metadata["key7"], original_metadata["key8"], original_metadata["new"]) == \
+            ("replaced", "updated", "2")
+        assert len(original_metadata) == 50002
+        assert OMEXML(ox.to_xml()).structured_annotations.OriginalMetadata["key7"] == "replaced"
+
+        sa = ox.structured_annotations
+        sa.node.remove(sa[node_id])
+        ox.namespaces.invalidate(sa.node)
+        assert node_id not in sa
+        assert "extra" not in original_metadata
+        with pytest.raises(IndexError):
+            sa[node_id]
+
+    def test_well_index(self) -> None:
+        ox = OMEXML()
+        plate = ox.plates.newPlate("plate", "Plate:0")
+        for row in range(32):
+            for column in range(48):
+                well = plate.Well.new(row, column, "Well:%d:%d" % (row, column))
+                well.Sample.new("WellSample:%d:%d" % (row, column), 0)
+                well.Sample[0].ImageRef = "Image:%d" % (row * 48 + column)
+        ox = OMEXML(ox.to_xml())
+        plate = ox.plates[0]
+
+        names = list(plate.Well)
+        wells = [plate.Well[name] for name in names]
+        locations = [ox.plates.locate_image(well.Sample[0].ImageRef) for well in wells]
+
+        assert len(plate.Well) == 1536
+        assert names[:2] == ["A01", "A02"] and names[-1] == "AF48"
+        assert plate.Well["AF48"].ID == plate.Well[31, 47].ID == plate.Well["Well:31:47"].ID == "Well:31:47"
+        assert plate.Well["B03"].Row == 1 and plate.Well["B03"].Column == 2
+        assert plate.Well["Z99"] is None and plate.Well[40, 0] is None
+        assert [well.ID for well in wells] == [located.ID for _, located, _ in locations]
+        assert locations[100][2].ID == "WellSample:2:4"
+        with pytest.raises(KeyError):
+            ox.plates.locate_image("Image:missing")
+
+        # the indexes follow the wells and samples added afterwards
+        well = plate.Well.new(40, 0, "Well:40:0")
+        well.Sample.new("WellSample:40:0", 0)
+        well.Sample[0].ImageRef = "Image:new"
+        assert plate.Well["AO01"].ID == "Well:40:0"
+        assert ox.plates.locate_image("Image:new")[1].ID == "Well:40:0"
+
+        # and the naming conventions
+        plate.RowNamingConvention = omexml.NC_NUMBER
+        plate.ColumnNamingConvention = omexml.NC_LETTER
+        assert plate.Well["0203"] is None and plate.Well["02C"].ID == "Well:1:2"
+        assert list(plate.Well)[0] == "01A"
+
+    def test_get_well_label(self) -> None:
+        labels = [omexml.get_well_label(index, omexml.NC_LETTER) for index in (0, 25, 26, 701, 702, 18277, 18278)]
+        assert labels == ["A", "Z", "AA", "ZZ", "AAA", "ZZZ", "AAAA"]
+        assert omexml.get_well_label(702, omexml.NC_NUMBER) == "703"
+
+    def test_build_plate(self) -> None:
+        ox = OMEXML()
+        ox.image().Pixels.populate_TiffData()
+        first_id = ox.image().ID
+        plate = ox.build_plate(16, 24, 4)
+
+        ox = OMEXML(ox.to_xml())
+        plate = ox.plates[0]
+        tags = [ElementTree.QName(child).localname for child in ox.root_node if isinstance(child.tag, str)]
+        assert tags.index("Plate") < tags.index("Image")
+        assert (plate.ID, plate.Rows, plate.Columns, len(plate.Well)) == ("Plate:0", 16, 24, 384)
+        assert len({well.ID for well in plate.Well[:]}) == 384
+        well = plate.Well["P24"]
+        assert (well.Row, well.Column, len(well.Sample)) == (15, 23, 4)
+        assert [sample.Index for sample in well.Sample] == [1533, 1534, 1535, 1536]
+        # the images are added after the existing one, which is left alone
+        assert ox.image_count == 1537
+        assert ox.image(0).ID == first_id and ox.image(0).Pixels.tiffdata_count == 1
+        image = ox.image(1536)
+        assert (image.ID, image.Name) == (well.Sample[3].ImageRef, "P24_3")
+        assert image.Pixels.Channel(0).ID == "Channel:0:1535:0"
+        assert image.Pixels.tiffdata_count == 0
+        assert ox.plates.locate_image(image.ID)[1].ID == well.ID
+
+        refs = np.full((2, 3, 1), None, dtype=object)
+        refs[1, 2, 0] = ox.image(0).ID
+        second = ox.build_plate(2, 3, image_refs=refs, name="second")
+        assert (second.ID, len(second.Well), ox.image_count) == ("Plate:1", 6, 1537)
+        assert second.Well["B03"].Sample[0].ImageRef == ox.image(0).ID
+        assert second.Well["A01"].Sample[0].ImageRef is None
+        with pytest.raises(ValueError):
+            ox.build_plate(2, 3, image_refs=refs[:, :2])
+
+        ids = {ox.plates.newPlate("new").ID, ox.plates.newPlate("new").ID}
+        assert len(ids) == 2
+
+    def test_build_plates_keep_images(self) -> None:
+        ox = OMEXML()
+        first = ox.build_plate(2, 2)
+        second = ox.build_plate(1, 3, 2)
+        ox = OMEXML(ox.to_xml())
+        assert ox.image_count == 1 + 4 + 6
+        image_ids = {ox.image(index).ID for index in range(ox.image_count)}
+        for plate in ox.plates:
+            for well in plate.Well[:]:
+                for sample in well.Sample:
+                    assert sample.ImageRef in image_ids
+                    assert ox.image(sample.Index).ID == sample.ImageRef
+        assert (first.ID, second.ID) == ("Plate:0", "Plate:1")
+
+        # the images of a plate with the ID of an existing one would clash
+        ox.plates[1].node.getparent().remove(ox.plates[1].node)
+        with pytest.raises(ValueError):
+            ox.build_plate(1, 1)
+
+        ox = OMEXML()
+        ox.root_node.remove(ox.image().node)
+        with pytest.raises(ValueError):
+            ox.build_plate(2, 2)
+        assert ox.build_plate(1, 1, image_refs=[[[None]]]).ID == "Plate:0"
+
+    def test_validate(self, tmp_path) -> None:
+        # a small stand-in for the OME schema: images need an ID and a Pixels element
+        schema_path = tmp_path / "images.xsd"
+        schema_path.write_text("""<?xml version="1.0" encoding="UTF-8"?>
+<xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:OME="{ns}" targetNamespace="{ns}"
+            elementFormDefault="qualified">
+  <xsd:element name="OME">
+    <xsd:complexType>
+      <xsd:sequence>
+        <xsd:element name="Image" maxOccurs="unbounded">
+          <xsd:complexType>
+            <xsd:sequence>
+              <xsd:element name="AcquisitionDate" type="xsd:dateTime" minOccurs="0"/>
+              <xsd:element name="Pixels">
+                <xsd:complexType>
+                  <xsd:sequence><xsd:any processContents="skip" minOccurs="0" maxOccurs="unbounded"/></xsd:sequence>
+                  <xsd:anyAttribute processContents="skip"/>
+                </xsd:complexType>
+              </xsd:element>
+            </xsd:sequence>
+            <xsd:attribute name="ID" type="xsd:string" use="required"/>
+            <xsd:anyAttribute processContents="skip"/>
+          </xsd:complexType>
+        </xsd:element>
+      </xsd:sequence>
+      <xsd:anyAttribute processContents="skip"/>
+    </xsd:complexType>
+  </xsd:element>
+</xsd:schema>
+""".format(ns="http://www.openmicroscopy.org/Schemas/OME/2016-06"))
+
+        ox = OMEXML()
+        ox.image_count = 2
+        result = ox.validate(schema_path)
+        assert result.valid and result.errors == []
+        assert result.seconds >= 0
+
+        del ox.image(1).node.attrib["ID"]
+        result = ox.validate(schema_path)
+        assert not result.valid
+        assert "ID" in result.errors[0]
+
+        # the schema is compiled once and reused by every later validation
+        hits = omexml.get_schema.cache_info().hits
+        schema = omexml.get_schema(str(schema_path))
+        assert all(OMEXML().validate(schema_path).valid for _ in range(5))
+        assert omexml.get_schema(str(schema_path)) is schema
+        assert omexml.get_schema.cache_info().hits == hits + 7
+
+        with pytest.raises(FileNotFoundError):
+            ox.validate(tmp_path / "missing.xsd")
+
+    def test_validate_bundled_schema(self) -> None:
+        assert os.path.exists(omexml.OME_SCHEMA_PATH)
+        assert all(os.path.exists(path) for path in omexml.BUNDLED_SCHEMAS.values())
+
+        # the default document has no TiffData yet, which the schema does not allow
+        ox = OMEXML()
+        result = ox.validate()
+        assert not result.valid
+        assert "Pixels" in result.errors[0]
+
+        ox.image().Pixels.populate_TiffData()
+        result = ox.validate()
+        assert result.valid and result.errors == []
+
+        ox.image().Pixels.node.set("SizeX", "-1")
+        result = ox.validate()
+        assert not result.valid
+        assert "SizeX" in result.errors[0]
+
+    def test_rectangles(self) -> None:
+        rng = np.random.default_rng(0)
+        boxes = np.column_stack([rng.integers(0, 1000, (100000, 4)), rng.integers(0, 5, (100000, 3))])
+        ox = OMEXML()
+        ox.structured_annotations.add_original_metadata("Segmentation", "cellpose")
+        roi_ids = ox.add_rectangles(boxes, image=0)
+        xml = ox.to_xml()
+
+        for lazy in (False, True):
+            ox = OMEXML(xml, lazy=lazy)
+            table = ox.rectangles_table()
+            assert table.dtype.names == omexml.RECTANGLE_COLUMNS
+            assert (np.column_stack([table[name] for name in table.dtype.names]) == boxes).all()
+            assert ox.roi_count == 100000
+            assert ox.roi(99999).ID == roi_ids[-1] == "ROI:99999"
+
+        tags = [ElementTree.QName(child).localname for child in ox.root_node if isinstance(child.tag, str)]
+        assert tags.index("Image") < tags.index("StructuredAnnotations") < tags.index("ROI")
+        assert [node.get("ID") for node in ox.image().node.iterchildren(ox.namespaces.qn('ome', "ROIRef"))][:2] == \
+            ["ROI:0", "ROI:1"]
+
+        # numbered after the existing ROIs, missing values left out
+        ox = OMEXML(xml, lazy=True)
+        assert ox.add_rectangles(np.array([[1.5, 2, 3, 4, np.nan, 0, -1]])) == ["ROI:100000"]
+        assert ox.roi_count == 100001
+        rectangle = ox.roi(-1).Union.Rectangle()
+        assert (rectangle.X, rectangle.Width, rectangle.TheZ, rectangle.TheC, rectangle.TheT) == \
+            ("1.5", "3.0", None, 0, None)
+        assert tuple(ox.rectangles_table()[-1]) == (1.5, 2.0, 3.0, 4.0, -1, 0, -1)
+
+        ox = OMEXML()
+        ox.add_rectangles(table[:10][["X", "Y", "Width", "Height"]])
+        assert (ox.rectangles_table()["TheZ"] == -1).all()
+        assert (ox.rectangles_table()["Height"] == table["Height"][:10]).all()
+        with pytest.raises(ValueError):
+            ox.add_rectangles(np.zeros((3, 5)))
+
+        # plane indices are not truncated
+        with pytest.raises(ValueError, match="TheZ"):
+            ox.add_rectangles(np.array([[0, 0, 1, 1, 1.7, 0, 0]]))
+        with pytest.raises(ValueError, match="TheT"):
+            ox.add_rectangles(np.array([[0, 0, 1, 1, 0, 0, np.inf]]))
+        assert ox.roi_count == 10
+
+    def test_rectangles_ids(self) -> None:
+        for lazy in (False, True):
+            ox = OMEXML()
+            assert ox.add_rectangles(np.ones((2, 4))) == ["ROI:0", "ROI:1"]
+            ox = OMEXML(ox.to_xml(), lazy=lazy)
+            ox.root_node.remove(ox.roi(0).node)
+            assert ox.roi_count == 1
+            # numbered after the highest ID rather than the number of ROIs
+            assert ox.add_rectangles(np.ones((1, 4))) == ["ROI:2"]
+            assert [ox.roi(i).ID for i in range(ox.roi_count)] == ["ROI:1", "ROI:2"]
+            assert ox.roi(1).Union.Rectangle().ID == "Shape:2:0"
+
+        # a shape numbered past its ROI
+        ox = OMEXML()
+        ox.add_rectangles(np.ones((1, 4)))
+        ox.roi(0).Union.Rectangle().node.set("ID", "Shape:7:0")
+        assert ox.add_rectangles(np.ones((1, 4))) == ["ROI:8"]